@@ -1,17 +1,12 @@
 # First import all required modules
 import os
-import uuid
 import json
-import shutil
-import zipfile
-import io
-import tempfile
-
-
-import fnmatch
-import time
+from urllib.parse import quote
 from werkzeug.utils import secure_filename
-from flask import Flask, request, jsonify, send_file, make_response, after_this_request
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import parse_content_range_header
+from werkzeug.local import LocalProxy
+from flask import Flask, request, jsonify, send_file, make_response, after_this_request, Response, stream_with_context
 from flask_cors import CORS
 
 # Initialize Flask application
@@ -22,25 +17,84 @@ ADMIN_API_KEY = None
 # Configure CORS before using any app configuration
 CORS(app, resources={r"/*": {"origins": "*",
                             "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-                            "allow_headers": ["Content-Type", "Authorization", "X-API-Key"]}},
+                            "allow_headers": ["Content-Type", "Authorization", "X-API-Key",
+                                              "Range", "If-Range", "If-None-Match", "If-Modified-Since"]}},
      supports_credentials=True)
 
 # Set up app configuration
-app.config['UPLOAD_FOLDER'] = 'uploads'
+app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', 'uploads')
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max upload
 
+# Internal nginx location that maps to UPLOAD_FOLDER (e.g. /protected-uploads/).
+# When set, downloads are handed off to nginx with X-Accel-Redirect.
+app.config['X_ACCEL_PREFIX'] = os.environ.get('X_ACCEL_PREFIX')
+
 # Create uploads directory if it doesn't exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
 # Now import application-specific modules that might depend on Flask
 from pdf_operations import PdfOperations
+from jobs import JobManager
+from zip_stream import stream_zip
+from ingest import InvalidUpload
+
+# PDF operations handler, created lazily once per process. Worker processes
+# forked by the WSGI server each get their own instance (and their own
+# database connections) against the shared registry in the upload folder.
+_pdf_ops = None
+_pdf_ops_pid = None
+
+
+def get_pdf_ops():
+    """Get the PdfOperations instance for the current process"""
+    global _pdf_ops, _pdf_ops_pid
+    if _pdf_ops is None or _pdf_ops_pid != os.getpid():
+        _pdf_ops = PdfOperations(app.config['UPLOAD_FOLDER'])
+        _pdf_ops_pid = os.getpid()
+    return _pdf_ops
+
+
+pdf_ops = LocalProxy(get_pdf_ops)
+
+# Background job manager, also one per process (its process pool is private)
+_job_manager = None
+_job_manager_pid = None
+
+
+def get_job_manager():
+    """Get the JobManager instance for the current process"""
+    global _job_manager, _job_manager_pid
+    if _job_manager is None or _job_manager_pid != os.getpid():
+        _job_manager = JobManager(get_pdf_ops().registry, app.config['UPLOAD_FOLDER'])
+        _job_manager_pid = os.getpid()
+    return _job_manager
+
+
+job_manager = LocalProxy(get_job_manager)
+
+
+def start_janitor():
+    """Start the cleanup janitor; exactly one process per upload folder runs it"""
+    lock_path = os.path.join(app.config['UPLOAD_FOLDER'], 'janitor.lock')
+    get_pdf_ops().janitor.start(lock_path)
+
 
-# Initialize PDF operations handler
-pdf_ops = PdfOperations(app.config['UPLOAD_FOLDER'])
+def create_app(upload_folder=None):
+    """
+    Application factory used by the production WSGI server (see wsgi.py)
 
-# Storage for file metadata (for operations not yet migrated to PdfOperations)
-file_storage = {}
-zip_storage = {}
+    PdfOperations is not created here: each worker process creates its own
+    on first use, so nothing that holds a database connection crosses a fork.
+    """
+    global _pdf_ops, _pdf_ops_pid, _job_manager
+    if upload_folder:
+        app.config['UPLOAD_FOLDER'] = upload_folder
+        os.makedirs(upload_folder, exist_ok=True)
+        _pdf_ops = None
+        _pdf_ops_pid = None
+        _job_manager = None
+
+    return app
 
 # Import simple_logger if available
 try:
@@ -114,27 +168,126 @@ def log_operation(api_key, action, file_id=None, filename=None, description=None
         print(f"[LOG] Error during logging: {str(e)}")
         return False
 
+# Helpers for operations that can run as background jobs
+def wants_async(data=None):
+    """Check whether the client asked to run the operation as a background job"""
+    if data is not None:
+        value = data.get('async', False)
+    else:
+        value = request.form.get('async', request.args.get('async', False))
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+def parse_workers(data):
+    """Requested number of render processes: None if not given, 0 if invalid"""
+    if not data.get('workers'):
+        return None
+    try:
+        return max(0, int(data['workers']))
+    except (TypeError, ValueError):
+        return 0
+
+
+def job_accepted(job):
+    """202 response for a newly queued job"""
+    response_info = dict(job)
+    response_info['status_url'] = f"/jobs/{job['id']}"
+    return jsonify(response_info), 202
+
+
+# Response headers the frontend may read on downloads (range loading, revalidation)
+DOWNLOAD_EXPOSED_HEADERS = 'Content-Disposition, Content-Length, Content-Range, Accept-Ranges, ETag'
+
+def is_new_download(etag):
+    """Whether a download request fetches the file from its start (not a 304 or a later range)"""
+    if etag and request.if_none_match.contains_weak(etag):
+        return False
+    return request.range is None or request.range.ranges[0][0] == 0
+
+def send_stored_file(filepath, download_name, mimetype, etag=None):
+    """
+    Send a file from the upload folder as an attachment
+
+    Supports Range requests and conditional GET (ETag / Last-Modified). With
+    X_ACCEL_PREFIX set, only headers are sent and nginx streams the bytes
+    (and handles ranges) from its internal location.
+
+    Args:
+        etag: Strong ETag (e.g. the content hash); default derived from mtime and size
+    """
+    upload_folder = os.path.abspath(app.config['UPLOAD_FOLDER'])
+    relative_path = os.path.relpath(os.path.abspath(filepath), upload_folder)
+
+    if app.config.get('X_ACCEL_PREFIX') and not relative_path.startswith('..'):
+        if etag and request.if_none_match.contains_weak(etag):
+            response = make_response('', 304)
+        else:
+            response = make_response('')
+            response.headers['X-Accel-Redirect'] = app.config['X_ACCEL_PREFIX'].rstrip('/') + '/' + \
+                quote(relative_path.replace(os.sep, '/'))
+            response.headers['Content-Type'] = mimetype
+            response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+        if etag:
+            response.set_etag(etag)
+        return response
+
+    return make_response(send_file(
+        filepath,
+        download_name=download_name,
+        mimetype=mimetype,
+        as_attachment=True,
+        etag=etag if etag else True,
+        conditional=True
+    ))
+
+def zip_response(chunks, filename):
+    """Streamed ZIP download response (no Content-Length, the size is not known up front)"""
+    def generate():
+        try:
+            yield from chunks
+        except Exception as e:
+            # Headers are already sent; the client sees a truncated archive
+            app.logger.error(f"Error streaming ZIP {filename}: {str(e)}")
+            raise
+
+    response = Response(stream_with_context(generate()), mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename=filename)
+
+    # Add CORS headers
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    response.headers.add('Access-Control-Expose-Headers', 'Content-Disposition')
+    return response
 
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({'status': 'OK', 'message': 'PDF Service is running'})
 
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    # Each server process has its own document cache
+    stats = pdf_ops.docs.stats()
+    stats['thumbnails'] = pdf_ops.thumbnails.stats()
+    stats['compression'] = pdf_ops.compression_cache.stats()
+    stats['pid'] = os.getpid()
+    return jsonify(stats)
+
+@app.route('/engine-stats', methods=['GET'])
+def engine_stats():
+    # Per operation: runs on each engine, engines skipped thanks to the
+    # upload probe, and fallbacks after an engine failed (this process only)
+    return jsonify({'pid': os.getpid(), 'operations': pdf_ops.engine_stats, 'tools': pdf_ops.tools.stats()})
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    if 'pdf' not in request.files:
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
         return jsonify({'error': 'No file provided'}), 400
 
-    file = request.files['pdf']
-    if file.filename == '':
-        return jsonify({'error': 'No file selected'}), 400
-
-
-    if not file.filename.lower().endswith('.pdf'):
-        return jsonify({'error': 'File must be a PDF'}), 400
-
     try:
-        # Use the PdfOperations class to handle the upload
-        pdf_info = pdf_ops.save_pdf(file)
+        # Stream the body into the blob store; request.files is never parsed,
+        # so werkzeug does not spool the whole upload first
+        pdf_info = pdf_ops.ingest_upload(request.stream, boundary.encode('latin-1'),
+                                         max_bytes=app.config['MAX_CONTENT_LENGTH'])
 
         # Log the upload operation
         api_key = get_api_key_from_request()
@@ -150,13 +303,93 @@ def upload_file():
         response_info = pdf_info.copy()
         response_info.pop('filepath', None)
 
-        # Also store in the old system for compatibility with other functions
-        file_storage[pdf_info['id']] = pdf_info
+        return jsonify(response_info)
+    except InvalidUpload as e:
+        return jsonify({'error': str(e)}), 400
+    except RequestEntityTooLarge:
+        return jsonify({'error': 'File is too large'}), 413
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/uploads', methods=['POST'])
+def init_chunked_upload():
+    data = request.json
+    if not data or 'filename' not in data or 'size' not in data:
+        return jsonify({'error': 'Missing required parameters'}), 400
+
+    try:
+        upload = pdf_ops.uploads.init(data['filename'], data['size'], data.get('sha256'))
+        return jsonify(upload), 201
+    except InvalidUpload as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def get_chunked_upload(upload_id):
+    upload = pdf_ops.uploads.get(upload_id)
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    return jsonify(upload)
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+def put_upload_chunk(upload_id):
+    # The chunk position comes from ?offset= or a Content-Range header
+    offset = request.args.get('offset')
+    content_range = parse_content_range_header(request.headers.get('Content-Range'))
+    if offset is None and content_range is not None:
+        offset = content_range.start
+    if offset is None or request.content_length is None:
+        return jsonify({'error': 'Chunk needs an offset and a Content-Length'}), 400
+
+    try:
+        upload = pdf_ops.uploads.write_chunk(upload_id, offset, request.stream, request.content_length,
+                                             request.headers.get('X-Chunk-SHA256'))
+        if upload is None:
+            return jsonify({'error': 'Upload not found'}), 404
+
+        return jsonify(upload)
+    except (InvalidUpload, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    except RequestEntityTooLarge:
+        return jsonify({'error': 'Chunk is too large'}), 413
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_chunked_upload(upload_id):
+    try:
+        pdf_info = pdf_ops.finalize_upload(upload_id)
+        if pdf_info is None:
+            return jsonify({'error': 'Upload not found'}), 404
+
+        # Log the upload operation
+        api_key = get_api_key_from_request()
+        log_operation(
+            api_key=api_key,
+            action='upload',
+            file_id=pdf_info['id'],
+            filename=pdf_info['filename'],
+            description=f"Uploaded file in chunks: {pdf_info['filename']}"
+        )
+
+        response_info = pdf_info.copy()
+        response_info.pop('filepath', None)
 
         return jsonify(response_info)
+    except InvalidUpload as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def abort_chunked_upload(upload_id):
+    if not pdf_ops.uploads.abort(upload_id):
+        return jsonify({'error': 'Upload not found'}), 404
+
+    return jsonify({'upload_id': upload_id, 'aborted': True})
+
 @app.route('/download/<file_id>', methods=['GET', 'OPTIONS'])
 def download_file(file_id):
     # Handle CORS preflight request
@@ -164,54 +397,43 @@ def download_file(file_id):
         response = make_response()
         response.headers.add('Access-Control-Allow-Origin', '*')
         response.headers.add('Access-Control-Allow-Methods', 'GET, OPTIONS')
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type, X-API-Key')
+        response.headers.add('Access-Control-Allow-Headers', 'Content-Type, X-API-Key, Range, If-Range, If-None-Match')
         return response
 
-    # Try to get the file path from PdfOperations
-    filepath = pdf_ops.get_file_path(file_id)
-
-    if not filepath and file_id in file_storage:
-        filepath = file_storage[file_id]['filepath']
+    # Look the file up in the shared registry, rendering it if it is only a recipe so far
+    try:
+        file_info = pdf_ops.get_file_info(file_id, materialize=True)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-    if not filepath:
+    if not file_info or not file_info.get('filepath'):
         return jsonify({'error': 'File not found'}), 404
 
-    filename = ""
-    mime_type = "application/pdf"  # Default MIME type
-
-    if file_id in file_storage:
-        filename = file_storage[file_id]['filename']
-        if 'type' in file_storage[file_id]:
-            mime_type = file_storage[file_id]['type']
-    elif file_id in pdf_ops.pdf_storage:
-        filename = pdf_ops.pdf_storage[file_id]['filename']
-        if 'type' in pdf_ops.pdf_storage[file_id]:
-            mime_type = pdf_ops.pdf_storage[file_id]['type']
-    else:
-        filename = f"download_{file_id}.pdf"
+    filepath = file_info['filepath']
+    filename = file_info.get('filename') or f"download_{file_id}.pdf"
+    mime_type = file_info.get('type', "application/pdf")  # Default MIME type
 
     try:
-        # Log the download operation
-        api_key = get_api_key_from_request()
-        log_operation(
-            api_key=api_key,
-            action='download',
-            file_id=file_id,
-            filename=filename,
-            description=f"Downloaded file: {filename}"
-        )
+        # Strong ETag from the content hash, so any copy of the same bytes validates
+        etag = pdf_ops.content_hash(file_info)
+
+        # Log whole downloads once, not every range a viewer fetches or every revalidation
+        if is_new_download(etag):
+            api_key = get_api_key_from_request()
+            log_operation(
+                api_key=api_key,
+                action='download',
+                file_id=file_id,
+                filename=filename,
+                description=f"Downloaded file: {filename}"
+            )
 
         # Create a response with the file
-        response = make_response(send_file(
-            filepath,
-            download_name=filename,
-            mimetype=mime_type,
-            as_attachment=True
-        ))
+        response = send_stored_file(filepath, filename, mime_type, etag)
 
         # Add CORS headers explicitly
         response.headers.add('Access-Control-Allow-Origin', '*')
-        response.headers.add('Access-Control-Expose-Headers', 'Content-Disposition')
+        response.headers.add('Access-Control-Expose-Headers', DOWNLOAD_EXPOSED_HEADERS)
 
         return response
     except Exception as e:
@@ -231,78 +453,26 @@ def download_zip(zip_id):
     try:
         app.logger.info(f"Requesting ZIP file with ID: {zip_id}")
 
-        # Find the ZIP file information
-        zip_filepath = None
-        zip_filename = f"images_{zip_id}.zip"
-
-        # Method 1: Look in pdf_ops.pdf_storage for direct matches
-        if zip_id in pdf_ops.pdf_storage:
-            file_info = pdf_ops.pdf_storage[zip_id]
-            if 'filepath' in file_info:
-                zip_filepath = file_info['filepath']
-                zip_filename = file_info.get('filename', zip_filename)
-                app.logger.info(f"Found direct match in pdf_storage: {zip_filepath}")
-
-        # Method 2: Look in pdf_ops.pdf_storage for references to zip_id
-        if not zip_filepath:
-            for file_id, file_info in pdf_ops.pdf_storage.items():
-                if 'zip_id' in file_info and file_info['zip_id'] == zip_id:
-                    # Check various possible keys where the zip path might be stored
-                    if 'zip_path' in file_info:
-                        zip_filepath = file_info['zip_path']
-                        app.logger.info(f"Found zip_path in pdf_storage: {zip_filepath}")
-                        break
-                    elif 'zip_filepath' in file_info:
-                        zip_filepath = file_info['zip_filepath']
-                        app.logger.info(f"Found zip_filepath in pdf_storage: {zip_filepath}")
-                        break
-
-        # Method 3: Check the old zip_storage dictionary
-        if not zip_filepath and zip_id in zip_storage:
-            zip_info = zip_storage[zip_id]
-            if 'filepath' in zip_info:
-                zip_filepath = zip_info['filepath']
-                zip_filename = zip_info.get('filename', zip_filename)
-                app.logger.info(f"Found in zip_storage: {zip_filepath}")
-
-        # Method 4: Look for ZIP files in the uploads directory
-        if not zip_filepath:
-            search_pattern = f"*{zip_id}*.zip"
-            for filename in os.listdir(app.config['UPLOAD_FOLDER']):
-                if zip_id in filename and filename.endswith('.zip'):
-                    zip_filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    app.logger.info(f"Found by filesystem search: {zip_filepath}")
-                    break
-
-        # If we still couldn't find it, create a new ZIP from the images
-        if not zip_filepath:
-            app.logger.info(f"ZIP not found, attempting to create it from individual files")
-
-            # Find all image files with this zip_id reference
-            image_files = []
-            for file_id, file_info in pdf_ops.pdf_storage.items():
-                if 'zip_id' in file_info and file_info['zip_id'] == zip_id and 'filepath' in file_info:
-                    image_files.append(file_info)
-
-            if image_files:
-                # Create a new ZIP file
-                zip_filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"images_{zip_id}.zip")
-
-                with zipfile.ZipFile(zip_filepath, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                    for img_info in image_files:
-                        img_path = img_info['filepath']
-                        img_name = img_info['filename']
-                        if os.path.exists(img_path):
-                            zip_file.write(img_path, img_name)
-
-                app.logger.info(f"Created new ZIP file: {zip_filepath}")
-
-        # Final check if we have a valid file
-        if not zip_filepath or not os.path.exists(zip_filepath):
+        # Resolve the archive with a single manifest lookup
+        zip_info = pdf_ops.get_zip_info(zip_id)
+        if not zip_info:
             app.logger.error(f"ZIP file not found for ID: {zip_id}")
             return jsonify({'error': 'ZIP file not found'}), 404
 
-        app.logger.info(f"Sending ZIP file: {zip_filepath}")
+        zip_filepath = zip_info['filepath']
+        zip_filename = zip_info['filename']
+
+        # Archives are not stored; stream them from their member files
+        members = None
+        if not zip_filepath or not os.path.exists(zip_filepath):
+            members = list(pdf_ops.iter_zip_members(zip_id))
+            if not members:
+                app.logger.error(f"No member files left for ZIP ID: {zip_id}")
+                return jsonify({'error': 'ZIP file not found'}), 404
+
+            app.logger.info(f"Streaming ZIP {zip_filename} from {len(members)} member files")
+        else:
+            app.logger.info(f"Sending ZIP file: {zip_filepath}")
 
         # Log the download operation
         api_key = get_api_key_from_request()
@@ -315,17 +485,15 @@ def download_zip(zip_id):
         )
 
         try:
-            # Create a response with the file
-            response = make_response(send_file(
-                zip_filepath,
-                download_name=zip_filename,
-                mimetype='application/zip',
-                as_attachment=True
-            ))
+            if members is not None:
+                response = zip_response(stream_zip(members), zip_filename)
+            else:
+                # Create a response with the file
+                response = send_stored_file(zip_filepath, zip_filename, 'application/zip')
 
             # Add CORS headers explicitly
             response.headers.add('Access-Control-Allow-Origin', '*')
-            response.headers.add('Access-Control-Expose-Headers', 'Content-Disposition')
+            response.headers.add('Access-Control-Expose-Headers', DOWNLOAD_EXPOSED_HEADERS)
 
             return response
         except Exception as e:
@@ -346,6 +514,10 @@ def download_zip(zip_id):
 
 @app.route('/merge', methods=['POST'])
 def merge_files():
+    # Merge files that are already uploaded, by ID
+    if request.is_json:
+        return merge_stored_files(request.json or {})
+
     # Check if we have at least one file
     if len(request.files) < 1:
         return jsonify({'error': 'Need at least one PDF file to merge'}), 400
@@ -366,10 +538,18 @@ def merge_files():
     else:
         output_filename = f"merged_{len(files)}_files.pdf"
 
+    # Optionally subset fonts and merge duplicate objects of the result
+    optimize = str(request.form.get('optimize', False)).lower() in ('1', 'true', 'yes')
+
     try:
+        if wants_async():
+            # Keep the uploads in the store so the job can read them later
+            paths = [pdf_ops.get_file_path(pdf_ops.save_pdf(file)['id']) for file in files]
+            job = job_manager.submit('merge', {'paths': paths, 'output_filename': output_filename,
+                                               'optimize': optimize})
+            return job_accepted(job)
 
-        pdf_info = pdf_ops.merge_pdfs(files, output_filename)
-        file_storage[pdf_info['id']] = pdf_info
+        pdf_info = pdf_ops.merge_pdfs(files, output_filename, optimize=optimize)
 
         # Get API key for logging
         api_key = get_api_key_from_request()
@@ -398,6 +578,48 @@ def merge_files():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def merge_stored_files(data):
+    """Merge by file_ids (or inputs with per-file pages/ranges), reading the stored files"""
+    inputs = data.get('inputs') or data.get('file_ids')
+    if not isinstance(inputs, list) or len(inputs) < 2:
+        return jsonify({'error': 'Need at least two file_ids to merge'}), 400
+
+    for item in inputs:
+        input_id = item.get('file_id') if isinstance(item, dict) else item
+        if input_id not in pdf_ops.registry:
+            return jsonify({'error': f'File not found: {input_id}'}), 404
+
+    output_filename = secure_filename(data['output_filename']) if data.get('output_filename') else None
+    if not output_filename:
+        output_filename = f"merged_{len(inputs)}_files.pdf"
+
+    optimize = bool(data.get('optimize', False))
+
+    try:
+        if wants_async(data):
+            job = job_manager.submit('merge', {'inputs': inputs, 'output_filename': output_filename,
+                                               'optimize': optimize})
+            return job_accepted(job)
+
+        pdf_info = pdf_ops.merge_stored(inputs, output_filename, optimize=optimize)
+
+        # Log the operation
+        api_key = get_api_key_from_request()
+        log_operation(
+            api_key,
+            'merge',
+            pdf_info['id'],
+            pdf_info['filename'],
+            f"Merged {len(inputs)} stored files"
+        )
+
+        response_info = pdf_info.copy()
+        response_info.pop('filepath', None)
+
+        return jsonify(response_info)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/split', methods=['POST'])
 def split_pdf():
     data = request.json
@@ -406,8 +628,8 @@ def split_pdf():
 
     file_id = data['file_id']
 
-    # Check if file exists in either system
-    if file_id not in pdf_ops.pdf_storage and file_id not in file_storage:
+    # Check if file exists
+    if file_id not in pdf_ops.registry:
         return jsonify({'error': 'File not found'}), 404
 
     split_method = data['split_method']
@@ -430,23 +652,14 @@ def split_pdf():
             pages = [int(p.strip()) for p in pages.split(',') if p.strip().isdigit()]
 
     try:
+        if wants_async(data):
+            job = job_manager.submit('split', {'file_id': file_id, 'split_method': split_method,
+                                               'ranges': ranges, 'pages': pages, 'create_zip': create_zip})
+            return job_accepted(job)
+
         # Use the PdfOperations class to split PDF
         result_files = pdf_ops.split_pdf(file_id, split_method, ranges, pages, create_zip)
 
-        # Also store in the old system for compatibility
-        for file_info in result_files:
-            if 'id' in file_info:
-                file_storage[file_info['id']] = file_info
-
-            # If there's zip info, store that too
-            if 'zip_id' in file_info and 'zip_path' in file_info:
-                zip_storage[file_info['zip_id']] = {
-                    'id': file_info['zip_id'],
-                    'filename': file_info['zip_filename'],
-                    'filepath': file_info['zip_path']
-                }
-
-
         # Get API key for logging
         api_key = get_api_key_from_request()
 
@@ -460,13 +673,6 @@ def split_pdf():
         else:
             description = f"Split PDF using method: {split_method}"
 
-        # Get original filename
-        original_filename = None
-        if file_id in pdf_ops.pdf_storage:
-            original_filename = pdf_ops.pdf_storage[file_id].get('filename', 'Unknown')
-        elif file_id in file_storage:
-            original_filename = file_storage[file_id].get('filename', 'Unknown')
-
         # Log operation using a representative file (first one)
         if result_files:
             log_operation(
@@ -502,8 +708,8 @@ def rotate_pdf():
 
     file_id = data['file_id']
 
-    # Check if file exists in either system
-    if file_id not in pdf_ops.pdf_storage and file_id not in file_storage:
+    # Check if file exists
+    if file_id not in pdf_ops.registry:
         return jsonify({'error': 'File not found'}), 404
 
     # Get rotation parameters
@@ -520,18 +726,16 @@ def rotate_pdf():
 
     try:
         # Use the PdfOperations class to rotate PDF
-        pdf_info = pdf_ops.rotate_pdf(file_id, angle, pages)
-
-        # Also store in the old system for compatibility
-        file_storage[pdf_info['id']] = pdf_info
+        pdf_info = pdf_ops.rotate_pdf(file_id, angle, pages, incremental=data.get('incremental', True))
 
         # Get API key for logging
         api_key = get_api_key_from_request()
 
         # Get original filename for better description
         original_filename = "unknown"
-        if file_id in pdf_ops.pdf_storage:
-            original_filename = pdf_ops.pdf_storage[file_id].get('filename', 'unknown')
+        source_info = pdf_ops.get_file_info(file_id)
+        if source_info:
+            original_filename = source_info.get('filename', 'unknown')
 
         # Create detailed description
         page_desc = "all pages"
@@ -561,6 +765,8 @@ def rotate_pdf():
         response_info.pop('filepath', None)
 
         return jsonify(response_info)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -573,8 +779,8 @@ def add_watermark():
 
     file_id = data['file_id']
 
-    # Check if file exists in either system
-    if file_id not in pdf_ops.pdf_storage and file_id not in file_storage:
+    # Check if file exists
+    if file_id not in pdf_ops.registry:
         return jsonify({'error': 'File not found'}), 404
 
     # Get watermark parameters
@@ -618,9 +824,6 @@ def add_watermark():
         # Use the PdfOperations class to add watermark
         pdf_info = pdf_ops.add_watermark(file_id, watermark_text, opacity, color, size, angle, pages)
 
-        # Also store in the old system for compatibility
-        file_storage[pdf_info['id']] = pdf_info
-
         # Get API key for logging
         api_key = get_api_key_from_request()
 
@@ -648,6 +851,8 @@ def add_watermark():
         response_info.pop('filepath', None)
 
         return jsonify(response_info)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -667,46 +872,32 @@ def pdf_to_image_zip():
         pages = data.get('pages')
 
         # Check if file exists
-        if file_id not in pdf_ops.pdf_storage:
+        file_info = pdf_ops.get_file_info(file_id)
+        if not file_info:
             return jsonify({'error': 'File not found'}), 404
 
-        # Convert PDF to images
-        result_files = pdf_ops.convert_pdf_to_images(file_id, format, dpi, pages, True)
+        # Number of render processes (None = RENDER_WORKERS default, capped by the server)
+        workers = parse_workers(data)
+        if workers == 0:
+            return jsonify({'error': 'workers must be a positive integer'}), 400
+
+        # Render pages while the archive is being sent, nothing is stored
+        images = pdf_ops.iter_page_images(file_id, format, dpi, pages, workers=workers)
 
         # Get API key for logging
         api_key = get_api_key_from_request()
 
         # Log operation
+        page_count = len(pages) if pages else "all"
         log_operation(
             api_key,
             'pdf-to-image',
             file_id,
-            pdf_ops.pdf_storage[file_id]['filename'],
-            f"Converted PDF to {len(result_files)} {format.upper()} images"
+            file_info['filename'],
+            f"Converted {page_count} pages to {format.upper()} images ({dpi} DPI)"
         )
 
-        # Create a temporary ZIP file
-        zip_buffer = BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            for file_info in result_files:
-                filepath = file_info['filepath']
-                filename = file_info['filename']
-                if os.path.exists(filepath):
-                    zip_file.write(filepath, filename)
-
-        # Seek to the beginning of the buffer
-        zip_buffer.seek(0)
-
-        # Create a response with the ZIP file
-        response = make_response(zip_buffer.getvalue())
-        response.headers.set('Content-Type', 'application/zip')
-        response.headers.set('Content-Disposition', 'attachment', filename='pdf_images.zip')
-
-        # Add CORS headers
-        response.headers.add('Access-Control-Allow-Origin', '*')
-        response.headers.add('Access-Control-Expose-Headers', 'Content-Disposition')
-
-        return response
+        return zip_response(stream_zip(images), 'pdf_images.zip')
 
     except Exception as e:
         app.logger.error(f"Error creating ZIP file: {str(e)}")
@@ -730,8 +921,9 @@ def pdf_to_image():
 
         file_id = data['file_id']
 
-        # Check if file exists in either system
-        if file_id not in pdf_ops.pdf_storage and file_id not in file_storage:
+        # Check if file exists
+        source_info = pdf_ops.get_file_info(file_id)
+        if not source_info:
             return jsonify({'error': 'File not found'}), 404
 
         # Get conversion parameters
@@ -739,6 +931,11 @@ def pdf_to_image():
         dpi = data.get('dpi', 300)
         create_zip = data.get('create_zip', True)
 
+        # Number of render processes (None = RENDER_WORKERS default, capped by the server)
+        workers = parse_workers(data)
+        if workers == 0:
+            return jsonify({'error': 'workers must be a positive integer'}), 400
+
         # Handle page selection
         pages = None
         if 'pages' in data:
@@ -747,38 +944,20 @@ def pdf_to_image():
             if isinstance(pages, list):
                 pages = [int(p) for p in pages if isinstance(p, (int, str)) and str(p).isdigit()]
 
-        # Use the PdfOperations class to convert PDF to images
-        result_files = pdf_ops.convert_pdf_to_images(file_id, format, dpi, pages, create_zip)
-
-        # Also store in the old system for compatibility
-        for file_info in result_files:
-            if 'id' in file_info:
-                file_storage[file_info['id']] = file_info
+        if wants_async(data):
+            job = job_manager.submit('pdf-to-image', {'file_id': file_id, 'format': format, 'dpi': dpi,
+                                                      'pages': pages, 'create_zip': create_zip,
+                                                      'workers': workers})
+            return job_accepted(job)
 
-            # If there's zip info, store that too
-            if 'zip_id' in file_info:
-                zip_id = file_info['zip_id']
-                for other_file in result_files:
-                    if other_file.get('zip_id') == zip_id and 'zip_path' in other_file:
-                        zip_storage[zip_id] = {
-                            'id': zip_id,
-                            'filename': os.path.basename(other_file['zip_path']),
-                            'filepath': other_file['zip_path'],
-                            'type': 'application/zip'
-                        }
-                        break
+        # Use the PdfOperations class to convert PDF to images
+        result_files = pdf_ops.convert_pdf_to_images(file_id, format, dpi, pages, create_zip, workers=workers)
 
         # Get API key for logging
         api_key = get_api_key_from_request()
 
         # Get the original filename
-        file_name = None
-        if file_id in pdf_ops.pdf_storage:
-            file_name = pdf_ops.pdf_storage[file_id]['filename']
-        elif file_id in file_storage:
-            file_name = file_storage[file_id]['filename']
-        else:
-            file_name = "Unknown"
+        file_name = source_info.get('filename', "Unknown")
 
         # Create descriptive message
         page_count = len(pages) if pages else "all"
@@ -837,9 +1016,6 @@ def image_to_pdf():
         # Use the PdfOperations class to convert images to PDF
         pdf_info = pdf_ops.convert_images_to_pdf(image_files, page_size, orientation)
 
-        # Also store in the old system for compatibility
-        file_storage[pdf_info['id']] = pdf_info
-
         # Get API key for logging
         api_key = get_api_key_from_request()
 
@@ -934,18 +1110,28 @@ def compress_pdf_route():
         # Get compression parameters
         compression_level = data.get('compression_level', 'medium')
         preview_only = data.get('preview_only', False)
-
-        # Important: use file_storage if file_id is not in pdf_ops.pdf_storage
-        if file_id not in pdf_ops.pdf_storage and file_id in file_storage:
-            # Copy file info to pdf_ops storage
-            pdf_ops.pdf_storage[file_id] = file_storage[file_id]
+        optimize = bool(data.get('optimize', False))
+
+        # Optional size to fit under, instead of a fixed level
+        target_bytes = data.get('target_bytes')
+        if target_bytes is not None:
+            try:
+                target_bytes = int(target_bytes)
+            except (TypeError, ValueError):
+                target_bytes = 0
+            if target_bytes <= 0:
+                return jsonify({'error': 'target_bytes must be a positive integer'}), 400
+            compression_level = 'target'
+
+        if wants_async(data):
+            if file_id not in pdf_ops.registry:
+                return jsonify({'error': 'File not found'}), 404
+            job = job_manager.submit('compress', {'file_id': file_id, 'compression_level': compression_level,
+                                                  'target_bytes': target_bytes, 'optimize': optimize})
+            return job_accepted(job)
 
         # Use the PdfOperations class to compress PDF
-        pdf_info = pdf_ops.compress_pdf(file_id, compression_level)
-
-
-        # Also store in the old system for compatibility
-        file_storage[pdf_info['id']] = pdf_info
+        pdf_info = pdf_ops.compress_pdf(file_id, compression_level, target_bytes=target_bytes, optimize=optimize)
 
 
         # Get API key for logging
@@ -981,6 +1167,42 @@ def compress_pdf_route():
         print(f"Error compressing PDF: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/optimize', methods=['POST'])
+def optimize_pdf_route():
+    data = request.json
+    if not data or 'file_id' not in data:
+        return jsonify({'error': 'Missing required parameters'}), 400
+
+    file_id = data['file_id']
+    subset_fonts = bool(data.get('subset_fonts', True))
+
+    try:
+        if wants_async(data):
+            if file_id not in pdf_ops.registry:
+                return jsonify({'error': 'File not found'}), 404
+            job = job_manager.submit('optimize', {'file_id': file_id, 'subset_fonts': subset_fonts})
+            return job_accepted(job)
+
+        pdf_info = pdf_ops.optimize_pdf(file_id, subset_fonts)
+
+        # Log the operation
+        api_key = get_api_key_from_request()
+        log_operation(
+            api_key,
+            'optimize',
+            pdf_info['id'],
+            pdf_info['filename'],
+            f"Optimized PDF, saved {-pdf_info['size_delta']} bytes"
+        )
+
+        response_info = pdf_info.copy()
+        response_info.pop('filepath', None)
+
+        return jsonify(response_info)
+    except Exception as e:
+        print(f"Error optimizing PDF: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/remove-pages', methods=['POST'])
 def remove_pages_route():
     data = request.json
@@ -992,19 +1214,12 @@ def remove_pages_route():
     preview_only = data.get('preview_only', False)
 
     try:
-        # Make sure the file exists in pdf_ops storage
-        if file_id not in pdf_ops.pdf_storage and file_id in file_storage:
-            pdf_ops.pdf_storage[file_id] = file_storage[file_id]
-
         # Create a preview or actually remove the pages
         if preview_only:
             pdf_info = pdf_ops.preview_remove_pages(file_id, pages_to_remove)
         else:
             pdf_info = pdf_ops.remove_pages(file_id, pages_to_remove)
 
-        # Also store in the old system for compatibility
-        file_storage[pdf_info['id']] = pdf_info
-
         # Get API key for logging
         api_key = get_api_key_from_request()
 
@@ -1026,6 +1241,8 @@ def remove_pages_route():
         response_info.pop('filepath', None)
 
         return jsonify(response_info)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -1039,21 +1256,16 @@ def preview_remove_pages_route():
     pages_to_remove = data['pages']
 
     try:
-        # Make sure the file exists in pdf_ops storage
-        if file_id not in pdf_ops.pdf_storage and file_id in file_storage:
-            pdf_ops.pdf_storage[file_id] = file_storage[file_id]
-
         # Create a preview
         pdf_info = pdf_ops.preview_remove_pages(file_id, pages_to_remove)
 
-        # Also store in the old system for compatibility
-        file_storage[pdf_info['id']] = pdf_info
-
         # Return metadata (excluding internal filepath)
         response_info = pdf_info.copy()
         response_info.pop('filepath', None)
 
         return jsonify(response_info)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -1068,15 +1280,9 @@ def edit_metadata_route():
     preview_only = data.get('preview_only', False)
 
     try:
-        # Make sure the file exists in pdf_ops storage
-        if file_id not in pdf_ops.pdf_storage and file_id in file_storage:
-            pdf_ops.pdf_storage[file_id] = file_storage[file_id]
-
         # Edit metadata
-        pdf_info = pdf_ops.edit_metadata(file_id, metadata, preview_only)
-
-        # Also store in the old system for compatibility
-        file_storage[pdf_info['id']] = pdf_info
+        pdf_info = pdf_ops.edit_metadata(file_id, metadata, preview_only,
+                                         incremental=data.get('incremental', True))
 
         # Get API key for logging
         api_key = get_api_key_from_request()
@@ -1112,12 +1318,51 @@ def edit_metadata_route():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/pipeline', methods=['POST'])
+def pipeline_route():
+    data = request.json
+    if not data or 'file_id' not in data or not isinstance(data.get('steps'), list):
+        return jsonify({'error': 'Missing required parameters'}), 400
+
+    file_id = data['file_id']
+    steps = data['steps']
+
+    # Check if file exists
+    if file_id not in pdf_ops.registry:
+        return jsonify({'error': 'File not found'}), 404
+
+    for step in steps:
+        if not isinstance(step, dict) or step.get('op') not in pdf_ops.PIPELINE_STEPS:
+            return jsonify({'error': f"Each step needs an op out of: {', '.join(pdf_ops.PIPELINE_STEPS)}"}), 400
+
+    if any(step['op'] == 'protect' for step in steps[:-1]):
+        return jsonify({'error': 'protect must be the last pipeline step'}), 400
+
+    try:
+        # Run all steps on one document and save once
+        pdf_info = pdf_ops.run_pipeline(file_id, steps)
+
+        # Get API key for logging
+        api_key = get_api_key_from_request()
+        log_operation(
+            api_key,
+            'pipeline',
+            pdf_info['id'],
+            pdf_info['filename'],
+            f"Applied {' + '.join(pdf_info['steps'])} in one pass"
+        )
+
+        # Return metadata (excluding internal filepath)
+        response_info = pdf_info.copy()
+        response_info.pop('filepath', None)
+
+        return jsonify(response_info)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/metadata/<file_id>', methods=['GET'])
 def get_metadata_route(file_id):
-    if file_id not in pdf_ops.pdf_storage and file_id in file_storage:
-        pdf_ops.pdf_storage[file_id] = file_storage[file_id]
-
-    if file_id not in pdf_ops.pdf_storage:
+    if file_id not in pdf_ops.registry:
         return jsonify({'error': 'File not found'}), 404
 
     try:
@@ -1126,6 +1371,84 @@ def get_metadata_route(file_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/info/<file_id>', methods=['GET'])
+def get_info_route(file_id):
+    file_info = pdf_ops.get_file_info(file_id)
+    if not file_info:
+        return jsonify({'error': 'File not found'}), 404
+
+    try:
+        structure = pdf_ops.get_structure(file_id)
+
+        response_info = {'id': file_id, 'filename': file_info.get('filename')}
+        response_info.update(structure)
+        return jsonify(response_info)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/analyze/<file_id>', methods=['GET'])
+def analyze_route(file_id):
+    if file_id not in pdf_ops.registry:
+        return jsonify({'error': 'File not found'}), 404
+
+    try:
+        return jsonify(pdf_ops.analyze(file_id))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/thumbnail/<file_id>/<int:page>', methods=['GET'])
+def get_thumbnail_route(file_id, page):
+    if file_id not in pdf_ops.registry:
+        return jsonify({'error': 'File not found'}), 404
+
+    try:
+        # Optional preview of an operation on the page
+        watermark = None
+        if request.args.get('watermark'):
+            watermark = {'text': request.args['watermark']}
+            for name, convert in (('opacity', float), ('color', str), ('size', int), ('angle', int)):
+                if name in request.args:
+                    watermark[name] = convert(request.args[name])
+
+        thumbnail = pdf_ops.render_thumbnail(
+            file_id,
+            page,
+            width=request.args.get('w', 200),
+            image_format=request.args.get('format', 'png'),
+            rotate=request.args.get('rotate', 0),
+            watermark=watermark,
+            remove=request.args.get('remove', '').lower() in ('1', 'true', 'yes')
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    # The key covers content and all render options, so the image never changes
+    response = make_response(send_file(thumbnail['filepath'], mimetype=thumbnail['mimetype'],
+                                       etag=thumbnail['key'], conditional=True))
+    response.headers['Cache-Control'] = 'private, max-age=86400'
+    return response
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job_route(job_id):
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job_route(job_id):
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+
+    if job['status'] not in ('queued', 'running'):
+        return jsonify({'error': f"Job already {job['status']}"}), 409
+
+    return jsonify(job_manager.cancel(job_id))
+
 @app.route('/api-docs-spec', methods=['GET'])
 def api_docs_spec():
     try:
@@ -1136,27 +1459,6 @@ def api_docs_spec():
         app.logger.error(f"Error loading Swagger spec: {str(e)}")
         return jsonify({"error": "Failed to load API documentation"}), 500
 
-def get_zip_path(self, zip_id):
-    """Get zip file path for download"""
-    # First, check if we have a direct match in our storage
-    for file_id, file_info in self.pdf_storage.items():
-        if file_id == zip_id and 'filepath' in file_info:
-            return file_info['filepath']
-
-    # Then check for zip references
-    for file_id, file_info in self.pdf_storage.items():
-        if 'zip_id' in file_info and file_info['zip_id'] == zip_id:
-            if 'zip_path' in file_info:
-                return file_info['zip_path']
-
-    # If not found, search for any ZIP file with matching id pattern
-    zip_pattern = f"*{zip_id}*.zip"
-    for filename in os.listdir(self.upload_folder):
-        if fnmatch.fnmatch(filename, zip_pattern):
-            return os.path.join(self.upload_folder, filename)
-
-    return None
-
 @app.route('/test-logging-flow', methods=['GET'])
 def test_logging_flow():
     """Test kompletného logovacieho flow"""
@@ -1186,39 +1488,9 @@ def test_logging_flow():
         return jsonify({'error': str(e)}), 500
 
 
-# Cleanup task for temporary files (run in production)
-def cleanup_old_files():
-    while True:
-        time.sleep(3600)  # Sleep for 1 hour
-
-        try:
-            # Use the PdfOperations class to clean up files
-            pdf_ops.cleanup_files(24)  # 24 hours
-
-            # Also clean up any remaining files in the old system
-            now = time.time()
-            max_age = 24 * 3600  # 24 hours
-
-            # Clean up old files
-            for root, dirs, files in os.walk(app.config['UPLOAD_FOLDER']):
-                for filename in files:
-                    filepath = os.path.join(root, filename)
-                    if os.path.isfile(filepath):
-                        file_age = now - os.path.getmtime(filepath)
-                        if file_age > max_age:
-                            try:
-                                os.remove(filepath)
-                                print(f"Removed old file: {filepath}")
-                            except:
-                                pass
-        except Exception as e:
-            print(f"Error during cleanup: {str(e)}")
-
 if __name__ == '__main__':
-    # Start cleanup task in a separate thread
-    import threading
-    cleanup_thread = threading.Thread(target=cleanup_old_files, daemon=True)
-    cleanup_thread.start()
+    # Start the janitor that removes expired files in small batches
+    start_janitor()
 
-    # Start the Flask app
+    # Start the Flask development server (production uses gunicorn, see gunicorn.conf.py)
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,103 @@
+"""
+Benchmark for rotate and edit-metadata: incremental update vs. full rewrite.
+
+Builds a synthetic scanned-style document (one large noisy image per page),
+then times rotate_pdf and edit_metadata with incremental=True and
+incremental=False and compares latency, output size and how much of the
+output is new (an incremental update keeps the source bytes as a prefix and
+appends a small update section; on filesystems with reflinks that prefix is
+shared with the source instead of copied).
+
+Usage (from python-service/):
+    python benchmarks/bench_incremental_save.py [--pages 40] [--image-size 1600] [--repeat 3]
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import fitz
+from werkzeug.datastructures import FileStorage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pdf_operations import PdfOperations
+
+
+def build_document(path, page_count, image_size):
+    """Create a PDF with one incompressible image per page, like a scan"""
+    doc = fitz.open()
+    for page_number in range(page_count):
+        page = doc.new_page()
+        samples = os.urandom(image_size * image_size * 3)
+        pixmap = fitz.Pixmap(fitz.csRGB, image_size, image_size, samples, False)
+        page.insert_image(page.rect, stream=pixmap.tobytes('jpeg', jpg_quality=85))
+        page.insert_text((72, 30), f"Scanned page {page_number + 1}", fontsize=18)
+    doc.save(path)
+    doc.close()
+
+
+def run(label, operation, repeat):
+    """Time an operation (best of repeat) and return its last result"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = operation()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return label, best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=40)
+    parser.add_argument('--image-size', type=int, default=1600)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_incremental_')
+
+    try:
+        ops = PdfOperations(os.path.join(work_dir, 'uploads'))
+
+        source_path = os.path.join(work_dir, 'source.pdf')
+        build_document(source_path, args.pages, args.image_size)
+        with open(source_path, 'rb') as f:
+            file_id = ops.save_pdf(FileStorage(f, filename='source.pdf'))['id']
+        source_size = os.path.getsize(source_path)
+
+        print(f"{args.pages} pages, source {source_size / 1024 / 1024:.1f} MB, best of {args.repeat}")
+
+        cases = []
+        for incremental in (False, True):
+            mode = 'incremental' if incremental else 'rewrite'
+            # lazy=False times the rewrite itself, not just registering a recipe
+            cases.append(run(f"rotate         {mode:<12}",
+                             lambda: ops.rotate_pdf(file_id, 90, [1], incremental=incremental, lazy=False),
+                             args.repeat))
+            cases.append(run(f"edit_metadata  {mode:<12}",
+                             lambda: ops.edit_metadata(file_id, {'title': 'Benchmark'}, incremental=incremental),
+                             args.repeat))
+
+        with open(source_path, 'rb') as f:
+            source_bytes = f.read()
+
+        for label, elapsed, result in cases:
+            output_size = os.path.getsize(result['filepath'])
+
+            # An incremental update leaves the source bytes untouched and appends to them
+            with open(result['filepath'], 'rb') as f:
+                output_bytes = f.read()
+            appended = output_bytes[len(source_bytes):] if output_bytes.startswith(source_bytes) else None
+            update = f"update section {len(appended) / 1024:6.1f} KB" if appended is not None else "full rewrite"
+
+            print(f"{label} {elapsed * 1000:9.1f} ms  output {output_size / 1024 / 1024:7.2f} MB  {update}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
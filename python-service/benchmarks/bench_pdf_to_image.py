@@ -0,0 +1,97 @@
+"""
+Benchmark for PDF to image conversion: serial vs. parallel page rendering.
+
+Builds a synthetic document (vector drawings plus text on every page), then
+times convert_pdf_to_images with different worker counts and checks that
+every run produces the same files.
+
+Usage (from python-service/):
+    python benchmarks/bench_pdf_to_image.py [--pages 40] [--dpi 150] [--workers 1,2,4,8]
+"""
+import os
+import sys
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+
+import fitz
+from werkzeug.datastructures import FileStorage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pdf_operations import PdfOperations
+
+
+def build_document(path, page_count):
+    """Create a PDF whose pages are reasonably expensive to rasterize"""
+    doc = fitz.open()
+    for page_number in range(page_count):
+        page = doc.new_page()
+        for row in range(40):
+            for col in range(30):
+                rect = fitz.Rect(20 + col * 19, 40 + row * 19, 36 + col * 19, 56 + row * 19)
+                color = ((row * 7 % 255) / 255, (col * 11 % 255) / 255, (page_number * 13 % 255) / 255)
+                page.draw_circle(rect.tl + (8, 8), 7, color=color, fill=color)
+        page.insert_text((72, 30), f"Benchmark page {page_number + 1}", fontsize=18)
+    doc.save(path)
+    doc.close()
+
+
+def digest_outputs(result_files):
+    """Hash output files by name so runs can be compared"""
+    digests = {}
+    for file_info in result_files:
+        with open(file_info['filepath'], 'rb') as f:
+            digests[file_info['filename']] = hashlib.sha256(f.read()).hexdigest()
+    return digests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=40)
+    parser.add_argument('--dpi', type=int, default=150)
+    parser.add_argument('--format', default='png')
+    parser.add_argument('--workers', default='1,2,4,8')
+    args = parser.parse_args()
+
+    worker_counts = [int(w) for w in args.workers.split(',')]
+    work_dir = tempfile.mkdtemp(prefix='bench_pdf_to_image_')
+
+    try:
+        ops = PdfOperations(os.path.join(work_dir, 'uploads'))
+
+        source_path = os.path.join(work_dir, 'source.pdf')
+        build_document(source_path, args.pages)
+        with open(source_path, 'rb') as f:
+            file_id = ops.save_pdf(FileStorage(f, filename='source.pdf'))['id']
+
+        print(f"{args.pages} pages at {args.dpi} DPI ({args.format}), {os.cpu_count()} CPUs")
+
+        baseline = None
+        serial_time = None
+        for workers in worker_counts:
+            # Warm the pool once so process start-up is not counted
+            if workers > 1:
+                ops.convert_pdf_to_images(file_id, args.format, args.dpi, [1, 2], False, workers=workers)
+
+            start = time.perf_counter()
+            result_files = ops.convert_pdf_to_images(file_id, args.format, args.dpi, None, False, workers=workers)
+            elapsed = time.perf_counter() - start
+
+            digests = digest_outputs(result_files)
+            if baseline is None:
+                baseline = digests
+            identical = digests == baseline
+
+            if serial_time is None:
+                serial_time = elapsed
+            print(f"workers={workers:<3} {elapsed:8.2f}s  {args.pages / elapsed:7.1f} pages/s  "
+                  f"speedup {serial_time / elapsed:4.2f}x  identical={identical}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import os
+import time
+import uuid
+import hashlib
+
+
+class BlobStore:
+    """
+    Content-addressed storage for uploaded PDFs.
+
+    Uploads are hashed with SHA-256 while they stream to disk and kept once
+    per digest under blobs/<aa>/<digest>.pdf. File IDs in the registry are
+    cheap references to a blob, so uploading the same document again costs
+    no extra disk space.
+    """
+
+    CHUNK_SIZE = 1024 * 1024  # 1MB
+
+    def __init__(self, root, registry):
+        """Initialize the store below root, tracking blobs in registry"""
+        self.root = root
+        self.registry = registry
+        self.tmp_folder = os.path.join(root, 'tmp')
+        os.makedirs(self.tmp_folder, exist_ok=True)
+
+    def path_for(self, digest):
+        """Get the on-disk location of a blob"""
+        return os.path.join(self.root, digest[:2], f"{digest}.pdf")
+
+    def store(self, stream):
+        """
+        Stream a file-like object into the store
+
+        Returns:
+            Blob entry dictionary (digest, filepath, size, refcount, info).
+            info is None the first time a digest is seen.
+        """
+        with self.open_writer() as writer:
+            while True:
+                chunk = stream.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                writer.write(chunk)
+
+            return writer.commit()
+
+    def store_file(self, path):
+        """Move a finished file (e.g. an operation's output) into the store, return the blob entry"""
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                sha256.update(chunk)
+
+        return self.commit(path, sha256.hexdigest(), os.path.getsize(path))
+
+    def open_writer(self):
+        """Start a blob that is written (and hashed) chunk by chunk, see BlobWriter"""
+        return BlobWriter(self)
+
+    def commit(self, tmp_path, digest, size):
+        """Move a fully written temporary file into the store and reference it"""
+        blob_path = self.path_for(digest)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+        try:
+            # Hard-link so an existing blob is never overwritten
+            os.link(tmp_path, blob_path)
+        except FileExistsError:
+            # Same content is already stored
+            pass
+
+        blob = self.registry.add_blob_ref(digest, blob_path, size)
+
+        # The janitor may have released the old blob between the link and the
+        # new reference; restore it from our copy in that case
+        if not os.path.exists(blob_path):
+            os.link(tmp_path, blob_path)
+
+        os.remove(tmp_path)
+        return blob
+
+    def purge_tmp(self, max_age_seconds):
+        """Remove partial uploads left behind by interrupted requests"""
+        now = time.time()
+        with os.scandir(self.tmp_folder) as entries:
+            for entry in entries:
+                try:
+                    if now - entry.stat().st_mtime > max_age_seconds:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+
+
+class BlobWriter:
+    """
+    Incremental writer of one blob, for data that arrives in pieces
+
+    Chunks go to a temporary file in the store and into the SHA-256 as they
+    are written. commit() moves the file into the store; leaving the
+    context without committing (e.g. after rejecting the data) deletes it.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.tmp_path = os.path.join(store.tmp_folder, f"{uuid.uuid4()}.part")
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+        self._file = open(self.tmp_path, 'wb')
+
+    def write(self, chunk):
+        self._sha256.update(chunk)
+        self._file.write(chunk)
+        self.size += len(chunk)
+
+    def commit(self):
+        """Store the written data and return the blob entry (see BlobStore.store)"""
+        self._file.close()
+        return self.store.commit(self.tmp_path, self._sha256.hexdigest(), self.size)
+
+    def abort(self):
+        """Discard the written data"""
+        self._file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # No-op after a commit, which already moved the file away
+        self.abort()
@@ -0,0 +1,190 @@
+import os
+import uuid
+import hashlib
+
+from ingest import InvalidUpload, PdfStreamCheck
+
+
+# Default size of the chunks clients are asked to send (bytes)
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class ChunkedUploads:
+    """
+    Resumable uploads of large PDFs, sent in chunks.
+
+    init() preallocates a partial file in the blob store's tmp folder,
+    write_chunk() writes each chunk in place at its offset and records the
+    received byte range in the registry, and finalize() verifies the whole
+    file (completeness, optional SHA-256, PDF header and trailer) before it
+    becomes a blob. A client whose connection drops asks for the missing
+    ranges and sends only those again. Chunks may arrive in any order and in
+    parallel, also through different worker processes.
+    """
+
+    IO_SIZE = 1024 * 1024  # 1MB
+
+    def __init__(self, registry, blobs, max_bytes=None):
+        """
+        Args:
+            registry: FileRegistry tracking the uploads
+            blobs: BlobStore that receives finished uploads
+            max_bytes: Largest accepted file (default: MAX_CHUNKED_UPLOAD_MB or 1024 MB)
+        """
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('MAX_CHUNKED_UPLOAD_MB', 1024)) * 1024 * 1024
+        self.registry = registry
+        self.blobs = blobs
+        self.max_bytes = max_bytes
+
+    def init(self, filename, size, sha256=None):
+        """
+        Start an upload of size bytes
+
+        Args:
+            filename: Name of the PDF
+            size: Total size in bytes
+            sha256: Optional hex SHA-256 of the whole file, checked at finalize
+
+        Returns:
+            Upload status (see status())
+        """
+        size = int(size)
+        if not filename or not filename.lower().endswith('.pdf'):
+            raise InvalidUpload("File must be a PDF")
+        if size <= 0:
+            raise InvalidUpload("Upload size must be positive")
+        if size > self.max_bytes:
+            raise InvalidUpload(f"File is too large (limit {self.max_bytes // (1024 * 1024)} MB)")
+
+        upload_id = str(uuid.uuid4())
+        filepath = os.path.join(self.blobs.tmp_folder, f"upload_{upload_id}.part")
+
+        # Preallocate, so chunks can be written in place in any order
+        with open(filepath, 'wb') as f:
+            f.truncate(size)
+
+        upload = self.registry.create_upload(upload_id, filepath, filename, size,
+                                             sha256.lower() if sha256 else None)
+        return self.status(upload)
+
+    def write_chunk(self, upload_id, offset, stream, length, sha256=None):
+        """
+        Write one chunk at offset, streaming it from stream
+
+        Args:
+            offset: Position of the chunk in the file
+            stream: Readable stream with the chunk data (e.g. the request body)
+            length: Number of bytes in the chunk
+            sha256: Optional hex SHA-256 of the chunk; a mismatch rejects the
+                chunk, which is then not recorded as received
+
+        Returns:
+            Upload status, or None if the upload is unknown
+        """
+        upload = self.registry.get_upload(upload_id)
+        if upload is None:
+            return None
+
+        offset = int(offset)
+        length = int(length)
+        if offset < 0 or length <= 0 or offset + length > upload['size']:
+            raise InvalidUpload(f"Chunk {offset}-{offset + length} is outside the file (size {upload['size']})")
+
+        digest = hashlib.sha256()
+        written = 0
+        with open(upload['filepath'], 'r+b') as f:
+            f.seek(offset)
+            while written < length:
+                data = stream.read(min(self.IO_SIZE, length - written))
+                if not data:
+                    break
+                digest.update(data)
+                f.write(data)
+                written += len(data)
+
+        if written != length:
+            raise InvalidUpload(f"Chunk ended after {written} of {length} bytes")
+        if sha256 and digest.hexdigest() != sha256.lower():
+            raise InvalidUpload("Chunk checksum mismatch")
+
+        return self.status(self.registry.add_upload_range(upload_id, offset, offset + length))
+
+    def get(self, upload_id):
+        """Upload status, or None if the upload is unknown"""
+        upload = self.registry.get_upload(upload_id)
+        return self.status(upload) if upload else None
+
+    @staticmethod
+    def status(upload):
+        """Public view of an upload: received and missing byte ranges ([start, end))"""
+        missing = []
+        position = 0
+        for start, end in upload['received']:
+            if start > position:
+                missing.append([position, start])
+            position = max(position, end)
+        if position < upload['size']:
+            missing.append([position, upload['size']])
+
+        return {
+            "upload_id": upload['id'],
+            "filename": upload['filename'],
+            "size": upload['size'],
+            "chunk_size": DEFAULT_CHUNK_SIZE,
+            "received": upload['received'],
+            "missing": missing,
+            "complete": not missing
+        }
+
+    def finalize(self, upload_id):
+        """
+        Verify a complete upload and move it into the blob store
+
+        Returns:
+            (filename, blob entry), or None if the upload is unknown
+
+        Raises:
+            InvalidUpload: Chunks are missing (the upload stays open), or the
+                file failed verification (the upload is discarded)
+        """
+        upload = self.registry.get_upload(upload_id)
+        if upload is None:
+            return None
+
+        missing = self.status(upload)['missing']
+        if missing:
+            raise InvalidUpload(f"Upload is incomplete, {len(missing)} byte ranges missing")
+
+        # Claim the upload, so a concurrent finalize cannot commit it twice
+        upload = self.registry.remove_upload(upload_id)
+        if upload is None:
+            return None
+
+        try:
+            check = PdfStreamCheck()
+            digest = hashlib.sha256()
+            with open(upload['filepath'], 'rb') as f:
+                for chunk in iter(lambda: f.read(self.IO_SIZE), b''):
+                    check.feed(chunk)
+                    digest.update(chunk)
+            check.finish()
+
+            if upload['sha256'] and digest.hexdigest() != upload['sha256']:
+                raise InvalidUpload("File checksum mismatch")
+
+            blob = self.blobs.commit(upload['filepath'], digest.hexdigest(), upload['size'])
+            return upload['filename'], blob
+        finally:
+            if os.path.exists(upload['filepath']):
+                os.remove(upload['filepath'])
+
+    def abort(self, upload_id):
+        """Discard an upload; returns False if it is unknown"""
+        upload = self.registry.remove_upload(upload_id)
+        if upload is None:
+            return False
+
+        if os.path.exists(upload['filepath']):
+            os.remove(upload['filepath'])
+        return True
@@ -0,0 +1,77 @@
+import os
+import json
+import hashlib
+import threading
+
+
+class CompressionCache:
+    """
+    Cache of compression results, shared by all worker processes.
+
+    A result is keyed by the digest of the input, the compression settings
+    and the versions of the engines that may produce it, so a key never goes
+    stale. The compressed file is a blob in the blob store; a hit hands out
+    another reference to the same blob, so repeating a compression costs
+    neither time nor disk space. Entries live in the registry and hold a
+    blob reference of their own; the least recently used ones are dropped
+    once the cached blobs grow past the size limit.
+    """
+
+    def __init__(self, registry, max_bytes=None):
+        """
+        Args:
+            registry: FileRegistry holding the entries and blob references
+            max_bytes: Maximum size of the cached results in bytes (default:
+                COMPRESS_CACHE_MB or 512 MB)
+        """
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('COMPRESS_CACHE_MB', 512)) * 1024 * 1024
+        self.registry = registry
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    @staticmethod
+    def key(digest, settings, engine_version):
+        """Build the cache key of compressing the content digest with settings"""
+        parts = [digest, json.dumps(settings, sort_keys=True), engine_version]
+        return hashlib.sha256('|'.join(parts).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        Look up a result; on a hit the caller owns a new reference to its blob
+
+        Returns:
+            {digest, filepath, size, info}, or None on a miss
+        """
+        result = self.registry.get_cached_result(key)
+
+        if result is not None and not os.path.exists(result['filepath']):
+            # Blob deleted behind the registry's back; forget the entry
+            self.registry.release_blob(result['digest'])
+            self.registry.remove_cached_result(key)
+            result = None
+
+        with self._lock:
+            self._stats['hits' if result is not None else 'misses'] += 1
+        return result
+
+    def put(self, key, blob, info):
+        """Cache the result stored as blob, with its info (sizes, ratios, reports)"""
+        self.registry.put_cached_result(key, blob['digest'], blob['size'], info)
+
+        evicted = self.registry.evict_cached_results(self.max_bytes)
+        if evicted:
+            with self._lock:
+                self._stats['evictions'] += evicted
+
+    def stats(self):
+        """Hit/miss counters of this process and the size of the shared cache"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(self.registry.cached_results_usage())
+
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,180 @@
+import os
+import threading
+from io import BytesIO
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import fitz  # PyMuPDF
+from pypdf import PdfReader
+
+
+class _Entry:
+    """Cached bytes of one file plus the documents parsed from them"""
+
+    def __init__(self, mtime, data):
+        self.mtime = mtime
+        self.data = data
+        self.docs = {}
+        self.lock = threading.Lock()
+
+    @property
+    def weight(self):
+        # Rough estimate: the raw bytes plus about as much again per parsed engine
+        return len(self.data) * (1 + len(self.docs))
+
+
+class DocumentCache:
+    """
+    Bounded LRU cache of parsed documents, keyed by file_id.
+
+    The frontend fires several operations in a row on the same file (every
+    slider change is a new preview), and each one used to read and parse the
+    file again. Entries remember the file's mtime and are reloaded when it
+    changes. The cache is per process and bounded both by entry count and by
+    an estimate of the memory held; files too large to fit are opened from
+    disk on every use and never held.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        """
+        Args:
+            max_entries: Maximum number of cached files (default: DOC_CACHE_ENTRIES or 32)
+            max_bytes: Maximum estimated memory in bytes (default: DOC_CACHE_MB or 256 MB)
+        """
+        if max_entries is None:
+            max_entries = int(os.environ.get('DOC_CACHE_ENTRIES', 32))
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('DOC_CACHE_MB', 256)) * 1024 * 1024
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0, "uncached": 0}
+
+    def _entry(self, file_id, filepath):
+        """Get the up-to-date entry for a file, loading it on a miss (None if it is too large to cache)"""
+        file_stat = os.stat(filepath)
+        mtime = file_stat.st_mtime_ns
+
+        with self._lock:
+            entry = self._entries.get(file_id)
+            if entry is not None and entry.mtime == mtime:
+                self._entries.move_to_end(file_id)
+                self._stats['hits'] += 1
+                return entry
+
+            if entry is not None:
+                self._drop(file_id)
+                self._stats['invalidations'] += 1
+
+            # The bytes plus one parsed document would not fit the budget
+            if file_stat.st_size * 2 > self.max_bytes:
+                self._stats['uncached'] += 1
+                return None
+            self._stats['misses'] += 1
+
+        with open(filepath, 'rb') as f:
+            entry = _Entry(mtime, f.read())
+
+        with self._lock:
+            self._store(file_id, entry)
+        return entry
+
+    def _store(self, file_id, entry):
+        if file_id in self._entries:
+            self._drop(file_id)
+        self._entries[file_id] = entry
+        self._bytes += entry.weight
+        self._evict()
+
+    def _drop(self, file_id):
+        entry = self._entries.pop(file_id)
+        self._bytes -= entry.weight
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            self._drop(next(iter(self._entries)))
+            self._stats['evictions'] += 1
+
+    @staticmethod
+    def _open(data, engine):
+        if engine == 'fitz':
+            return fitz.open(stream=data, filetype='pdf')
+        if engine == 'pypdf':
+            return PdfReader(BytesIO(data))
+        raise Exception(f"Unknown PDF engine: {engine}")
+
+    @staticmethod
+    def _open_file(filepath, engine):
+        if engine == 'fitz':
+            return fitz.open(filepath)
+        if engine == 'pypdf':
+            return PdfReader(filepath)
+        raise Exception(f"Unknown PDF engine: {engine}")
+
+    @contextmanager
+    def borrow(self, file_id, filepath, engine='fitz'):
+        """
+        Use the shared parsed document of a file, read-only
+
+        The document is locked for the duration of the block, so everything
+        that reads from it (including writing a PdfWriter that copied its
+        pages) must happen inside the block. Never modify it; use checkout()
+        for that.
+        """
+        entry = self._entry(file_id, filepath)
+        if entry is None:
+            doc = self._open_file(filepath, engine)
+            try:
+                yield doc
+            finally:
+                if engine == 'fitz':
+                    doc.close()
+            return
+
+        with entry.lock:
+            doc = entry.docs.get(engine)
+            if doc is None:
+                doc = self._open(entry.data, engine)
+                with self._lock:
+                    # Account for the parsed document if the entry is still cached
+                    if self._entries.get(file_id) is entry:
+                        self._bytes -= entry.weight
+                        entry.docs[engine] = doc
+                        self._bytes += entry.weight
+                        self._evict()
+                    else:
+                        entry.docs[engine] = doc
+
+            yield doc
+
+    def checkout(self, file_id, filepath, engine='fitz'):
+        """
+        Get a private document, parsed from the cached bytes, that may be modified
+
+        The caller owns the copy (and closes it, for PyMuPDF documents).
+        """
+        entry = self._entry(file_id, filepath)
+        if entry is None:
+            return self._open_file(filepath, engine)
+        return self._open(entry.data, engine)
+
+    def invalidate(self, file_id):
+        """Forget a file (e.g. after it was removed)"""
+        with self._lock:
+            if file_id in self._entries:
+                self._drop(file_id)
+                self._stats['invalidations'] += 1
+
+    def stats(self):
+        """Hit/miss counters and current size of the cache"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
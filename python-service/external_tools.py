@@ -0,0 +1,182 @@
+import os
+import time
+import fcntl
+import signal
+import shutil
+import resource
+import tempfile
+import threading
+import subprocess
+
+
+class ToolError(Exception):
+    """Raised when an external tool fails, times out or cannot be run"""
+
+
+class ToolUnavailable(ToolError):
+    """Raised without starting anything when the startup probe did not find the tool"""
+
+
+class ToolTimeout(ToolError):
+    """Raised after a tool ran past its time limit and was killed"""
+
+
+class ExternalTools:
+    """
+    Bounded executor for external command-line tools (Ghostscript, qpdf).
+
+    Every tool is probed once when the executor is created; running a tool
+    that is missing fails at once instead of spawning a process per request.
+    At most max_concurrent tools run at a time across all worker processes
+    (one lock file per slot, held with flock for the life of the process).
+    Each process gets an address-space and CPU-time limit, is killed with
+    its whole process group when it runs past its wall-clock timeout, and
+    only the tail of its stderr is kept for error messages.
+    """
+
+    # Bytes of stderr kept for error messages
+    STDERR_TAIL = 4096
+
+    def __init__(self, slot_folder, tools=('gs', 'qpdf'), max_concurrent=None, timeout=None, memory_mb=None):
+        """
+        Args:
+            slot_folder: Folder of the slot lock files, shared by all workers
+            tools: Names of the tools to probe
+            max_concurrent: Tools running at once (default: TOOL_WORKERS or the CPU count)
+            timeout: Default wall-clock limit per run in seconds (default: TOOL_TIMEOUT or 300)
+            memory_mb: Address-space limit per process in MB (default: TOOL_MEMORY_MB or 2048)
+        """
+        if max_concurrent is None:
+            max_concurrent = int(os.environ.get('TOOL_WORKERS', os.cpu_count() or 2))
+        if timeout is None:
+            timeout = float(os.environ.get('TOOL_TIMEOUT', 300))
+        if memory_mb is None:
+            memory_mb = int(os.environ.get('TOOL_MEMORY_MB', 2048))
+
+        self.slot_folder = slot_folder
+        self.max_concurrent = max(1, max_concurrent)
+        self.timeout = timeout
+        self.memory_bytes = memory_mb * 1024 * 1024
+        os.makedirs(slot_folder, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._stats = {"runs": 0, "failures": 0, "timeouts": 0, "unavailable": 0}
+
+        self.versions = {tool: self._probe(tool) for tool in tools}
+
+    def _probe(self, tool):
+        """Version line of an installed tool, or None if it is missing or broken"""
+        path = shutil.which(tool)
+        if path is None:
+            return None
+
+        try:
+            result = subprocess.run([path, '--version'], capture_output=True, timeout=10, check=True)
+            return result.stdout.decode('utf-8', 'replace').strip().splitlines()[0]
+        except (OSError, subprocess.SubprocessError, IndexError):
+            return None
+
+    def available(self, tool):
+        return self.versions.get(tool) is not None
+
+    def version(self, tool):
+        return self.versions.get(tool)
+
+    def _acquire_slot(self, deadline):
+        """Wait for a free slot until deadline, return its open (locked) lock file"""
+        while True:
+            for index in range(self.max_concurrent):
+                lock_file = open(os.path.join(self.slot_folder, f"slot_{index}.lock"), 'a')
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return lock_file
+                except OSError:
+                    lock_file.close()
+
+            if time.monotonic() >= deadline:
+                raise ToolTimeout("Timed out waiting for a free tool slot")
+            time.sleep(0.05)
+
+    def _limit_resources(self, pid):
+        """
+        Apply the memory and CPU limits to a started tool
+
+        Set from the parent right after the spawn; a preexec_fn would run
+        Python between fork and exec, which can deadlock while other server
+        threads hold locks.
+        """
+        cpu_seconds = max(1, int(self.timeout))
+        try:
+            resource.prlimit(pid, resource.RLIMIT_AS, (self.memory_bytes, self.memory_bytes))
+            resource.prlimit(pid, resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 5))
+        except ProcessLookupError:
+            # Already exited; its status is collected as usual
+            pass
+
+    def run(self, tool, args, timeout=None):
+        """
+        Run a tool with arguments, waiting for a free slot first
+
+        Args:
+            tool: Name of a probed tool
+            args: Arguments (without the tool itself)
+            timeout: Wall-clock limit in seconds for waiting plus running
+                (default: the executor's timeout)
+
+        Raises:
+            ToolUnavailable: The tool is not installed
+            ToolTimeout: No slot became free, or the tool ran too long
+            ToolError: The tool exited with an error
+        """
+        if not self.available(tool):
+            self._count('unavailable')
+            raise ToolUnavailable(f"{tool} is not installed")
+
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.monotonic() + timeout
+
+        slot = self._acquire_slot(deadline)
+        try:
+            with tempfile.TemporaryFile() as stderr:
+                process = subprocess.Popen([shutil.which(tool)] + list(args),
+                                           stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=stderr,
+                                           start_new_session=True)
+                self._limit_resources(process.pid)
+                try:
+                    returncode = process.wait(timeout=max(0.0, deadline - time.monotonic()))
+                except subprocess.TimeoutExpired:
+                    # Kill the whole group, in case the tool started children
+                    os.killpg(process.pid, signal.SIGKILL)
+                    process.wait()
+                    self._count('timeouts')
+                    raise ToolTimeout(f"{tool} ran longer than {timeout:g}s and was killed")
+
+                self._count('runs')
+                if returncode != 0:
+                    self._count('failures')
+                    stderr.seek(max(0, stderr.seek(0, os.SEEK_END) - self.STDERR_TAIL))
+                    message = stderr.read().decode('utf-8', 'replace').strip()
+                    if returncode < 0:
+                        reason = f"was killed by {signal.Signals(-returncode).name}"
+                    else:
+                        reason = f"exited with status {returncode}"
+                    raise ToolError(f"{tool} {reason}: {message}" if message else f"{tool} {reason}")
+        finally:
+            slot.close()
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        """Probed versions, limits and run counters of this process"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update({
+            "versions": dict(self.versions),
+            "max_concurrent": self.max_concurrent,
+            "timeout": self.timeout,
+            "memory_mb": self.memory_bytes // (1024 * 1024)
+        })
+        return stats
@@ -0,0 +1,658 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from pdf_index import remove_index
+
+
+# Default lifetimes for stored artifacts (seconds)
+DEFAULT_TTL = 24 * 3600
+PREVIEW_TTL = 3600
+
+
+class FileRegistry:
+    """
+    Shared registry of every stored file, backed by SQLite in WAL mode.
+
+    One registry replaces the per-process dictionaries that used to hold file
+    metadata. Each process (and each thread) gets its own connection, so
+    several workers can serve requests against the same database file and a
+    restart keeps every registered file.
+    """
+
+    SCHEMA = [
+        """
+        CREATE TABLE IF NOT EXISTS files (
+            id TEXT PRIMARY KEY,
+            filepath TEXT,
+            zip_id TEXT,
+            parent_id TEXT,
+            created_at REAL NOT NULL,
+            expires_at REAL,
+            info TEXT NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_files_zip_id ON files(zip_id)",
+        "CREATE INDEX IF NOT EXISTS idx_files_parent_id ON files(parent_id)",
+        "CREATE INDEX IF NOT EXISTS idx_files_expires_at ON files(expires_at)",
+        "CREATE INDEX IF NOT EXISTS idx_files_filepath ON files(filepath)",
+        """
+        CREATE TABLE IF NOT EXISTS zips (
+            zip_id TEXT PRIMARY KEY,
+            filepath TEXT,
+            filename TEXT NOT NULL,
+            member_ids TEXT NOT NULL,
+            size INTEGER,
+            parent_id TEXT,
+            created_at REAL NOT NULL,
+            expires_at REAL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_zips_expires_at ON zips(expires_at)",
+        "CREATE INDEX IF NOT EXISTS idx_zips_filepath ON zips(filepath)",
+        """
+        CREATE TABLE IF NOT EXISTS blobs (
+            digest TEXT PRIMARY KEY,
+            filepath TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            info TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            operation TEXT NOT NULL,
+            status TEXT NOT NULL,
+            done INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            result TEXT,
+            error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            expires_at REAL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_jobs_expires_at ON jobs(expires_at)",
+        """
+        CREATE TABLE IF NOT EXISTS uploads (
+            id TEXT PRIMARY KEY,
+            filepath TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            sha256 TEXT,
+            received TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_uploads_expires_at ON uploads(expires_at)",
+        """
+        CREATE TABLE IF NOT EXISTS result_cache (
+            key TEXT PRIMARY KEY,
+            digest TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            info TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            used_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_result_cache_used_at ON result_cache(used_at)",
+    ]
+
+    def __init__(self, db_path):
+        """Open (or create) the registry database at db_path"""
+        self.db_path = db_path
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+
+        with self._transaction() as conn:
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+
+    def _connect(self):
+        """Return the connection for the current thread and process"""
+        conn = getattr(self._local, 'conn', None)
+
+        # Connections must never cross a fork, so key them by pid as well
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Run a block inside a write transaction
+
+        Blob files released by the block are deleted only once it has
+        committed, so a rollback never leaves an entry without its file.
+        """
+        conn = self._connect()
+        released = self._local.released = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+            self._delete_blob_files(released)
+
+    @staticmethod
+    def _row_to_info(row):
+        if row is None:
+            return None
+        return json.loads(row['info'])
+
+    def register(self, info, parent_id=None, ttl=None, blob_ref=None):
+        """
+        Store file info under info['id'] and return it
+
+        blob_ref, a (digest, filepath, size) tuple, adds a reference to that
+        blob in the same transaction, so the entry and its reference are
+        only ever stored together.
+        """
+        now = time.time()
+        if ttl is None:
+            ttl = PREVIEW_TTL if info.get('preview') else DEFAULT_TTL
+
+        with self._transaction() as conn:
+            if blob_ref is not None:
+                digest, filepath, size = blob_ref
+                conn.execute(
+                    "INSERT INTO blobs (digest, filepath, size, refcount, created_at) VALUES (?, ?, ?, 1, ?) "
+                    "ON CONFLICT(digest) DO UPDATE SET refcount = refcount + 1",
+                    (digest, filepath, size, now)
+                )
+            conn.execute(
+                "INSERT OR REPLACE INTO files (id, filepath, zip_id, parent_id, created_at, expires_at, info) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (info['id'], info.get('filepath'), info.get('zip_id'), parent_id,
+                 now, now + ttl, json.dumps(info))
+            )
+
+        return info
+
+    def restore_blob_entry(self, info, size, ttl=None):
+        """
+        Bring back an expired entry of a blob file, with a new reference to its blob
+
+        The check and both inserts run in one transaction, so concurrent
+        callers restore the entry (and take the reference) exactly once.
+
+        Returns:
+            True if the entry was restored, False if it already existed
+        """
+        now = time.time()
+        if ttl is None:
+            ttl = DEFAULT_TTL
+
+        with self._transaction() as conn:
+            if conn.execute("SELECT 1 FROM files WHERE id = ?", (info['id'],)).fetchone() is not None:
+                return False
+
+            conn.execute(
+                "INSERT INTO blobs (digest, filepath, size, refcount, created_at) VALUES (?, ?, ?, 1, ?) "
+                "ON CONFLICT(digest) DO UPDATE SET refcount = refcount + 1",
+                (info['digest'], info['filepath'], size, now)
+            )
+            conn.execute(
+                "INSERT INTO files (id, filepath, zip_id, parent_id, created_at, expires_at, info) "
+                "VALUES (?, ?, ?, NULL, ?, ?, ?)",
+                (info['id'], info.get('filepath'), info.get('zip_id'), now, now + ttl, json.dumps(info))
+            )
+
+        return True
+
+    def get(self, file_id):
+        """Get file info by ID, or None if the file is unknown"""
+        row = self._connect().execute(
+            "SELECT info FROM files WHERE id = ?", (file_id,)
+        ).fetchone()
+        return self._row_to_info(row)
+
+    def __contains__(self, file_id):
+        row = self._connect().execute(
+            "SELECT 1 FROM files WHERE id = ?", (file_id,)
+        ).fetchone()
+        return row is not None
+
+    def update(self, file_id, **fields):
+        """Merge fields into an existing entry and return the updated info"""
+        with self._transaction() as conn:
+            row = conn.execute("SELECT info FROM files WHERE id = ?", (file_id,)).fetchone()
+            if row is None:
+                return None
+
+            info = json.loads(row['info'])
+            info.update(fields)
+            conn.execute(
+                "UPDATE files SET filepath = ?, zip_id = ?, info = ? WHERE id = ?",
+                (info.get('filepath'), info.get('zip_id'), json.dumps(info), file_id)
+            )
+
+        return info
+
+    def remove(self, file_id):
+        """Remove an entry and return its info (None if it did not exist)"""
+        with self._transaction() as conn:
+            row = conn.execute("SELECT info FROM files WHERE id = ?", (file_id,)).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
+
+        return self._row_to_info(row)
+
+    def references_file(self, filepath):
+        """Check whether a file or ZIP entry points at filepath"""
+        conn = self._connect()
+        if conn.execute("SELECT 1 FROM files WHERE filepath = ? LIMIT 1", (filepath,)).fetchone() is not None:
+            return True
+        return conn.execute("SELECT 1 FROM zips WHERE filepath = ? LIMIT 1", (filepath,)).fetchone() is not None
+
+    def find_by_zip(self, zip_id):
+        """Get all entries belonging to a ZIP archive"""
+        rows = self._connect().execute(
+            "SELECT info FROM files WHERE zip_id = ? ORDER BY created_at", (zip_id,)
+        ).fetchall()
+        return [self._row_to_info(row) for row in rows]
+
+    def children(self, parent_id):
+        """Get all entries derived from parent_id"""
+        rows = self._connect().execute(
+            "SELECT info FROM files WHERE parent_id = ? ORDER BY created_at", (parent_id,)
+        ).fetchall()
+        return [self._row_to_info(row) for row in rows]
+
+    def register_zip(self, zip_id, filepath, filename, member_ids, parent_id=None, ttl=None):
+        """Record a ZIP archive in the manifest index and return its entry"""
+        now = time.time()
+        if ttl is None:
+            ttl = DEFAULT_TTL
+
+        size = None
+        if filepath and os.path.exists(filepath):
+            size = os.path.getsize(filepath)
+
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO zips (zip_id, filepath, filename, member_ids, size, parent_id, created_at, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (zip_id, filepath, filename, json.dumps(list(member_ids)), size, parent_id, now, now + ttl)
+            )
+
+        return self.get_zip(zip_id)
+
+    def get_zip(self, zip_id):
+        """Get a ZIP manifest entry by ID, or None if it is unknown"""
+        row = self._connect().execute(
+            "SELECT zip_id, filepath, filename, member_ids, size, created_at FROM zips WHERE zip_id = ?",
+            (zip_id,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        return {
+            "id": row['zip_id'],
+            "filepath": row['filepath'],
+            "filename": row['filename'],
+            "member_ids": json.loads(row['member_ids']),
+            "size": row['size'],
+            "created_at": row['created_at'],
+            "type": "application/zip"
+        }
+
+    def add_blob_ref(self, digest, filepath, size):
+        """Add a reference to a content blob, creating its entry if needed"""
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO blobs (digest, filepath, size, refcount, created_at) VALUES (?, ?, ?, 1, ?) "
+                "ON CONFLICT(digest) DO UPDATE SET refcount = refcount + 1",
+                (digest, filepath, size, time.time())
+            )
+
+        return self.get_blob(digest)
+
+    def get_blob(self, digest):
+        """Get a blob entry by digest, or None if it is unknown"""
+        row = self._connect().execute(
+            "SELECT digest, filepath, size, refcount, info FROM blobs WHERE digest = ?", (digest,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        return {
+            "digest": row['digest'],
+            "filepath": row['filepath'],
+            "size": row['size'],
+            "refcount": row['refcount'],
+            "info": json.loads(row['info']) if row['info'] else None
+        }
+
+    def set_blob_info(self, digest, info):
+        """Attach parsed information (page count etc.) to a blob"""
+        with self._transaction() as conn:
+            conn.execute("UPDATE blobs SET info = ? WHERE digest = ?", (json.dumps(info), digest))
+
+    def release_blob(self, digest):
+        """Drop one blob reference (e.g. of an upload that was rejected after storing)"""
+        with self._transaction() as conn:
+            self._release_blob(conn, digest)
+
+    def _release_blob(self, conn, digest):
+        """Drop one blob reference inside a transaction, deleting the blob at zero"""
+        conn.execute("UPDATE blobs SET refcount = refcount - 1 WHERE digest = ?", (digest,))
+        row = conn.execute(
+            "SELECT filepath FROM blobs WHERE digest = ? AND refcount <= 0", (digest,)
+        ).fetchone()
+        if row is None:
+            return
+
+        # The file goes once the transaction has committed
+        conn.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+        self._local.released.append((digest, row['filepath']))
+
+    def _delete_blob_files(self, released):
+        """Delete the files of committed blob releases"""
+        for digest, filepath in released:
+            # Check and delete under the write lock, so a concurrent upload of
+            # the same content either re-created the entry first (and the file
+            # stays) or finds the file gone afterwards and links it back
+            with self._transaction() as conn:
+                if conn.execute("SELECT 1 FROM blobs WHERE digest = ?", (digest,)).fetchone() is not None:
+                    continue
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+                remove_index(filepath)
+
+    def expire_files(self, now, limit):
+        """
+        Remove up to limit file entries whose expiry has passed
+
+        Blob references are released (and unreferenced blobs deleted) in the
+        same transaction. Returns the removed entries; files that are not
+        blobs are left on disk for the caller to delete.
+        """
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT id, info FROM files WHERE expires_at <= ? ORDER BY expires_at LIMIT ?",
+                (now, limit)
+            ).fetchall()
+
+            expired = []
+            for row in rows:
+                info = json.loads(row['info'])
+                conn.execute("DELETE FROM files WHERE id = ?", (row['id'],))
+                if info.get('digest'):
+                    self._release_blob(conn, info['digest'])
+
+                # Files stored as a recipe keep their source blob alive
+                if info.get('source_digest'):
+                    self._release_blob(conn, info['source_digest'])
+                expired.append(info)
+
+        return expired
+
+    def expire_zips(self, now, limit):
+        """Remove up to limit expired zip manifest entries and return them"""
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT zip_id, filepath FROM zips WHERE expires_at <= ? ORDER BY expires_at LIMIT ?",
+                (now, limit)
+            ).fetchall()
+            for row in rows:
+                conn.execute("DELETE FROM zips WHERE zip_id = ?", (row['zip_id'],))
+
+        return [{"id": row['zip_id'], "filepath": row['filepath']} for row in rows]
+
+    def create_job(self, job_id, operation, ttl=None):
+        """Create a queued job entry and return it"""
+        now = time.time()
+        if ttl is None:
+            ttl = DEFAULT_TTL
+
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, operation, status, created_at, updated_at, expires_at) "
+                "VALUES (?, ?, 'queued', ?, ?, ?)",
+                (job_id, operation, now, now, now + ttl)
+            )
+
+        return self.get_job(job_id)
+
+    def get_job(self, job_id):
+        """Get a job by ID, or None if it is unknown"""
+        row = self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+
+        return {
+            "id": row['id'],
+            "operation": row['operation'],
+            "status": row['status'],
+            "progress": {"done": row['done'], "total": row['total']},
+            "result": json.loads(row['result']) if row['result'] else None,
+            "error": row['error'],
+            "created_at": row['created_at'],
+            "updated_at": row['updated_at']
+        }
+
+    def update_job(self, job_id, status=None, done=None, total=None, result=None, error=None):
+        """
+        Update a job and return its current status
+
+        A cancelled job stays cancelled: later updates from the worker are
+        ignored, which is how running workers notice the cancellation.
+        """
+        fields = {"updated_at": time.time()}
+        if status is not None:
+            fields['status'] = status
+        if done is not None:
+            fields['done'] = done
+        if total is not None:
+            fields['total'] = total
+        if result is not None:
+            fields['result'] = json.dumps(result)
+        if error is not None:
+            fields['error'] = error
+
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._transaction() as conn:
+            conn.execute(
+                f"UPDATE jobs SET {assignments} WHERE id = ? AND status != 'cancelled'",
+                list(fields.values()) + [job_id]
+            )
+            row = conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+        return row['status'] if row else None
+
+    def cancel_job(self, job_id):
+        """Mark a queued or running job as cancelled and return it"""
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'cancelled', updated_at = ? "
+                "WHERE id = ? AND status IN ('queued', 'running')",
+                (time.time(), job_id)
+            )
+
+        return self.get_job(job_id)
+
+    def expire_jobs(self, now, limit):
+        """Remove up to limit expired job entries and return how many went"""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "DELETE FROM jobs WHERE id IN "
+                "(SELECT id FROM jobs WHERE expires_at <= ? ORDER BY expires_at LIMIT ?)",
+                (now, limit)
+            )
+
+        return cursor.rowcount
+
+    @staticmethod
+    def _row_to_upload(row):
+        if row is None:
+            return None
+        upload = dict(row)
+        upload['received'] = json.loads(upload['received'])
+        return upload
+
+    def create_upload(self, upload_id, filepath, filename, size, sha256=None, ttl=None):
+        """Record a new chunked upload and return it"""
+        now = time.time()
+        if ttl is None:
+            ttl = DEFAULT_TTL
+
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO uploads (id, filepath, filename, size, sha256, received, created_at, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, '[]', ?, ?)",
+                (upload_id, filepath, filename, size, sha256, now, now + ttl)
+            )
+
+        return self.get_upload(upload_id)
+
+    def get_upload(self, upload_id):
+        """Get a chunked upload by ID, or None if it is unknown"""
+        row = self._connect().execute("SELECT * FROM uploads WHERE id = ?", (upload_id,)).fetchone()
+        return self._row_to_upload(row)
+
+    def add_upload_range(self, upload_id, start, end, ttl=None):
+        """
+        Mark bytes [start, end) of an upload as received and return the upload
+
+        Ranges are kept sorted and merged. Every chunk extends the expiry, so
+        only uploads that stopped making progress expire.
+        """
+        if ttl is None:
+            ttl = DEFAULT_TTL
+
+        with self._transaction() as conn:
+            row = conn.execute("SELECT received FROM uploads WHERE id = ?", (upload_id,)).fetchone()
+            if row is None:
+                return None
+
+            merged = []
+            for range_start, range_end in sorted(json.loads(row['received']) + [[start, end]]):
+                if merged and range_start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], range_end)
+                else:
+                    merged.append([range_start, range_end])
+
+            conn.execute(
+                "UPDATE uploads SET received = ?, expires_at = ? WHERE id = ?",
+                (json.dumps(merged), time.time() + ttl, upload_id)
+            )
+
+        return self.get_upload(upload_id)
+
+    def remove_upload(self, upload_id):
+        """Remove a chunked upload entry and return it (None if it did not exist)"""
+        with self._transaction() as conn:
+            row = conn.execute("SELECT * FROM uploads WHERE id = ?", (upload_id,)).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM uploads WHERE id = ?", (upload_id,))
+
+        return self._row_to_upload(row)
+
+    def expire_uploads(self, now, limit):
+        """Remove up to limit abandoned chunked uploads and return them"""
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT * FROM uploads WHERE expires_at <= ? ORDER BY expires_at LIMIT ?",
+                (now, limit)
+            ).fetchall()
+            for row in rows:
+                conn.execute("DELETE FROM uploads WHERE id = ?", (row['id'],))
+
+        return [self._row_to_upload(row) for row in rows]
+
+    def get_cached_result(self, key):
+        """
+        Look up a cached operation result and take a reference to its blob
+
+        The caller owns the new blob reference (e.g. for a file entry it
+        registers) and must release it if it does not use it.
+
+        Returns:
+            {key, digest, filepath, size, info}, or None on a miss
+        """
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT c.key, c.digest, c.size, c.info, b.filepath FROM result_cache c "
+                "JOIN blobs b ON b.digest = c.digest WHERE c.key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            conn.execute("UPDATE blobs SET refcount = refcount + 1 WHERE digest = ?", (row['digest'],))
+            conn.execute("UPDATE result_cache SET used_at = ? WHERE key = ?", (time.time(), key))
+
+        result = dict(row)
+        result['info'] = json.loads(result['info'])
+        return result
+
+    def put_cached_result(self, key, digest, size, info):
+        """Cache an operation result stored as a blob; the entry holds its own blob reference"""
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO result_cache (key, digest, size, info, created_at, used_at) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO NOTHING",
+                (key, digest, size, json.dumps(info), now, now)
+            )
+            if cursor.rowcount:
+                conn.execute("UPDATE blobs SET refcount = refcount + 1 WHERE digest = ?", (digest,))
+
+        return bool(cursor.rowcount)
+
+    def remove_cached_result(self, key):
+        """Drop a cached result and its blob reference"""
+        with self._transaction() as conn:
+            row = conn.execute("SELECT digest FROM result_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM result_cache WHERE key = ?", (key,))
+                self._release_blob(conn, row['digest'])
+
+    def evict_cached_results(self, max_bytes):
+        """
+        Drop least recently used cached results until they total at most 90%
+        of max_bytes, if they are above max_bytes
+
+        Returns:
+            Number of evicted results
+        """
+        with self._transaction() as conn:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM result_cache").fetchone()[0]
+            if total <= max_bytes:
+                return 0
+
+            evicted = 0
+            target = max_bytes * 0.9
+            for row in conn.execute("SELECT key, digest, size FROM result_cache ORDER BY used_at").fetchall():
+                if total <= target:
+                    break
+                conn.execute("DELETE FROM result_cache WHERE key = ?", (row['key'],))
+                self._release_blob(conn, row['digest'])
+                total -= row['size']
+                evicted += 1
+
+        return evicted
+
+    def cached_results_usage(self):
+        """Number and total size of cached results"""
+        row = self._connect().execute(
+            "SELECT COUNT(*) AS entries, COALESCE(SUM(size), 0) AS bytes FROM result_cache"
+        ).fetchone()
+        return {"entries": row['entries'], "bytes": row['bytes']}
@@ -0,0 +1,35 @@
+# Gunicorn configuration for the production PDF service
+import os
+import multiprocessing
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+
+# PDF work is CPU-bound, so default to one worker process per core
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+
+# The app sizes its per-process job pools by the number of workers
+os.environ['GUNICORN_WORKERS'] = str(workers)
+threads = int(os.environ.get('GUNICORN_THREADS', '2'))
+worker_class = 'gthread' if threads > 1 else 'sync'
+
+# Import the app once in the master and fork workers from it
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+# Large renders and compressions can take a while
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '300'))
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers now and then to cap memory growth from MuPDF
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', '1000'))
+max_requests_jitter = 100
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
+
+
+def post_fork(server, worker):
+    # Every worker competes for the janitor lock; only one actually cleans up
+    from app import start_janitor
+    start_janitor()
@@ -0,0 +1,308 @@
+import io
+import math
+import zlib
+
+import fitz
+from PIL import Image
+
+from process_pools import imap_bounded
+
+
+# Bumped whenever a change makes the same settings produce different output
+ENGINE_VERSION = 1
+
+# Images smaller than this are left alone; re-encoding them saves next to nothing
+MIN_IMAGE_BYTES = 4 * 1024
+
+# Images are never scaled below this many pixels on their shorter side
+MIN_IMAGE_SIDE = 16
+
+# (JPEG quality, DPI) steps of the target-size search, mildest first
+TARGET_LADDER = (
+    (85, 300),
+    (75, 200),
+    (65, 150),
+    (50, 120),
+    (40, 100),
+    (30, 72),
+    (25, 60),
+    (20, 50)
+)
+
+# Number of (largest) images encoded to estimate the size a step produces
+SAMPLE_SIZE = 8
+
+
+def collect_images(doc):
+    """
+    Find the unique images of a PyMuPDF document in one pass over its pages
+
+    An image drawn on many pages (a logo, a letterhead) is listed once, with
+    the pages it appears on and the largest size it is displayed at.
+
+    Returns:
+        {xref: {width, height, bpc, filter, length, pages, display}} where
+        display is the largest (width, height) in points the image is drawn
+        at, or None if it is never drawn
+    """
+    images = {}
+
+    for page in doc:
+        for item in page.get_images(full=True):
+            xref = item[0]
+            if xref in images:
+                images[xref]['pages'].append(page.number + 1)
+                continue
+
+            images[xref] = {
+                'xref': xref,
+                'width': item[2],
+                'height': item[3],
+                'bpc': item[4],
+                'filter': item[8],
+                'length': len(doc.xref_stream_raw(xref) or b''),
+                'pages': [page.number + 1],
+                'display': None
+            }
+
+        # Displayed size from the placement matrix, so rotated images measure correctly
+        for placement in page.get_image_info(xrefs=True):
+            image = images.get(placement.get('xref'))
+            if image is None:
+                continue
+
+            a, b, c, d = placement['transform'][:4]
+            shown = (math.hypot(a, b), math.hypot(c, d))
+            if image['display'] is None:
+                image['display'] = shown
+            else:
+                image['display'] = (max(image['display'][0], shown[0]), max(image['display'][1], shown[1]))
+
+    return images
+
+
+def _is_recompressible(doc, image):
+    """Whether an image can become a JPEG without changing how it looks"""
+    xref = image['xref']
+
+    # Stencil masks and 1-bit images are tiny already and would only get blurry
+    if image['bpc'] == 1 or doc.xref_get_key(xref, 'ImageMask')[1] == 'true':
+        return False
+
+    # Colour-key masks match exact colours, which a lossy encoding does not keep
+    if doc.xref_get_key(xref, 'Mask')[0] == 'array':
+        return False
+
+    return image['length'] >= MIN_IMAGE_BYTES
+
+
+def plan_image(image, dpi):
+    """
+    Decide the target size of an image: scaled down to dpi at the largest
+    size it is displayed at, never up
+
+    Returns:
+        (width, height) in pixels
+    """
+    width, height = image['width'], image['height']
+    if image['display'] is None or not dpi:
+        return width, height
+
+    display_width, display_height = image['display']
+    if display_width <= 0 or display_height <= 0:
+        return width, height
+
+    scale = min(1.0, dpi * display_width / 72 / width, dpi * display_height / 72 / height)
+    if scale >= 0.95:
+        # Not worth a resample
+        return width, height
+
+    scale = max(scale, MIN_IMAGE_SIDE / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _encode_image(doc, xref, size, quality):
+    """Decode an image and encode it as a JPEG of size, return (data, grayscale)"""
+    pixmap = fitz.Pixmap(doc, xref)
+
+    # Soft masks stay separate objects; only the colour channels are re-encoded
+    if pixmap.alpha:
+        pixmap = fitz.Pixmap(pixmap, 0)
+    if pixmap.colorspace is None or pixmap.colorspace.n not in (1, 3):
+        pixmap = fitz.Pixmap(fitz.csRGB, pixmap)
+
+    grayscale = pixmap.colorspace.n == 1
+    image = Image.frombytes('L' if grayscale else 'RGB', (pixmap.width, pixmap.height), pixmap.samples)
+    if image.size != size:
+        image = image.resize(size, Image.LANCZOS)
+
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=quality, optimize=True)
+    return output.getvalue(), grayscale
+
+
+def recompress_image_chunk(pdf_path, jobs, quality):
+    """
+    Re-encode a chunk of images in a worker process with its own document handle
+
+    Args:
+        jobs: (xref, (width, height), original length) tuples
+
+    Returns:
+        (xref, JPEG data, grayscale) for each image that got smaller, and
+        (xref, None, error message) for each that failed
+    """
+    doc = fitz.open(pdf_path)
+    try:
+        return [result for result in (_recompress(doc, job, quality) for job in jobs) if result]
+    finally:
+        doc.close()
+
+
+def _recompress(doc, job, quality):
+    xref, size, length = job
+    try:
+        data, grayscale = _encode_image(doc, xref, size, quality)
+    except Exception as e:
+        return xref, None, str(e)
+
+    if len(data) >= length:
+        return None
+    return xref, data, grayscale
+
+
+def _write_image(doc, xref, data, size, grayscale):
+    """Replace the stream of an image object with JPEG data, keeping its mask and other keys"""
+    doc.update_stream(xref, data, compress=False)
+    doc.xref_set_key(xref, 'Filter', '/DCTDecode')
+    doc.xref_set_key(xref, 'Width', str(size[0]))
+    doc.xref_set_key(xref, 'Height', str(size[1]))
+    doc.xref_set_key(xref, 'BitsPerComponent', '8')
+    doc.xref_set_key(xref, 'ColorSpace', '/DeviceGray' if grayscale else '/DeviceRGB')
+
+    # The decoded samples were already mapped through these
+    doc.xref_set_key(xref, 'DecodeParms', 'null')
+    doc.xref_set_key(xref, 'Decode', 'null')
+
+
+def deflate_savings(doc, skip=(), xrefs=None):
+    """
+    Bytes that saving with deflate would take off the uncompressed streams
+    not in skip, looking only at xrefs if given
+    """
+    if xrefs is None:
+        xrefs = range(1, doc.xref_length())
+
+    saved = 0
+    for xref in xrefs:
+        if xref in skip or not doc.xref_is_stream(xref) or doc.xref_get_key(xref, 'Filter')[0] != 'null':
+            continue
+        raw = doc.xref_stream_raw(xref) or b''
+        saved += max(0, len(raw) - len(zlib.compress(raw, 1)))
+    return saved
+
+
+def estimate_size(doc, images, quality, dpi, file_size, sample_size=SAMPLE_SIZE):
+    """
+    Predict the file size after recompress_images, from a sample of images
+
+    The largest images are encoded at quality and dpi; the ratio of their
+    sizes before and after is applied to all recompressible images, and
+    everything else is assumed to keep its size.
+
+    Args:
+        images: Result of collect_images(doc)
+        file_size: Size of the file in bytes without its images re-encoded
+            (e.g. less deflate_savings)
+
+    Returns:
+        Estimated size in bytes
+    """
+    candidates = sorted((image for image in images.values() if _is_recompressible(doc, image)),
+                        key=lambda image: image['length'], reverse=True)
+    image_bytes = sum(image['length'] for image in candidates)
+    if not image_bytes:
+        return file_size
+
+    before = after = 0
+    for image in candidates[:sample_size]:
+        result = _recompress(doc, (image['xref'], plan_image(image, dpi), image['length']), quality)
+        before += image['length']
+        after += len(result[1]) if result and result[1] else image['length']
+
+    return round(file_size - image_bytes * (1 - after / before))
+
+
+def recompress_images(doc, pdf_path, quality, dpi, pool=None, workers=1, images=None):
+    """
+    Downsample and re-encode the images of a document as JPEG, in place
+
+    Each unique image is decoded once, scaled down to dpi at the largest
+    size it is displayed at, encoded at quality and written back into its
+    own object, so every page using it, its soft mask and its other keys
+    stay as they are. Images that would not get smaller are left untouched.
+
+    Args:
+        doc: Open PyMuPDF document of pdf_path, updated in place
+        pdf_path: Path of the document, opened by the worker processes
+        quality: JPEG quality (1-95)
+        dpi: Target resolution, None to keep the pixel size
+        pool: Optional process pool encoding chunks of images in parallel
+        workers: Number of chunks to keep in the pool at a time
+        images: Result of collect_images for this file, if known already
+
+    Returns:
+        Report of every image considered: xref, pages, original and new size
+        in pixels and bytes, bytes saved, and skipped or error if unchanged
+    """
+    if images is None:
+        images = collect_images(doc)
+
+    report = []
+    jobs = []
+    for xref, image in sorted(images.items()):
+        entry = {
+            'xref': xref,
+            'pages': image['pages'],
+            'filter': image['filter'],
+            'width': image['width'],
+            'height': image['height'],
+            'original_bytes': image['length'],
+            'new_bytes': image['length'],
+            'saved': 0
+        }
+        report.append(entry)
+
+        if not _is_recompressible(doc, image):
+            entry['skipped'] = 'not recompressible'
+            continue
+
+        size = plan_image(image, dpi)
+        entry['new_width'], entry['new_height'] = size
+        jobs.append((xref, size, image['length']))
+
+    if pool is not None and workers > 1 and len(jobs) > 1:
+        chunk_size = max(1, -(-len(jobs) // (workers * 4)))
+        chunks = [(pdf_path, jobs[start:start + chunk_size], quality) for start in range(0, len(jobs), chunk_size)]
+        results = [result for chunk in imap_bounded(pool, recompress_image_chunk, chunks, workers) for result in chunk]
+    else:
+        results = [result for result in (_recompress(doc, job, quality) for job in jobs) if result]
+
+    sizes = {xref: size for xref, size, _ in jobs}
+    entries = {entry['xref']: entry for entry in report}
+    for xref, data, detail in results:
+        entry = entries[xref]
+        if data is None:
+            entry['error'] = detail
+            continue
+
+        _write_image(doc, xref, data, sizes[xref], detail)
+        entry['new_bytes'] = len(data)
+        entry['saved'] = entry['original_bytes'] - len(data)
+
+    for entry in report:
+        if 'new_width' in entry and not entry['saved'] and 'error' not in entry:
+            entry['skipped'] = 'no smaller encoding'
+            del entry['new_width'], entry['new_height']
+
+    return report
@@ -0,0 +1,121 @@
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.sansio.multipart import MultipartDecoder, File, Data, Epilogue, NEED_DATA
+
+
+# PDF readers accept the header anywhere in the first 1 KB, and the %%EOF
+# marker anywhere in the last 1 KB
+PDF_HEADER = b'%PDF-'
+PDF_EOF = b'%%EOF'
+SCAN_WINDOW = 1024
+
+# Size of the pieces read from the request body
+CHUNK_SIZE = 64 * 1024
+
+
+class InvalidUpload(Exception):
+    """Raised when an upload is rejected before it is stored"""
+
+
+class PdfStreamCheck:
+    """
+    Structural sanity check of a PDF that arrives in chunks
+
+    Only the first and the last kilobyte are kept, so the check costs no
+    memory whatever the size of the file. The header is checked as soon as
+    the first kilobyte has arrived, so a non-PDF is rejected right away.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._head = b''
+        self._tail = b''
+
+    def feed(self, chunk):
+        self.size += len(chunk)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            raise RequestEntityTooLarge()
+
+        if len(self._head) < SCAN_WINDOW:
+            self._head += chunk[:SCAN_WINDOW - len(self._head)]
+            if len(self._head) == SCAN_WINDOW and PDF_HEADER not in self._head:
+                raise InvalidUpload("File is not a PDF (no %PDF- header)")
+
+        self._tail = (self._tail + chunk)[-SCAN_WINDOW:]
+
+    def finish(self):
+        if PDF_HEADER not in self._head:
+            raise InvalidUpload("File is not a PDF (no %PDF- header)")
+        if PDF_EOF not in self._tail:
+            raise InvalidUpload("PDF is incomplete (no %%EOF trailer)")
+
+
+def ingest_pdf_upload(stream, boundary, blobs, field='pdf', max_bytes=None):
+    """
+    Stream the PDF part of a multipart request body straight into the blob store
+
+    The body is read in fixed-size chunks and the file part is hashed and
+    written as it arrives, without werkzeug spooling the whole request
+    first. Invalid or oversize files are rejected while they stream.
+
+    Args:
+        stream: Request body stream (already limited to MAX_CONTENT_LENGTH)
+        boundary: Multipart boundary (bytes)
+        blobs: BlobStore to write into
+        field: Name of the form field holding the PDF
+        max_bytes: Maximum size of the PDF itself
+
+    Returns:
+        (filename, blob entry)
+    """
+    decoder = MultipartDecoder(boundary, max_form_memory_size=4 * CHUNK_SIZE)
+    filename = None
+    blob = None
+    writer = None
+    check = None
+    in_file = False
+    body_done = False
+
+    try:
+        while True:
+            event = decoder.next_event()
+
+            if event is NEED_DATA:
+                if body_done:
+                    # Body ended before the closing boundary
+                    break
+                chunk = stream.read(CHUNK_SIZE)
+                body_done = not chunk
+                decoder.receive_data(chunk or None)
+                continue
+
+            if isinstance(event, File):
+                in_file = event.name == field and blob is None and writer is None
+                if in_file:
+                    filename = event.filename
+                    if not filename:
+                        raise InvalidUpload("No file selected")
+                    if not filename.lower().endswith('.pdf'):
+                        raise InvalidUpload("File must be a PDF")
+                    writer = blobs.open_writer()
+                    check = PdfStreamCheck(max_bytes)
+
+            elif isinstance(event, Data) and in_file:
+                check.feed(event.data)
+                writer.write(event.data)
+
+                if not event.more_data:
+                    check.finish()
+                    blob = writer.commit()
+                    writer = None
+                    in_file = False
+
+            elif isinstance(event, Epilogue):
+                break
+    finally:
+        if writer is not None:
+            writer.abort()
+
+    if blob is None:
+        raise InvalidUpload("No file provided")
+    return filename, blob
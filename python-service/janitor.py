@@ -0,0 +1,229 @@
+import os
+import re
+import time
+import fcntl
+import threading
+
+from pdf_index import remove_index
+
+
+# Names of operation outputs in the upload folder: <uuid>_<filename> files
+# and images_<id>_<run> folders
+OUTPUT_FILE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}_')
+OUTPUT_FOLDER_PREFIX = 'images_'
+INDEX_SUFFIX = '.index.json'
+
+
+class Janitor:
+    """
+    Incremental cleanup of expired files.
+
+    Every few seconds the janitor asks the registry for a small batch of
+    entries whose expiry has passed (an indexed query) and deletes them, so
+    regular cleanup needs no directory walks and no full registry scans.
+
+    Outputs that never got a registry entry (the worker crashed or was
+    killed between writing and registering) are invisible to that query.
+    An hourly pass over the top of the upload folder removes those once
+    they are older than orphan_age; anything younger may still be in the
+    middle of being written.
+    """
+
+    def __init__(self, registry, upload_folder, blobs=None, interval=5, batch_size=100,
+                 orphan_age=24 * 3600):
+        """
+        Args:
+            registry: FileRegistry holding the expiry index
+            upload_folder: Root upload folder (never removed)
+            blobs: Optional BlobStore whose partial uploads are purged too
+            interval: Seconds between cleanup passes
+            batch_size: Maximum number of entries removed per pass
+            orphan_age: Seconds after which an output without a registry
+                entry is removed
+        """
+        self.registry = registry
+        self.upload_folder = os.path.abspath(upload_folder)
+        self.blobs = blobs
+        self.interval = interval
+        self.batch_size = batch_size
+        self.orphan_age = orphan_age
+        self._last_tmp_purge = 0
+        self._last_orphan_sweep = 0
+        self._thread = None
+
+    def run_once(self, now=None):
+        """Remove one batch of expired files and archives, return how many were removed"""
+        if now is None:
+            now = time.time()
+
+        removed = 0
+        for info in self.registry.expire_files(now, self.batch_size):
+            # Blobs are deleted by the registry once their last reference goes
+            if not info.get('digest'):
+                self._remove_file(info.get('filepath'))
+            removed += 1
+
+        for zip_info in self.registry.expire_zips(now, self.batch_size):
+            self._remove_file(zip_info.get('filepath'))
+            removed += 1
+
+        removed += self.registry.expire_jobs(now, self.batch_size)
+
+        # Chunked uploads that stopped receiving chunks (their partial files
+        # live in the blob store's tmp folder, which must stay in place)
+        for upload in self.registry.expire_uploads(now, self.batch_size):
+            try:
+                os.remove(upload['filepath'])
+            except FileNotFoundError:
+                pass
+            removed += 1
+
+        # Partial uploads are rare, so an hourly pass over the tmp folder is enough
+        if self.blobs is not None and now - self._last_tmp_purge > 3600:
+            self.blobs.purge_tmp(24 * 3600)
+            self._last_tmp_purge = now
+
+        if now - self._last_orphan_sweep > 3600:
+            swept = self.remove_orphans(now)
+            removed += swept
+            # A full batch means there may be more; look again on the next pass
+            if swept < self.batch_size:
+                self._last_orphan_sweep = now
+
+        return removed
+
+    def remove_orphans(self, now=None):
+        """
+        Remove up to batch_size old outputs that no registry entry points at
+
+        Only the top of the upload folder and the images_* folders are
+        looked at; the blob store, caches and the registry itself are left
+        alone. Returns how many files were removed.
+        """
+        if now is None:
+            now = time.time()
+
+        removed = 0
+        for folder, names in self._output_candidates():
+            # Index sidecars belong to the file with the same stem
+            stems = {os.path.splitext(name)[0] for name in names if not name.endswith(INDEX_SUFFIX)}
+
+            for name in names:
+                if removed >= self.batch_size:
+                    return removed
+
+                filepath = os.path.join(folder, name)
+                try:
+                    if now - os.path.getmtime(filepath) <= self.orphan_age:
+                        continue
+                except OSError:
+                    continue
+
+                if name.endswith(INDEX_SUFFIX):
+                    if name[:-len(INDEX_SUFFIX)] in stems:
+                        continue
+                    try:
+                        os.remove(filepath)
+                    except OSError:
+                        pass
+                    continue
+
+                if self.registry.references_file(filepath):
+                    continue
+
+                self._remove_file(filepath)
+                removed += 1
+
+            if folder != self.upload_folder:
+                self._remove_empty_folder(folder, now)
+
+        return removed
+
+    def _output_candidates(self):
+        """(folder, output names) for the upload folder and each images_* folder"""
+        files = []
+        folders = []
+        with os.scandir(self.upload_folder) as entries:
+            for entry in entries:
+                if entry.name.startswith(OUTPUT_FOLDER_PREFIX) and entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                elif OUTPUT_FILE.match(entry.name) and entry.is_file(follow_symlinks=False):
+                    files.append(entry.name)
+
+        yield self.upload_folder, files
+        for folder in folders:
+            try:
+                yield folder, os.listdir(folder)
+            except OSError:
+                continue
+
+    def _remove_empty_folder(self, folder, now):
+        """Remove an old, empty per-operation folder (a fresh one may be about to fill)"""
+        try:
+            if not os.listdir(folder) and now - os.path.getmtime(folder) > self.orphan_age:
+                os.rmdir(folder)
+        except OSError:
+            pass
+
+    def _remove_file(self, filepath):
+        if not filepath or not os.path.exists(filepath):
+            return
+
+        try:
+            os.remove(filepath)
+            remove_index(filepath)
+            print(f"Removed expired file: {filepath}")
+
+            # Drop per-operation folders (e.g. images_<id>) once they are empty
+            folder = os.path.dirname(os.path.abspath(filepath))
+            if folder != self.upload_folder and not os.listdir(folder):
+                os.rmdir(folder)
+        except Exception as e:
+            print(f"Error removing file {filepath}: {str(e)}")
+
+    def _acquire_leadership(self, lock_path):
+        """Try to become the only janitor for this upload folder"""
+        lock_file = open(lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+
+        # The lock is held for as long as this file stays open
+        return lock_file
+
+    def run_forever(self, lock_path=None):
+        lock_file = None
+        while True:
+            # With several worker processes only the lock holder cleans up;
+            # the others keep polling so one takes over if the leader dies
+            if lock_path and lock_file is None:
+                lock_file = self._acquire_leadership(lock_path)
+                if lock_file is None:
+                    time.sleep(self.interval)
+                    continue
+
+            removed = 0
+            try:
+                removed = self.run_once()
+            except Exception as e:
+                print(f"Error during cleanup: {str(e)}")
+
+            # Catch up quickly (but still in small steps) after a busy period
+            time.sleep(0.1 if removed >= self.batch_size else self.interval)
+
+    def start(self, lock_path=None):
+        """
+        Start the janitor in a daemon thread
+
+        Args:
+            lock_path: Optional lock file shared by all processes; when given,
+                exactly one process at a time performs the cleanup
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return self._thread
+
+        self._thread = threading.Thread(target=self.run_forever, args=(lock_path,), daemon=True)
+        self._thread.start()
+        return self._thread
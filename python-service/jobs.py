@@ -0,0 +1,162 @@
+import os
+import uuid
+from concurrent.futures.process import BrokenProcessPool
+
+from process_pools import get_pool, replace_pool
+
+
+class JobCancelled(BaseException):
+    """
+    Raised inside a worker when its job has been cancelled.
+
+    Derives from BaseException so the generic `except Exception` fallbacks in
+    PdfOperations do not swallow it and retry with another engine.
+    """
+
+
+# PdfOperations instance of the current pool worker process
+_worker_ops = None
+
+
+def _get_worker_ops(upload_folder):
+    global _worker_ops
+    if _worker_ops is None:
+        from pdf_operations import PdfOperations
+
+        # Render serially: a render pool started inside a pool worker would
+        # block the worker's exit (and gunicorn's recycling) joining its children
+        _worker_ops = PdfOperations(upload_folder, render_workers_max=1)
+    return _worker_ops
+
+
+def _public_info(file_info):
+    """File info without internal paths, as returned by the HTTP API"""
+    info = file_info.copy()
+    info.pop('filepath', None)
+    info.pop('zip_path', None)
+    return info
+
+
+def _run_job(job_id, upload_folder, operation, params):
+    """Execute one job inside a pool worker process"""
+    ops = _get_worker_ops(upload_folder)
+    registry = ops.registry
+
+    # The job may have been cancelled while it was waiting in the queue
+    if registry.update_job(job_id, status='running') != 'running':
+        return
+
+    def progress(done, total):
+        if registry.update_job(job_id, done=done, total=total) == 'cancelled':
+            raise JobCancelled()
+
+    try:
+        if operation == 'compress':
+            files = [ops.compress_pdf(params['file_id'], params.get('compression_level', 'medium'),
+                                      progress=progress, target_bytes=params.get('target_bytes'),
+                                      optimize=params.get('optimize', False))]
+        elif operation == 'optimize':
+            files = [ops.optimize_pdf(params['file_id'], params.get('subset_fonts', True), progress=progress)]
+        elif operation == 'pdf-to-image':
+            files = ops.convert_pdf_to_images(params['file_id'], params.get('format', 'png'),
+                                              params.get('dpi', 300), params.get('pages'),
+                                              params.get('create_zip', True), progress=progress,
+                                              workers=params.get('workers'))
+        elif operation == 'split':
+            files = ops.split_pdf(params['file_id'], params['split_method'], params.get('ranges'),
+                                  params.get('pages'), params.get('create_zip', True), progress=progress)
+        elif operation == 'merge' and 'inputs' in params:
+            files = [ops.merge_stored(params['inputs'], params.get('output_filename'), progress=progress,
+                                      optimize=params.get('optimize', False))]
+        elif operation == 'merge':
+            files = [ops.merge_pdf_paths(params['paths'], params.get('output_filename'), progress=progress,
+                                         optimize=params.get('optimize', False))]
+        else:
+            raise Exception(f"Unknown operation: {operation}")
+
+        result = {"files": [_public_info(file_info) for file_info in files]}
+        zip_ids = {file_info['zip_id'] for file_info in files if file_info.get('zip_id')}
+        if zip_ids:
+            result['zip_id'] = zip_ids.pop()
+            result['zip_url'] = f"/download-zip/{result['zip_id']}"
+
+        registry.update_job(job_id, status='done', result=result)
+
+    except JobCancelled:
+        print(f"Job {job_id} cancelled")
+    except Exception as e:
+        registry.update_job(job_id, status='failed', error=str(e))
+
+
+class JobManager:
+    """
+    Runs long operations (compress, optimize, pdf-to-image, split, merge) in the background.
+
+    Jobs execute on a bounded process pool that calls the regular
+    PdfOperations methods. Job state lives in the shared registry, so any
+    server process can report status for, or cancel, any job.
+
+    Every server process (gunicorn worker) has its own pool, so the job
+    processes of the whole service number GUNICORN_WORKERS x JOB_WORKERS.
+    By default JOB_WORKERS splits half the CPUs between the server processes.
+    """
+
+    OPERATIONS = ('compress', 'optimize', 'pdf-to-image', 'split', 'merge')
+
+    def __init__(self, registry, upload_folder, max_workers=None):
+        """Initialize the manager (the pool itself starts on first submit)"""
+        self.registry = registry
+        self.upload_folder = upload_folder
+        if max_workers is None:
+            servers = int(os.environ.get('GUNICORN_WORKERS', 1))
+            max_workers = int(os.environ.get('JOB_WORKERS', max(1, (os.cpu_count() or 2) // 2 // servers)))
+        self.max_workers = max_workers
+        self._futures = {}
+
+    def submit(self, operation, params):
+        """Queue an operation and return the new job"""
+        if operation not in self.OPERATIONS:
+            raise Exception(f"Unsupported job operation: {operation}")
+
+        job_id = str(uuid.uuid4())
+        job = self.registry.create_job(job_id, operation)
+
+        try:
+            pool = get_pool('jobs', self.max_workers)
+            try:
+                future = pool.submit(_run_job, job_id, self.upload_folder, operation, params)
+            except BrokenProcessPool:
+                # A worker died since the last job; start over with a fresh pool
+                future = replace_pool('jobs', self.max_workers, pool).submit(
+                    _run_job, job_id, self.upload_folder, operation, params)
+        except Exception as e:
+            # The job never reached a worker, so nothing else would finish its row
+            self.registry.update_job(job_id, status='failed', error=str(e))
+            raise
+
+        self._futures[job_id] = future
+        future.add_done_callback(lambda done: self._on_done(job_id, done))
+
+        return job
+
+    def _on_done(self, job_id, future):
+        self._futures.pop(job_id, None)
+
+        # A worker that died (e.g. killed for memory) never reports back itself
+        if not future.cancelled() and future.exception() is not None:
+            self.registry.update_job(job_id, status='failed', error=str(future.exception()))
+
+    def get(self, job_id):
+        """Get job status, progress and result"""
+        return self.registry.get_job(job_id)
+
+    def cancel(self, job_id):
+        """Cancel a job; running jobs stop at their next progress report"""
+        job = self.registry.cancel_job(job_id)
+
+        # Drop it from the queue if this process submitted it and it has not started
+        future = self._futures.get(job_id)
+        if future is not None:
+            future.cancel()
+
+        return job
@@ -0,0 +1,248 @@
+import re
+import time
+
+from image_compress import estimate_size, deflate_savings
+
+
+# Bump when the layout of the analysis changes; older cached analyses are redone
+ANALYSIS_VERSION = 1
+
+# Number of (largest) images encoded to predict the size of each compression level
+ANALYSIS_SAMPLE_SIZE = 3
+
+# Pixel-count buckets of the image breakdown: (label, upper bound in megapixels)
+RESOLUTION_BUCKETS = (
+    ('under 0.5 MP', 0.5),
+    ('0.5-2 MP', 2),
+    ('2-8 MP', 8),
+    ('over 8 MP', None)
+)
+
+# Font file keys of a font descriptor and the font format they hold
+FONT_FILE_KEYS = {'FontFile': 'Type1', 'FontFile2': 'TrueType', 'FontFile3': 'Type1C/OpenType'}
+
+REFERENCE = re.compile(rb'(\d+) \d+ R')
+SUBSET_PREFIX = re.compile(r'^[A-Z]{6}\+')
+LENGTH = re.compile(rb'/Length\s+(\d+)(\s+\d+\s+R)?')
+FILTER_NAME = re.compile(r'/([^\s/\[\]]+)')
+
+
+def _int_key(doc, xref, key):
+    """Integer value of a key, following an indirect reference (0 if missing)"""
+    kind, value = doc.xref_get_key(xref, key)
+    if kind == 'xref':
+        value = doc.xref_object(int(value.split()[0]), compressed=True)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _stream_length(doc, xref, source):
+    """Length of a stream as stored, read from its dictionary text when it is a direct number"""
+    match = LENGTH.search(source)
+    if match and not match.group(2):
+        return int(match.group(1))
+    return _int_key(doc, xref, 'Length')
+
+
+def _name_key(doc, xref, key):
+    """Name value of a key without its slash, or the raw value (None if missing)"""
+    kind, value = doc.xref_get_key(xref, key)
+    if kind == 'null':
+        return None
+    return value[1:] if kind == 'name' else value
+
+
+def _bucket(totals, name, size):
+    entry = totals.setdefault(name, {"count": 0, "bytes": 0})
+    entry['count'] += 1
+    entry['bytes'] += size
+
+
+def _resolution_bucket(width, height):
+    megapixels = width * height / 1e6
+    for label, limit in RESOLUTION_BUCKETS:
+        if limit is None or megapixels < limit:
+            return label
+
+
+def _reachable(trailer, references):
+    """Object numbers reachable from the trailer through references"""
+    seen = set()
+    pending = [int(number) for number in REFERENCE.findall(trailer)]
+    while pending:
+        xref = pending.pop()
+        if xref in seen:
+            continue
+        seen.add(xref)
+        pending.extend(number for number in references.get(xref, ()) if number not in seen)
+    return seen
+
+
+def _locate_images(doc, images):
+    """Fill in the displayed size of a few images, parsing only the first page each is drawn on"""
+    wanted = {xref for xref, image in images.items() if image['display'] is None}
+    for page_number in range(len(doc)):
+        if not wanted:
+            break
+
+        found = wanted & {item[0] for item in doc.get_page_images(page_number)}
+        if not found:
+            continue
+
+        for placement in doc[page_number].get_image_info(xrefs=True):
+            if placement.get('xref') in found:
+                a, b, c, d = placement['transform'][:4]
+                images[placement['xref']]['display'] = ((a * a + b * b) ** 0.5, (c * c + d * d) ** 0.5)
+        wanted -= found
+
+
+def analyze_pdf(doc, file_size, levels):
+    """
+    Break the size of a PDF down by what the bytes are used for
+
+    The xref table is walked once, reading object dictionaries and stream
+    lengths but no stream data, so the cost grows with the number of
+    objects rather than the file size. Only a few of the largest images are
+    decoded, to predict what each compression level would save.
+
+    Args:
+        doc: Open PyMuPDF document
+        file_size: Size of the file in bytes
+        levels: {level name: {'image_quality', 'dpi'}} to predict
+
+    Returns:
+        Totals (count and bytes) of images (by filter and by resolution),
+        embedded fonts (with subset status), content streams, metadata,
+        unused objects and everything else, plus predicted sizes per level
+    """
+    started = time.time()
+
+    images = {}
+    fonts = []
+    font_files = {}
+    contents = set()
+    metadata = set()
+    structure = set()
+    sizes = {}
+    references = {}
+
+    streams = set()
+    unfiltered = []
+
+    for xref in range(1, doc.xref_length()):
+        try:
+            source = doc.xref_object(xref, compressed=True).encode('latin-1', 'replace')
+        except Exception:
+            continue
+
+        size = len(source)
+        if doc.xref_is_stream(xref):
+            size += _stream_length(doc, xref, source)
+            streams.add(xref)
+            if b'/Filter' not in source:
+                unfiltered.append(xref)
+        sizes[xref] = size
+        references[xref] = [int(number) for number in REFERENCE.findall(source)]
+
+        # Test the text first; keys are only parsed for objects that may match
+        if b'/Image' in source and _name_key(doc, xref, 'Subtype') == 'Image':
+            images[xref] = {
+                'xref': xref,
+                'width': _int_key(doc, xref, 'Width'),
+                'height': _int_key(doc, xref, 'Height'),
+                'bpc': _int_key(doc, xref, 'BitsPerComponent'),
+                'filter': '+'.join(FILTER_NAME.findall(doc.xref_get_key(xref, 'Filter')[1])) or 'none',
+                'length': size - len(source),
+                'pages': [],
+                'display': None
+            }
+        elif b'/FontDescriptor' in source and _name_key(doc, xref, 'Type') == 'FontDescriptor':
+            for key, font_format in FONT_FILE_KEYS.items():
+                kind, value = doc.xref_get_key(xref, key)
+                if kind == 'xref':
+                    name = _name_key(doc, xref, 'FontName') or ''
+                    font_files[int(value.split()[0])] = len(fonts)
+                    fonts.append({"name": SUBSET_PREFIX.sub('', name), "format": font_format,
+                                  "subset": bool(SUBSET_PREFIX.match(name)), "bytes": 0})
+        elif b'/Page' in source and _name_key(doc, xref, 'Type') == 'Page':
+            kind, value = doc.xref_get_key(xref, 'Contents')
+            contents.update(int(number) for number in REFERENCE.findall(value.encode('latin-1', 'replace')))
+        elif b'/Form' in source and _name_key(doc, xref, 'Subtype') == 'Form':
+            contents.add(xref)
+        elif b'/Metadata' in source and _name_key(doc, xref, 'Type') == 'Metadata':
+            metadata.add(xref)
+        elif (b'/ObjStm' in source or b'/XRef' in source) and _name_key(doc, xref, 'Type') in ('ObjStm', 'XRef'):
+            structure.add(xref)
+
+    # A page's /Contents may point to an array object listing the streams
+    for xref in list(contents):
+        if xref not in streams:
+            contents.update(references.get(xref, ()))
+
+    trailer = doc.pdf_trailer(compressed=True).encode('latin-1', 'replace')
+    reachable = _reachable(trailer, references)
+    info = {int(number) for number in REFERENCE.findall(doc.xref_get_key(-1, 'Info')[1].encode('latin-1'))}
+    metadata.update(info)
+
+    result = {
+        "size": file_size,
+        "objects": len(sizes),
+        "images": {"count": 0, "bytes": 0, "by_filter": {}, "by_resolution": {}},
+        "fonts": {"count": 0, "bytes": 0, "subset_bytes": 0, "embedded": fonts},
+        "content_streams": {"count": 0, "bytes": 0},
+        "metadata": {"count": 0, "bytes": 0},
+        "unused": {"count": 0, "bytes": 0},
+        "other": {"count": 0, "bytes": 0}
+    }
+
+    unused = set()
+    for xref, size in sizes.items():
+        if xref not in reachable and xref not in structure:
+            unused.add(xref)
+            category = 'unused'
+        elif xref in images:
+            image = images[xref]
+            _bucket(result['images']['by_filter'], image['filter'], size)
+            _bucket(result['images']['by_resolution'], _resolution_bucket(image['width'], image['height']), size)
+            category = 'images'
+        elif xref in font_files:
+            fonts[font_files[xref]]['bytes'] += size
+            if fonts[font_files[xref]]['subset']:
+                result['fonts']['subset_bytes'] += size
+            category = 'fonts'
+        elif xref in contents:
+            category = 'content_streams'
+        elif xref in metadata:
+            category = 'metadata'
+        else:
+            category = 'other'
+
+        result[category]['count'] += 1
+        result[category]['bytes'] += size
+
+    fonts.sort(key=lambda font: font['bytes'], reverse=True)
+
+    # Every level drops unused objects and deflates uncompressed streams
+    base_size = file_size - result['unused']['bytes'] - deflate_savings(doc, skip=unused.union(images), xrefs=unfiltered)
+
+    # Decode only the largest used images, at the size they are displayed at
+    used_images = {xref: image for xref, image in images.items() if xref in reachable}
+    sample = dict(sorted(used_images.items(), key=lambda item: item[1]['length'], reverse=True)[:ANALYSIS_SAMPLE_SIZE])
+    _locate_images(doc, sample)
+
+    result['predictions'] = {}
+    for level, settings in levels.items():
+        predicted = estimate_size(doc, used_images, settings['image_quality'], settings['dpi'], base_size,
+                                  sample_size=ANALYSIS_SAMPLE_SIZE)
+        predicted = min(predicted, file_size)
+        result['predictions'][level] = {
+            "size": predicted,
+            "saving": file_size - predicted,
+            "ratio": 1 - predicted / file_size if file_size else 0.0
+        }
+
+    result['version'] = ANALYSIS_VERSION
+    result['analysis_time'] = round(time.time() - started, 3)
+    return result
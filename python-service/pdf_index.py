@@ -0,0 +1,75 @@
+import os
+import json
+import uuid
+
+
+# Bump when the layout of the index changes; older sidecars are rebuilt
+INDEX_VERSION = 1
+
+
+def index_path(pdf_path):
+    """Get the location of the structural index sidecar of a PDF"""
+    return os.path.splitext(pdf_path)[0] + '.index.json'
+
+
+def build_index(doc):
+    """
+    Build the structural index of an open PyMuPDF document
+
+    The index holds everything later requests want to know without parsing
+    the file again: per-page size, rotation and image/font xrefs, the
+    outline, metadata, and the encryption and linearization flags.
+    """
+    pages = []
+    if not doc.needs_pass:
+        for page in doc:
+            mediabox = page.mediabox
+            pages.append({
+                "width": round(mediabox.width, 2),
+                "height": round(mediabox.height, 2),
+                "rotation": page.rotation,
+                "images": sorted({image[0] for image in page.get_images(full=True)}),
+                "fonts": sorted({font[0] for font in page.get_fonts(full=True)})
+            })
+
+    metadata = {key: value for key, value in (doc.metadata or {}).items() if value}
+
+    return {
+        "version": INDEX_VERSION,
+        "page_count": len(doc),
+        "pages": pages,
+        "outline": doc.get_toc(simple=True) if not doc.needs_pass else [],
+        "metadata": metadata,
+        "encrypted": bool(doc.is_encrypted or doc.needs_pass),
+        "linearized": bool(getattr(doc, 'is_fast_webaccess', False))
+    }
+
+
+def write_index(pdf_path, index):
+    """Persist an index next to its PDF (atomically, so readers never see half a file)"""
+    path = index_path(pdf_path)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def read_index(pdf_path):
+    """Load the index of a PDF, or None if there is no current one"""
+    try:
+        with open(index_path(pdf_path)) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if index.get('version') != INDEX_VERSION:
+        return None
+    return index
+
+
+def remove_index(pdf_path):
+    """Delete the index sidecar of a PDF, if any"""
+    try:
+        os.remove(index_path(pdf_path))
+    except FileNotFoundError:
+        pass
@@ -1,12 +1,229 @@
-from pypdf import PdfReader, PdfWriter
+from pypdf import PdfReader, PdfWriter, __version__ as pypdf_version
 import os
 import uuid
-import zipfile
 import tempfile
 from werkzeug.utils import secure_filename
 from io import BytesIO
 import fitz  # PyMuPDF for additional PDF operations
 from PIL import Image  # For image to PDF conversion
+from file_registry import FileRegistry, PREVIEW_TTL
+from blob_store import BlobStore
+from janitor import Janitor
+from doc_cache import DocumentCache
+from thumb_cache import ThumbnailCache
+from compress_cache import CompressionCache
+from external_tools import ExternalTools, ToolUnavailable
+from zip_stream import zip_members_from_files
+from ingest import ingest_pdf_upload, InvalidUpload
+from chunked_uploads import ChunkedUploads
+from image_compress import recompress_images, collect_images, estimate_size, deflate_savings, TARGET_LADDER, \
+    ENGINE_VERSION as IMAGE_ENGINE_VERSION
+from pdf_index import build_index, read_index, write_index
+from pdf_analysis import analyze_pdf, ANALYSIS_VERSION
+from pdf_optimize import optimize_file, OPTIMIZE_VERSION
+from process_pools import get_pool, replace_pool, run_on_pool, imap_bounded
+import time
+import hashlib
+import fcntl
+import shutil
+import threading
+from collections import Counter
+from concurrent.futures.process import BrokenProcessPool
+
+
+def _render_page(doc, index, zoom, format, output_folder):
+    """Render one page (0-based index) to an image file, return (filename, filepath)"""
+    pixmap = doc[index].get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+
+    image_filename = f"page_{index+1}.{format}"
+    image_filepath = os.path.join(output_folder, image_filename)
+    pixmap.save(image_filepath)
+
+    return image_filename, image_filepath
+
+
+def _render_page_bytes(doc, index, zoom, format):
+    """Render one page (0-based index) to image bytes, return (filename, data)"""
+    pixmap = doc[index].get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    return f"page_{index+1}.{format}", pixmap.tobytes(format)
+
+
+def _render_page_chunk_bytes(pdf_path, page_indices, zoom, format):
+    """Render a chunk of pages to image bytes in a worker process"""
+    doc = fitz.open(pdf_path)
+    try:
+        return [_render_page_bytes(doc, index, zoom, format) for index in page_indices]
+    finally:
+        doc.close()
+
+
+def _render_page_chunk(pdf_path, page_indices, zoom, format, output_folder):
+    """Render a chunk of pages in a worker process with its own document handle"""
+    doc = fitz.open(pdf_path)
+    try:
+        return [(index,) + _render_page(doc, index, zoom, format, output_folder) for index in page_indices]
+    finally:
+        doc.close()
+
+
+# ioctl that makes a file share the extents of another (Linux reflink)
+FICLONE = 0x40049409
+
+
+def _clone_file(src, dst):
+    """Copy a file, as a reflink (no data copied) where the filesystem supports it"""
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            return
+        except OSError:
+            # Not supported here (e.g. ext4 or across filesystems)
+            pass
+
+    shutil.copyfile(src, dst)
+
+
+# Watermark text colors (RGB, 0-1) by name
+WATERMARK_COLORS = {
+    "gray": (0.5, 0.5, 0.5),
+    "red": (1, 0, 0),
+    "blue": (0, 0, 1),
+    "green": (0, 0.5, 0),
+    "black": (0, 0, 0)
+}
+
+
+def _page_numbers(pages):
+    """
+    1-indexed page numbers of a request (numbers or numeric strings), or
+    None for all pages
+
+    Raises ValueError for anything else, so a bad request fails at once
+    instead of when a deferred result is first rendered.
+    """
+    if pages is None:
+        return None
+    if not isinstance(pages, (list, tuple)):
+        raise ValueError("Pages must be a list of page numbers")
+
+    numbers = []
+    for page in pages:
+        try:
+            numbers.append(int(str(page).strip()))
+        except ValueError:
+            raise ValueError(f"Invalid page number: {page}")
+    return numbers
+
+
+def _number(value, name):
+    """A number from a request (numeric strings allowed), or ValueError naming the parameter"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be a number")
+
+
+def _rotate_pages(doc, pages, angle):
+    """Rotate pages (1-indexed, None for all) of a PyMuPDF document by angle, return the page count"""
+    total_pages = len(doc)
+
+    # Determine which pages to rotate
+    if pages is None or not pages:
+        selected = list(range(1, total_pages + 1))
+    else:
+        # Validate pages
+        selected = [p for p in pages if 1 <= p <= total_pages]
+
+    if not selected:
+        raise Exception("No valid pages to rotate")
+
+    for page_num in selected:
+        # PyMuPDF uses 0-based indexing and rotations of 0, 90, 180, 270
+        page = doc[page_num - 1]
+        page.set_rotation((page.rotation + angle) % 360)
+
+    return total_pages
+
+
+def _watermark_pages(doc, pages, text, opacity, color, size, angle):
+    """Stamp a centred, rotated text watermark on pages (1-indexed) of a PyMuPDF document"""
+    text_color = WATERMARK_COLORS.get(color, WATERMARK_COLORS['gray'])
+    text_width = fitz.get_text_length(text, fontsize=size)
+
+    for page_num in pages:
+        # Get the page (PyMuPDF uses 0-based indexing)
+        page = doc[page_num - 1]
+
+        # Centre the text on the page, then turn it around the centre
+        rect = page.rect
+        center = fitz.Point(rect.width / 2, rect.height / 2)
+        text_writer = fitz.TextWriter(rect, opacity=opacity, color=text_color)
+        text_writer.append((center.x - text_width / 2, center.y), text, fontsize=size)
+        text_writer.write_text(page, morph=(center, fitz.Matrix(angle)))
+
+
+def _mark_pages_for_removal(doc, pages):
+    """Highlight pages (1-indexed) of a PyMuPDF document in red, as a delete preview"""
+    for page_num in pages:
+        page = doc[page_num-1]  # 0-based index
+
+        # Get page dimensions
+        rect = page.rect
+
+        # Add a semi-transparent red overlay
+        page.draw_rect(rect, color=(1, 0, 0), fill=(1, 0, 0, 0.3), overlay=True)
+
+        # Add a "TO BE DELETED" watermark
+        font_size = 36
+        text = "TO BE DELETED"
+        # TextWriter.append() takes no color, the writer itself carries it
+        red_color = (1, 0, 0)  # RGB red
+        tw = fitz.TextWriter(rect, color=red_color)
+        tw.append((rect.width/2, rect.height/2), text, fontsize=font_size)
+
+        tw.write_text(page, opacity=0.8)
+
+
+# Image formats of page thumbnails and their MIME types
+THUMBNAIL_FORMATS = {'png': 'image/png', 'webp': 'image/webp'}
+
+
+def _page_runs(pages):
+    """Group 1-indexed page numbers into (first, last) runs of consecutive pages, keeping their order"""
+    runs = []
+    for page_num in pages:
+        if runs and page_num == runs[-1][1] + 1:
+            runs[-1][1] = page_num
+        else:
+            runs.append([page_num, page_num])
+    return [tuple(run) for run in runs]
+
+
+def _fitz_metadata(metadata):
+    """Metadata fields (title, author, subject, keywords) in PyMuPDF form, empty ones left out"""
+    return {key: metadata[key] for key in ('title', 'author', 'subject', 'keywords') if metadata.get(key)}
+
+
+# Image quality, target resolution and Ghostscript preset of each compression level
+COMPRESSION_SETTINGS = {
+    'low': {'image_quality': 80, 'dpi': 150, 'pdfsettings': '/prepress'},
+    'medium': {'image_quality': 50, 'dpi': 120, 'pdfsettings': '/ebook'},
+    'high': {'image_quality': 30, 'dpi': 72, 'pdfsettings': '/screen'}
+}
+
+# Keys of a compression result that describe the run that produced it, not the file
+COMPRESSION_RUN_KEYS = ('compression_time', 'attempts', 'passes')
+
+
+# Display names of the PDF engines, for error messages
+ENGINE_NAMES = {'pypdf': 'PyPDF', 'fitz': 'PyMuPDF'}
+
+
+class EngineUnavailable(Exception):
+    """Raised instead of parsing a file with an engine that the upload probe found cannot read it"""
+
 
 class PdfOperations:
     """
@@ -18,78 +235,571 @@ class PdfOperations:
     - Adding watermarks to PDFs
     - Converting images to PDF
     - Converting PDF to images
+    - Rendering cached page thumbnails
 
     - Compressing PDFs
     - Editing PDF metadata
+    - Chaining rotate, watermark, metadata and protect in a single pass
 
     """
 
-    def __init__(self, upload_folder):
-        """Initialize PDF operations with upload folder for temporary storage"""
+    # Operations run_pipeline can chain
+    PIPELINE_STEPS = ('rotate', 'watermark', 'metadata', 'protect')
+
+    def __init__(self, upload_folder, registry=None, render_workers_max=None):
+        """
+        Initialize PDF operations with upload folder for temporary storage
+
+        Args:
+            render_workers_max: Size of this process's render pool and the
+                most render workers one request may use (default:
+                RENDER_WORKERS_MAX or the CPU count, never more than the
+                CPU count; 1 renders everything serially)
+        """
         self.upload_folder = upload_folder
         os.makedirs(upload_folder, exist_ok=True)
-        self.pdf_storage = {}
+
+        cpus = os.cpu_count() or 1
+        if render_workers_max is None:
+            render_workers_max = int(os.environ.get('RENDER_WORKERS_MAX', cpus))
+        self.render_workers_max = max(1, min(render_workers_max, cpus))
+
+        # Shared file registry (one SQLite database per upload folder)
+        if registry is None:
+            registry = FileRegistry(os.path.join(upload_folder, 'registry.db'))
+        self.registry = registry
+
+        # Content-addressed store for uploads
+        self.blobs = BlobStore(os.path.join(upload_folder, 'blobs'), registry)
+
+        # Resumable uploads of large files, sent in chunks
+        self.uploads = ChunkedUploads(registry, self.blobs)
+
+        # Expiry-driven cleanup of stored files (started by the app)
+        self.janitor = Janitor(registry, upload_folder, self.blobs)
+
+        # Parsed documents reused across consecutive operations on a file
+        self.docs = DocumentCache()
+
+        # Rendered page thumbnails, shared by all workers
+        self.thumbnails = ThumbnailCache(os.path.join(upload_folder, 'thumbnails'))
+
+        # Compression results, reused for the same content and settings
+        self.compression_cache = CompressionCache(registry)
+
+        # Ghostscript and qpdf, probed once and run with limits
+        self.tools = ExternalTools(os.path.join(upload_folder, 'tool_slots'))
+
+        # How often each operation ran on each engine, skipped an engine or fell back
+        self.engine_stats = {}
+        self._engine_stats_lock = threading.Lock()
 
     def save_pdf(self, file):
         """Save uploaded PDF and return basic info"""
         file_id = str(uuid.uuid4())
         filename = secure_filename(file.filename)
-        filepath = os.path.join(self.upload_folder, f"{file_id}.pdf")
 
-        file.save(filepath)
+        # Store the upload once per content digest
+        blob = self.blobs.store(file.stream)
+
+        return self._register_blob(file_id, filename, blob, self._blob_info(blob))
+
+    def ingest_upload(self, stream, boundary, max_bytes=None):
+        """
+        Store a PDF streamed from a multipart request body and return basic info
+
+        Unlike save_pdf, the body is never spooled: the file is hashed and
+        written to the blob store as it arrives, and non-PDFs, truncated or
+        oversize files are rejected while streaming. Files that no engine can
+        read or that need a password are rejected after the probe.
+
+        Raises:
+            InvalidUpload: The file was rejected
+        """
+        filename, blob = ingest_pdf_upload(stream, boundary, self.blobs, max_bytes=max_bytes)
+        return self._accept_upload(filename, blob)
+
+    def finalize_upload(self, upload_id):
+        """
+        Finish a chunked upload (see ChunkedUploads) and return basic info
+
+        Returns:
+            PDF file info, or None if the upload is unknown
+
+        Raises:
+            InvalidUpload: The upload is incomplete or the file was rejected
+        """
+        result = self.uploads.finalize(upload_id)
+        if result is None:
+            return None
+
+        filename, blob = result
+        return self._accept_upload(filename, blob)
+
+    def _accept_upload(self, filename, blob):
+        """Probe a newly stored upload and register it, or reject it and release its blob"""
+        blob_info = self._blob_info(blob)
+
+        reason = None
+        if 'engines' in blob_info and not any(blob_info['engines'].values()):
+            reason = "File is not a readable PDF"
+        elif blob_info.get('needs_pass'):
+            reason = "Password-protected PDFs are not supported"
+
+        if reason:
+            self.registry.release_blob(blob['digest'])
+            raise InvalidUpload(reason)
+
+        return self._register_blob(str(uuid.uuid4()), secure_filename(filename), blob, blob_info)
+
+    def _blob_info(self, blob):
+        """Parsed info of a stored blob, probing it the first time its content is seen"""
+        blob_info = blob['info']
+        if blob_info is None:
+            blob_info = self._probe_pdf(blob['filepath'])
+            self.registry.set_blob_info(blob['digest'], blob_info)
+        return blob_info
+
+    def _register_blob(self, file_id, filename, blob, blob_info):
+        """Register a new file ID referencing a stored blob"""
+        filepath = blob['filepath']
+
+        pdf_info = {
+            "id": file_id,
+            "filename": filename,
+            "pages": blob_info['pages'],
+            "filepath": filepath,
+            "digest": blob['digest']
+        }
+
+        # Operations dispatch straight to an engine that is known to work
+        if 'engines' in blob_info:
+            pdf_info['engines'] = blob_info['engines']
+            pdf_info['repaired'] = blob_info['repaired']
+
+        self.registry.register(pdf_info)
+        return pdf_info
+
+    def _probe_pdf(self, filepath):
+        """
+        Find out once, when a PDF is stored, which engines can read it
+
+        PyMuPDF also writes the structural index sidecar while the file is
+        open. Returns the blob info: page count, which engines can read the
+        file, whether MuPDF had to repair it and whether it needs a password.
+        """
+        engines = {"pypdf": False, "fitz": False}
+        pages = 0
+        repaired = False
+        needs_pass = False
+
+        try:
+            doc = fitz.open(filepath)
+            try:
+                index = build_index(doc)
+                repaired = bool(doc.is_repaired)
+                needs_pass = bool(doc.needs_pass)
+            finally:
+                doc.close()
+
+            write_index(filepath, index)
+            engines['fitz'] = True
+            pages = index['page_count']
+        except Exception as e:
+            print(f"PyMuPDF cannot read {filepath}: {str(e)}")
 
-        # Get PDF info using PyPDF
         try:
             reader = PdfReader(filepath)
-            pdf_info = {
-                "id": file_id,
-                "filename": filename,
-                "pages": len(reader.pages),
-                "filepath": filepath
-            }
+            pypdf_pages = len(reader.pages)
+            engines['pypdf'] = True
+            pages = pages or pypdf_pages
         except Exception as e:
-            # If PyPDF fails, try with PyMuPDF
+            print(f"PyPDF cannot read {filepath}: {str(e)}")
+
+        return {"pages": pages, "engines": engines, "repaired": repaired, "needs_pass": needs_pass}
+
+    def _use_engine(self, operation, file_info, engine, after=None):
+        """
+        Record that an operation runs on an engine, skipping engines that the
+        upload probe found unable to read the file
+
+        Args:
+            operation: Operation name, for the engine statistics
+            file_info: Registry entry of the source file
+            engine: 'pypdf' or 'fitz'
+            after: The error that made the operation fall back to this engine
+
+        Raises:
+            EngineUnavailable: The engine cannot read this file; the caller
+                goes straight to its other engine without parsing anything
+        """
+        with self._engine_stats_lock:
+            stats = self.engine_stats.setdefault(operation, Counter())
+            if after is not None and not isinstance(after, EngineUnavailable):
+                stats['fallback'] += 1
+
+            if file_info.get('engines', {}).get(engine) is False:
+                stats['skipped'] += 1
+                raise EngineUnavailable(f"{ENGINE_NAMES[engine]} cannot read this file")
+
+            stats[engine] += 1
+
+    def _update_incrementally(self, operation, file_info, output_path, modify):
+        """
+        Write a modified copy of a PDF as an incremental update
+
+        The source is cloned to output_path (a reflink where the filesystem
+        supports it), modify(doc) is applied to the clone and only the changed
+        objects are appended to it, so small edits of large files do not
+        rewrite the whole document.
+
+        Returns:
+            What modify returned, or None (leaving nothing behind) when the
+            file cannot be updated incrementally, e.g. because it is
+            encrypted or MuPDF had to repair it
+        """
+        if file_info.get('repaired') or file_info.get('engines', {}).get('fitz') is False:
+            return None
+
+        _clone_file(file_info['filepath'], output_path)
+        try:
+            doc = fitz.open(output_path)
             try:
-                doc = fitz.open(filepath)
-                pdf_info = {
-                    "id": file_id,
-                    "filename": filename,
-                    "pages": len(doc),
-                    "filepath": filepath
-                }
+                if doc.needs_pass or not doc.can_save_incrementally():
+                    result = None
+                else:
+                    result = modify(doc)
+                    doc.saveIncr()
+            finally:
                 doc.close()
-            except Exception as e2:
-                # If both fail, just provide basic info
-                pdf_info = {
-                    "id": file_id,
-                    "filename": filename,
-                    "pages": 0,  # Unknown number of pages
-                    "filepath": filepath
-                }
+        except Exception:
+            os.remove(output_path)
+            raise
 
-        self.pdf_storage[file_id] = pdf_info
-        return pdf_info
+        if result is None:
+            os.remove(output_path)
+            return None
+
+        with self._engine_stats_lock:
+            self.engine_stats.setdefault(operation, Counter())['incremental'] += 1
+        return result
+
+    def _defer(self, operation, file_id, file_info, prefix, params, preview_only, extra=None):
+        """
+        Register a derived file as a recipe instead of writing it
+
+        The entry records the operation, its parameters and the source; the
+        bytes are produced by _materialize() when a download or a later
+        operation first needs them. The entry holds its own reference to the
+        source blob, so it can be rendered (again) even after the source
+        entry has expired. Only uploaded sources (blobs) are deferred.
+
+        Returns:
+            Public file info, or None if the source is not a blob and the
+            caller has to write the file right away
+        """
+        digest = file_info.get('digest')
+        if not digest:
+            return None
+
+        new_file_id = str(uuid.uuid4())
+        new_filename = f"{prefix}{file_info['filename']}"
+
+        pdf_info = {
+            "id": new_file_id,
+            "filename": new_filename,
+            "pages": file_info['pages'],
+            "filepath": os.path.join(self.upload_folder, f"{new_file_id}_{new_filename}"),
+            "preview": preview_only,
+            "source_digest": digest,
+            "recipe": {"op": operation, "params": params, "source": file_info}
+        }
+        if extra:
+            pdf_info.update(extra)
+
+        # One transaction, so a crash in between cannot leak a blob reference
+        self.registry.register(pdf_info, parent_id=file_id,
+                               blob_ref=(digest, file_info['filepath'], os.path.getsize(file_info['filepath'])))
+
+        with self._engine_stats_lock:
+            self.engine_stats.setdefault(operation, Counter())['deferred'] += 1
+
+        return self._public_recipe_info(pdf_info)
+
+    @staticmethod
+    def _public_recipe_info(pdf_info):
+        """File info of a recipe-backed file, without the recipe internals"""
+        info = {key: value for key, value in pdf_info.items() if key not in ('recipe', 'source_digest')}
+        info['lazy'] = True
+        return info
+
+    def _materialize(self, file_info):
+        """
+        Make sure a file is on disk, rendering it from its recipe if needed
+
+        Files without a recipe are returned as they are. The rendered result
+        stays on disk as a cache; if it is removed, the recipe renders it again.
+        """
+        recipe = file_info.get('recipe')
+        if not recipe or os.path.exists(file_info['filepath']):
+            return file_info
+
+        source = recipe['source']
+
+        # The source entry may have expired; this file's blob reference kept
+        # its bytes, so bring the entry back for the operation to read
+        if source['id'] not in self.registry:
+            self.registry.restore_blob_entry(source, os.path.getsize(source['filepath']), ttl=PREVIEW_TTL)
+
+        operations = {
+            'rotate': self.rotate_pdf,
+            'watermark': self.add_watermark,
+            'preview-remove-pages': self.preview_remove_pages
+        }
+        result = operations[recipe['op']](source['id'], lazy=False, **recipe['params'])
+
+        # Move the rendered file into place and drop its temporary entry
+        os.replace(result['filepath'], file_info['filepath'])
+        self.registry.remove(result['id'])
 
-    def merge_pdfs(self, files, output_filename=None):
+        with self._engine_stats_lock:
+            self.engine_stats.setdefault(recipe['op'], Counter())['materialized'] += 1
+
+        return file_info
+
+    def content_hash(self, file_info):
+        """
+        Get the SHA-256 digest of a file's content
+
+        Uploads already carry their blob digest; other files are hashed once
+        and the result is stored with their entry.
+        """
+        if file_info.get('digest'):
+            return file_info['digest']
+        if file_info.get('content_hash'):
+            return file_info['content_hash']
+
+        sha256 = hashlib.sha256()
+        with open(file_info['filepath'], 'rb') as f:
+            for chunk in iter(lambda: f.read(BlobStore.CHUNK_SIZE), b''):
+                sha256.update(chunk)
+
+        content_hash = sha256.hexdigest()
+        self.registry.update(file_info['id'], content_hash=content_hash)
+        return content_hash
+
+    def render_thumbnail(self, file_id, page, width=200, image_format='png', rotate=0, watermark=None,
+                         remove=False):
+        """
+        Render a small image of one page, previewing an operation on it
+
+        Previews used to be whole preview_*.pdf documents; a thumbnail is a
+        few KB per page. Renderings are cached on disk by content hash, page,
+        width, transform and format.
+
+        Args:
+            page: Page number (1-indexed)
+            width: Image width in pixels (16-1024)
+            image_format: 'png' or 'webp'
+            rotate: Extra clockwise rotation in degrees, as rotate_pdf would apply
+            watermark: Watermark options (text, opacity, color, size, angle), as add_watermark takes them
+            remove: Highlight the page as preview_remove_pages does
+
+        Returns:
+            Dictionary with filepath, mimetype and key (usable as ETag) of the thumbnail
+        """
+        file_info = self._get_file_info(file_id)
+
+        image_format = str(image_format).lower()
+        if image_format not in THUMBNAIL_FORMATS:
+            raise ValueError(f"Unsupported thumbnail format: {image_format}")
+
+        width = min(max(int(width), 16), 1024)
+        rotate = int(rotate) % 360
+        if rotate not in (0, 90, 180, 270):
+            raise ValueError("Rotation angle must be a multiple of 90")
+
+        page = int(page)
+        total_pages = self._known_page_count(file_info)
+        if total_pages and not 1 <= page <= total_pages:
+            raise ValueError(f"Page {page} does not exist")
+
+        transform = {}
+        if rotate:
+            transform['rotate'] = rotate
+        if watermark and watermark.get('text'):
+            opacity = watermark.get('opacity', 0.3)
+            if isinstance(opacity, int) and opacity > 1:
+                opacity = opacity / 100.0
+            watermark = {
+                "text": str(watermark['text']),
+                "opacity": min(max(float(opacity), 0), 1),
+                "color": watermark.get('color', 'gray'),
+                "size": int(watermark.get('size', 36)),
+                "angle": int(watermark.get('angle', 45))
+            }
+            transform.update({f"watermark_{key}": value for key, value in watermark.items()})
+        else:
+            watermark = None
+        if remove:
+            transform['remove'] = 1
+
+        key = self.thumbnails.key(self.content_hash(file_info), page, width, transform, image_format)
+        result = {"key": key, "mimetype": THUMBNAIL_FORMATS[image_format]}
+
+        cached_path = self.thumbnails.get(key, image_format)
+        if cached_path:
+            result['filepath'] = cached_path
+            return result
+
+        try:
+            # Page-changing previews need a private copy, plain renders share the cached document
+            if watermark or remove:
+                doc = self.docs.checkout(file_id, file_info['filepath'])
+                try:
+                    if watermark:
+                        _watermark_pages(doc, [page], **watermark)
+                    if remove:
+                        _mark_pages_for_removal(doc, [page])
+                    pixmap = self._render_thumbnail_pixmap(doc, page, width, rotate)
+                finally:
+                    doc.close()
+            else:
+                with self.docs.borrow(file_id, file_info['filepath']) as doc:
+                    pixmap = self._render_thumbnail_pixmap(doc, page, width, rotate)
+
+            if image_format == 'png':
+                data = pixmap.tobytes('png')
+            else:
+                image = Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+                buffer = BytesIO()
+                image.save(buffer, format='WEBP', quality=80)
+                data = buffer.getvalue()
+
+            result['filepath'] = self.thumbnails.put(key, image_format, data)
+            return result
+
+        except Exception as e:
+            raise Exception(f"Error rendering thumbnail: {str(e)}")
+
+    @staticmethod
+    def _render_thumbnail_pixmap(doc, page_num, width, rotate):
+        """Render a page scaled to width pixels, turned clockwise by rotate degrees"""
+        if page_num > len(doc):
+            raise ValueError(f"Page {page_num} does not exist")
+
+        page = doc[page_num - 1]
+        rect = page.rect
+        page_width = rect.height if rotate in (90, 270) else rect.width
+        zoom = width / page_width
+        return page.get_pixmap(matrix=fitz.Matrix(zoom, zoom).prerotate(rotate), alpha=False)
+
+    def get_structure(self, file_id):
+        """
+        Get the structural index of a file (page sizes, rotations, image and
+        font xrefs, outline, metadata, encryption and linearization flags)
+
+        Uploads are indexed when they are stored; other files are indexed on
+        first use and the index is kept next to them.
+        """
+        file_info = self._get_file_info(file_id)
+
+        index = read_index(file_info['filepath'])
+        if index is None:
+            with self.docs.borrow(file_id, file_info['filepath']) as doc:
+                index = build_index(doc)
+            write_index(file_info['filepath'], index)
+
+        # The size analysis is kept in the same sidecar, but is not structure
+        index.pop('analysis', None)
+        return index
+
+    def analyze(self, file_id):
+        """
+        Explain where the bytes of a file are: images (by filter and
+        resolution), embedded fonts (with subset status), content streams,
+        metadata and unused objects, with the predicted size after each
+        compression level
+
+        Files never change, so the analysis is stored in the file's index
+        sidecar and later requests are answered from there.
+        """
+        file_info = self._get_file_info(file_id)
+        filepath = file_info['filepath']
+
+        index = read_index(filepath)
+        analysis = index.get('analysis') if index else None
+        if analysis is None or analysis.get('version') != ANALYSIS_VERSION:
+            with self.docs.borrow(file_id, filepath) as doc:
+                if index is None:
+                    index = build_index(doc)
+                analysis = analyze_pdf(doc, os.path.getsize(filepath), COMPRESSION_SETTINGS)
+            index['analysis'] = analysis
+            write_index(filepath, index)
+
+        return dict(analysis, id=file_id, filename=file_info['filename'], pages=file_info['pages'])
+
+    def _known_page_count(self, file_info):
+        """Page count from the structural index or the registry, without opening the PDF (0 if unknown)"""
+        index = read_index(file_info['filepath'])
+        if index is not None:
+            return index['page_count']
+        return file_info.get('pages') or 0
+
+    @staticmethod
+    def _remove_outputs(paths):
+        """Delete the files an operation wrote before it failed, and forget them"""
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        paths.clear()
+
+    def merge_pdfs(self, files, output_filename=None, progress=None, optimize=False):
         """Merge multiple PDF files into one"""
+        temp_files = []
         try:
-            # Save temporary files
-            temp_files = []
+            # Save temporary files (unique names, so concurrent merges never share a path)
             for file in files:
-                temp_path = os.path.join(tempfile.gettempdir(), secure_filename(file.filename))
-                file.save(temp_path)
+                fd, temp_path = tempfile.mkstemp(suffix=f"_{secure_filename(file.filename)}")
+                os.close(fd)
                 temp_files.append(temp_path)
+                file.save(temp_path)
 
+            return self.merge_pdf_paths(temp_files, output_filename, progress, optimize=optimize)
+
+        finally:
+            # Cleanup temporary files
+            for temp_path in temp_files:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+    def merge_pdf_paths(self, paths, output_filename=None, progress=None, optimize=False):
+        """
+        Merge PDF files that are already on disk into one
+
+        Args:
+            paths: List of PDF file paths, in merge order
+            output_filename: Name for the merged file
+            progress: Optional callback(done, total) called after each input
+            optimize: Run the optimize pass (see optimize_pdf) on the result
+
+        Returns:
+            PDF file info dictionary
+        """
+        try:
             # Try merging with PyPDF first
             try:
                 # Merge PDFs using PyPDF
                 writer = PdfWriter()
 
-                for temp_path in temp_files:
-                    reader = PdfReader(temp_path)
+                for index, path in enumerate(paths):
+                    reader = PdfReader(path)
                     for page in reader.pages:
                         writer.add_page(page)
 
+                    if progress:
+                        progress(index + 1, len(paths))
+
                 # Save merged PDF
                 file_id = str(uuid.uuid4())
                 if output_filename:
@@ -107,13 +817,17 @@ class PdfOperations:
 
             except Exception as e:
                 # If PyPDF fails, try with PyMuPDF
+                print(f"PyPDF merge failed, retrying with PyMuPDF: {e}")
                 doc = fitz.open()
 
-                for temp_path in temp_files:
-                    src_doc = fitz.open(temp_path)
+                for index, path in enumerate(paths):
+                    src_doc = fitz.open(path)
                     doc.insert_pdf(src_doc)
                     src_doc.close()
 
+                    if progress:
+                        progress(index + 1, len(paths))
+
                 # Save merged PDF
                 file_id = str(uuid.uuid4())
                 if output_filename:
@@ -128,10 +842,106 @@ class PdfOperations:
                 total_pages = len(doc)
                 doc.close()
 
-            # Cleanup temporary files
-            for temp_path in temp_files:
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
+            # Create file info
+            pdf_info = {
+                "id": file_id,
+                "filename": filename,
+                "pages": total_pages,
+                "filepath": output_path
+            }
+
+            if optimize:
+                pdf_info['optimization'] = self._optimize_output(output_path)
+
+            self.registry.register(pdf_info)
+            return pdf_info
+
+        except Exception as e:
+            raise Exception(f"Error merging PDFs: {str(e)}")
+
+    def merge_stored(self, inputs, output_filename=None, progress=None, optimize=False):
+        """
+        Merge files that are already stored, by file ID
+
+        Pages are read straight from the stored files (blobs for uploads),
+        so nothing is uploaded twice and no temporary copies are made. The
+        inputs are opened from disk rather than through the document cache,
+        so a bulk merge does not push out the files being edited.
+
+        Args:
+            inputs: List, in merge order, of file IDs or dictionaries with
+                file_id and optionally pages (list of 1-indexed page numbers)
+                or ranges (list of {start, end}, 1-indexed and inclusive,
+                as split_pdf takes them)
+            output_filename: Name for the merged file
+            progress: Optional callback(done, total) called after each input
+            optimize: Run the optimize pass (see optimize_pdf) on the result
+
+        Returns:
+            PDF file info dictionary
+        """
+        if len(inputs) < 2:
+            raise Exception("Need at least two files to merge")
+
+        # Resolve every input before parsing anything
+        sources = []
+        for item in inputs:
+            if not isinstance(item, dict):
+                item = {"file_id": item}
+
+            file_info = self.registry.get(item.get('file_id'))
+            if file_info is None:
+                raise Exception(f"File not found: {item.get('file_id')}")
+            file_info = self._materialize(file_info)
+
+            sources.append((file_info, self._merge_page_selection(file_info, item)))
+
+        file_id = str(uuid.uuid4())
+        filename = secure_filename(output_filename) if output_filename else "merged.pdf"
+        output_path = os.path.join(self.upload_folder, f"{file_id}_{filename}")
+
+        try:
+            # Try merging with PyPDF first
+            try:
+                writer = PdfWriter()
+
+                for index, (file_info, pages) in enumerate(sources):
+                    self._use_engine('merge', file_info, 'pypdf')
+                    reader = PdfReader(file_info['filepath'])
+                    for page_num in pages or range(1, len(reader.pages) + 1):
+                        writer.add_page(reader.pages[page_num - 1])
+
+                    if progress:
+                        progress(index + 1, len(sources))
+
+                with open(output_path, 'wb') as output_file:
+                    writer.write(output_file)
+
+                total_pages = len(writer.pages)
+
+            except Exception as e:
+                # If PyPDF fails, try with PyMuPDF
+                doc = fitz.open()
+
+                for index, (file_info, pages) in enumerate(sources):
+                    self._use_engine('merge', file_info, 'fitz', after=e)
+                    src_doc = fitz.open(file_info['filepath'])
+                    try:
+                        if pages is None:
+                            doc.insert_pdf(src_doc)
+                        else:
+                            # Insert runs of consecutive pages in one call each
+                            for start, end in _page_runs(pages):
+                                doc.insert_pdf(src_doc, from_page=start - 1, to_page=end - 1)
+                    finally:
+                        src_doc.close()
+
+                    if progress:
+                        progress(index + 1, len(sources))
+
+                doc.save(output_path)
+                total_pages = len(doc)
+                doc.close()
 
             # Create file info
             pdf_info = {
@@ -141,64 +951,98 @@ class PdfOperations:
                 "filepath": output_path
             }
 
-            self.pdf_storage[file_id] = pdf_info
+            if optimize:
+                pdf_info['optimization'] = self._optimize_output(output_path)
+
+            self.registry.register(pdf_info)
             return pdf_info
 
         except Exception as e:
+            if os.path.exists(output_path):
+                os.remove(output_path)
             raise Exception(f"Error merging PDFs: {str(e)}")
 
+    def _merge_page_selection(self, file_info, item):
+        """1-indexed pages of one merge input, or None for all pages"""
+        if not item.get('pages') and not item.get('ranges'):
+            return None
+
+        total_pages = self._known_page_count(file_info) or self.get_page_count(file_info['filepath'])
+
+        pages = []
+        for range_info in item.get('ranges') or []:
+            start = int(range_info.get('start', 1))
+            end = int(range_info.get('end', start))
+            pages.extend(range(max(start, 1), min(end, total_pages) + 1))
+        for page_num in item.get('pages') or []:
+            if 1 <= int(page_num) <= total_pages:
+                pages.append(int(page_num))
+
+        if not pages:
+            raise Exception(f"No valid pages selected from {file_info['filename']}")
+        return pages
+
     def remove_pages(self, file_id, pages_to_remove):
         """Remove specific pages from a PDF file"""
-        if file_id not in self.pdf_storage:
-            raise Exception("File not found")
+        file_info = self._get_file_info(file_id)
+        pages_to_remove = _page_numbers(pages_to_remove)
 
-        file_info = self.pdf_storage[file_id]
+        # Reject impossible requests before parsing anything
+        total_pages = self._known_page_count(file_info)
+        if total_pages:
+            valid_pages = {p for p in pages_to_remove if 1 <= p <= total_pages}
+            if len(valid_pages) >= total_pages:
+                raise Exception("Error removing pages from PDF: Cannot remove all pages from the PDF")
 
         try:
             # Try with PyPDF first
             try:
-                reader = PdfReader(file_info['filepath'])
-                writer = PdfWriter()
-                total_pages = len(reader.pages)
+                self._use_engine('remove-pages', file_info, 'pypdf')
 
-                # Convert to integers and ensure within range
-                pages_to_remove = [int(p) for p in pages_to_remove if 1 <= int(p) <= total_pages]
+                with self.docs.borrow(file_id, file_info['filepath'], 'pypdf') as reader:
+                    writer = PdfWriter()
+                    total_pages = len(reader.pages)
 
-                # Check that we're not removing all pages
-                if len(pages_to_remove) >= total_pages:
-                    raise Exception("Cannot remove all pages from the PDF")
+                    # Convert to integers and ensure within range
+                    pages_to_remove = [int(p) for p in pages_to_remove if 1 <= int(p) <= total_pages]
 
-                # Add all pages except those to be removed
-                for i in range(total_pages):
-                    if i + 1 not in pages_to_remove:  # Use 1-indexed page numbers
-                        writer.add_page(reader.pages[i])
+                    # Check that we're not removing all pages
+                    if len(pages_to_remove) >= total_pages:
+                        raise Exception("Cannot remove all pages from the PDF")
 
-                new_file_id = str(uuid.uuid4())
-                new_filename = f"pages_removed_{file_info['filename']}"
-                output_path = os.path.join(self.upload_folder, f"{new_file_id}_{new_filename}")
+                    # Add all pages except those to be removed
+                    for i in range(total_pages):
+                        if i + 1 not in pages_to_remove:  # Use 1-indexed page numbers
+                            writer.add_page(reader.pages[i])
 
-                with open(output_path, 'wb') as output_file:
-                    writer.write(output_file)
+                    new_file_id = str(uuid.uuid4())
+                    new_filename = f"pages_removed_{file_info['filename']}"
+                    output_path = os.path.join(self.upload_folder, f"{new_file_id}_{new_filename}")
+
+                    with open(output_path, 'wb') as output_file:
+                        writer.write(output_file)
 
             except Exception as e:
                 # If PyPDF fails, try with PyMuPDF
-                doc = fitz.open(file_info['filepath'])
-                total_pages = len(doc)
+                self._use_engine('remove-pages', file_info, 'fitz', after=e)
+
+                with self.docs.borrow(file_id, file_info['filepath']) as doc:
+                    total_pages = len(doc)
 
-                # Convert to integers and ensure within range
-                pages_to_remove = [int(p) for p in pages_to_remove if 1 <= int(p) <= total_pages]
+                    # Convert to integers and ensure within range
+                    pages_to_remove = [int(p) for p in pages_to_remove if 1 <= int(p) <= total_pages]
 
-                # Check that we're not removing all pages
-                if len(pages_to_remove) >= total_pages:
-                    raise Exception("Cannot remove all pages from the PDF")
+                    # Check that we're not removing all pages
+                    if len(pages_to_remove) >= total_pages:
+                        raise Exception("Cannot remove all pages from the PDF")
 
-                # PyMuPDF requires a list of pages to keep, not to remove
-                pages_to_keep = [i for i in range(total_pages) if i+1 not in pages_to_remove]
+                    # PyMuPDF requires a list of pages to keep, not to remove
+                    pages_to_keep = [i for i in range(total_pages) if i+1 not in pages_to_remove]
 
-                # Create a new document with only the pages we want to keep
-                new_doc = fitz.open()
-                for page_num in pages_to_keep:
-                    new_doc.insert_pdf(doc, from_page=page_num, to_page=page_num)
+                    # Create a new document with only the pages we want to keep
+                    new_doc = fitz.open()
+                    for page_num in pages_to_keep:
+                        new_doc.insert_pdf(doc, from_page=page_num, to_page=page_num)
 
                 new_file_id = str(uuid.uuid4())
                 new_filename = f"pages_removed_{file_info['filename']}"
@@ -206,7 +1050,6 @@ class PdfOperations:
 
                 new_doc.save(output_path)
                 new_doc.close()
-                doc.close()
 
             # Create file info
             pdf_info = {
@@ -217,48 +1060,40 @@ class PdfOperations:
                 "removed_pages": pages_to_remove
             }
 
-            self.pdf_storage[new_file_id] = pdf_info
+            self.registry.register(pdf_info, parent_id=file_id)
             return pdf_info
 
         except Exception as e:
             raise Exception(f"Error removing pages from PDF: {str(e)}")
 
-    def preview_remove_pages(self, file_id, pages_to_remove):
-        """Create a preview showing which pages will be removed in red"""
-        if file_id not in self.pdf_storage:
-            raise Exception("File not found")
+    def preview_remove_pages(self, file_id, pages_to_remove, lazy=True):
+        """
+        Create a preview showing which pages will be removed in red
 
-        file_info = self.pdf_storage[file_id]
+        With lazy=True the preview is only rendered when it is first needed.
+        """
+        file_info = self._get_file_info(file_id)
+        pages_to_remove = _page_numbers(pages_to_remove)
+
+        # Store the preview as a recipe; it is rendered on first download or use
+        total_pages = self._known_page_count(file_info)
+        if lazy and total_pages:
+            pages_to_remove = [p for p in pages_to_remove if 1 <= p <= total_pages]
+            pdf_info = self._defer('preview-remove-pages', file_id, file_info, "preview_delete_",
+                                   {"pages_to_remove": pages_to_remove}, True,
+                                   {"pages_to_remove": pages_to_remove})
+            if pdf_info is not None:
+                return pdf_info
 
         try:
-            doc = fitz.open(file_info['filepath'])
+            doc = self.docs.checkout(file_id, file_info['filepath'])
             total_pages = len(doc)
 
             # Convert to integers and ensure within range
             pages_to_remove = [int(p) for p in pages_to_remove if 1 <= int(p) <= total_pages]
 
             # Add a red highlight to pages that will be removed
-            for page_num in pages_to_remove:
-                page = doc[page_num-1]  # 0-based index
-
-                # Get page dimensions
-                rect = page.rect
-
-                # Add a semi-transparent red overlay
-                page.draw_rect(rect, color=(1, 0, 0), fill=(1, 0, 0, 0.3), overlay=True)
-
-                # Add a "TO BE DELETED" watermark
-                font_size = 36
-                text = "TO BE DELETED"
-                tw = fitz.TextWriter(rect)
-
-                # V PyMuPDF TextWriter.append() nepoužívá parametr color přímo
-                # Místo toho musíme použít fitz.utils.getColor pro převod barvy
-                red_color = (1, 0, 0)  # RGB červená
-                tw.append((rect.width/2, rect.height/2), text, fontsize=font_size,
-                          color=red_color)  # Správné použití color parametru
-
-                tw.write_text(page, opacity=0.8)
+            _mark_pages_for_removal(doc, pages_to_remove)
 
             new_file_id = str(uuid.uuid4())
             new_filename = f"preview_delete_{file_info['filename']}"
@@ -277,23 +1112,33 @@ class PdfOperations:
                 "pages_to_remove": pages_to_remove
             }
 
-            self.pdf_storage[new_file_id] = pdf_info
+            self.registry.register(pdf_info, parent_id=file_id)
             return pdf_info
 
         except Exception as e:
             raise Exception(f"Error creating delete preview: {str(e)}")
 
 
-    def split_pdf(self, file_id, split_method='byPage', ranges=None, pages=None, create_zip=True):
+    def split_pdf(self, file_id, split_method='byPage', ranges=None, pages=None, create_zip=True, progress=None):
         """Split a PDF file based on specified method"""
-        if file_id not in self.pdf_storage:
-            raise Exception("File not found")
+        file_info = self._get_file_info(file_id)
+
+        # Number of output files, for progress reporting
+        expected_files = {
+            'byPage': file_info.get('pages', 0),
+            'byRanges': len(ranges or []),
+            'extractPages': 1
+        }.get(split_method, 0)
 
-        file_info = self.pdf_storage[file_id]
+        # Every output path, so nothing is left behind unregistered if the
+        # split fails or its job is cancelled part way
+        written = []
 
         try:
             # Try with PyPDF first
             try:
+                self._use_engine('split', file_info, 'pypdf')
+
                 reader = PdfReader(file_info['filepath'])
                 total_pages = len(reader.pages)
 
@@ -308,6 +1153,7 @@ class PdfOperations:
                         split_id = str(uuid.uuid4())
                         filename = f"page_{i+1}.pdf"
                         output_path = os.path.join(self.upload_folder, f"{split_id}_{filename}")
+                        written.append(output_path)
 
                         with open(output_path, 'wb') as output_file:
                             writer.write(output_file)
@@ -319,9 +1165,11 @@ class PdfOperations:
                             "filepath": output_path
                         }
 
-                        self.pdf_storage[split_id] = pdf_info
                         result_files.append(pdf_info)
 
+                        if progress:
+                            progress(len(result_files), expected_files)
+
                 elif split_method == 'byRanges' and ranges:
                     # Split by specified page ranges
                     for i, range_info in enumerate(ranges):
@@ -339,6 +1187,7 @@ class PdfOperations:
                         split_id = str(uuid.uuid4())
                         filename = f"pages_{start+1}-{end}.pdf"
                         output_path = os.path.join(self.upload_folder, f"{split_id}_{filename}")
+                        written.append(output_path)
 
 
                         with open(output_path, 'wb') as output_file:
@@ -352,9 +1201,11 @@ class PdfOperations:
                             "filepath": output_path
                         }
 
-                        self.pdf_storage[split_id] = pdf_info
                         result_files.append(pdf_info)
 
+                        if progress:
+                            progress(len(result_files), expected_files)
+
                 elif split_method == 'extractPages' and pages:
                     # Extract specific pages
                     writer = PdfWriter()
@@ -371,6 +1222,7 @@ class PdfOperations:
 
                     filename = f"extracted_pages_{page_list}.pdf"
                     output_path = os.path.join(self.upload_folder, f"{split_id}_{filename}")
+                    written.append(output_path)
 
                     with open(output_path, 'wb') as output_file:
                         writer.write(output_file)
@@ -382,11 +1234,16 @@ class PdfOperations:
                         "filepath": output_path
                     }
 
-                    self.pdf_storage[split_id] = pdf_info
                     result_files.append(pdf_info)
 
+                    if progress:
+                        progress(len(result_files), expected_files)
+
             except Exception as e:
                 # If PyPDF fails, try with PyMuPDF
+                self._remove_outputs(written)
+                self._use_engine('split', file_info, 'fitz', after=e)
+
                 doc = fitz.open(file_info['filepath'])
                 total_pages = len(doc)
 
@@ -401,6 +1258,7 @@ class PdfOperations:
                         split_id = str(uuid.uuid4())
                         filename = f"page_{i+1}.pdf"
                         output_path = os.path.join(self.upload_folder, f"{split_id}_{filename}")
+                        written.append(output_path)
 
                         output_doc.save(output_path)
                         output_doc.close()
@@ -412,9 +1270,11 @@ class PdfOperations:
                             "filepath": output_path
                         }
 
-                        self.pdf_storage[split_id] = pdf_info
                         result_files.append(pdf_info)
 
+                        if progress:
+                            progress(len(result_files), expected_files)
+
                 elif split_method == 'byRanges' and ranges:
                     # Split by specified page ranges
                     for i, range_info in enumerate(ranges):
@@ -431,6 +1291,7 @@ class PdfOperations:
                         split_id = str(uuid.uuid4())
                         filename = f"pages_{start+1}-{end+1}.pdf"
                         output_path = os.path.join(self.upload_folder, f"{split_id}_{filename}")
+                        written.append(output_path)
 
                         output_doc.save(output_path)
                         output_doc.close()
@@ -443,9 +1304,11 @@ class PdfOperations:
                             "filepath": output_path
                         }
 
-                        self.pdf_storage[split_id] = pdf_info
                         result_files.append(pdf_info)
 
+                        if progress:
+                            progress(len(result_files), expected_files)
+
                 elif split_method == 'extractPages' and pages:
                     # Extract specific pages
                     output_doc = fitz.open()
@@ -464,6 +1327,7 @@ class PdfOperations:
 
                     filename = f"extracted_pages_{page_list}.pdf"
                     output_path = os.path.join(self.upload_folder, f"{split_id}_{filename}")
+                    written.append(output_path)
 
                     output_doc.save(output_path)
                     output_doc.close()
@@ -475,81 +1339,88 @@ class PdfOperations:
                         "filepath": output_path
                     }
 
-                    self.pdf_storage[split_id] = pdf_info
                     result_files.append(pdf_info)
 
+                    if progress:
+                        progress(len(result_files), expected_files)
+
                 doc.close()
 
-            # Create zip file if needed and there are multiple files
+            # Record a zip archive if needed and there are multiple files; it is
+            # streamed from the member files on download, never written to disk
             if create_zip and len(result_files) > 1:
                 zip_id = str(uuid.uuid4())
                 zip_filename = f"split_files_{zip_id}.zip"
-                zip_path = os.path.join(self.upload_folder, zip_filename)
-
-                with zipfile.ZipFile(zip_path, 'w') as zip_file:
-                    for file_info in result_files:
-                        zip_file.write(file_info['filepath'], file_info['filename'])
 
                 # Add zip info to result files
                 for file_info in result_files:
                     file_info['zip_id'] = zip_id
-                    file_info['zip_path'] = zip_path
                     file_info['zip_filename'] = zip_filename
 
+                # Record the archive in the zip manifest
+                self.registry.register_zip(zip_id, None, zip_filename,
+                                           [split_info['id'] for split_info in result_files],
+                                           parent_id=file_id)
+
+            # Register the split files once their zip info is complete
+            for split_info in result_files:
+                self.registry.register(split_info, parent_id=file_id)
+
             return result_files
 
         except Exception as e:
+            self._remove_outputs(written)
             raise Exception(f"Error splitting PDF: {str(e)}")
+        except BaseException:
+            # Cancelled (JobCancelled is not an Exception)
+            self._remove_outputs(written)
+            raise
 
 
-    def rotate_pdf(self, file_id, angle=90, pages=None, preview_only=False):
+    def rotate_pdf(self, file_id, angle=90, pages=None, preview_only=False, incremental=True, lazy=True):
 
-        """Rotate pages in a PDF file"""
-        if file_id not in self.pdf_storage:
-            raise Exception("File not found")
+        """
+        Rotate pages in a PDF file
 
-        file_info = self.pdf_storage[file_id]
+        With incremental=True only the changed page objects are appended to a
+        copy of the source, instead of rewriting the whole document. With
+        lazy=True the result is only rendered when it is first needed.
+        """
+        file_info = self._get_file_info(file_id)
 
-        try:
-            # Convert angle to integer if it's a string
-            if isinstance(angle, str):
-                try:
-                    angle = int(angle)
-                except ValueError:
-                    angle = 90  # Default to 90 degrees if invalid
+        # Convert angle to integer if it's a string
+        if isinstance(angle, str):
+            try:
+                angle = int(angle)
+            except ValueError:
+                angle = 90  # Default to 90 degrees if invalid
+
+        # Normalize angle to 0, 90, 180, or 270; a deferred result would
+        # otherwise only fail when it is first rendered
+        angle = _number(angle, "Rotation angle") % 360
+        if angle not in (0, 90, 180, 270):
+            raise ValueError("Rotation angle must be a multiple of 90")
+        angle = int(angle)
+        pages = _page_numbers(pages)
 
-            # Normalize angle to 0, 90, 180, or 270
-            angle = angle % 360
+        try:
+            # Reject page lists that match no page before parsing anything
+            known_pages = self._known_page_count(file_info)
+            if pages and known_pages and not [p for p in pages if 1 <= p <= known_pages]:
+                raise Exception("No valid pages to rotate")
+
+            # Store the result as a recipe; it is rendered on first download or use
+            if lazy and known_pages:
+                pdf_info = self._defer('rotate', file_id, file_info,
+                                       "preview_rotated_" if preview_only else "rotated_",
+                                       {"angle": angle, "pages": pages, "preview_only": preview_only,
+                                        "incremental": incremental}, preview_only)
+                if pdf_info is not None:
+                    return pdf_info
 
             # Try with PyMuPDF first
             try:
-                doc = fitz.open(file_info['filepath'])
-                total_pages = len(doc)
-
-                # Determine which pages to rotate
-                if pages is None or not pages:
-                    pages = list(range(1, total_pages + 1))
-
-                # Validate pages
-                pages = [p for p in pages if 1 <= p <= total_pages]
-
-                if not pages:
-                    raise Exception("No valid pages to rotate")
-
-                # Apply rotation
-                for page_num in pages:
-                    # PyMuPDF uses 0-based indexing
-                    page = doc[page_num - 1]
-
-                    # Get current rotation
-                    current_rotation = page.rotation
-
-                    # Calculate new rotation (fitz uses 0, 90, 180, 270)
-                    new_rotation = (current_rotation + angle) % 360
-
-                    # Apply the rotation
-                    page.set_rotation(new_rotation)
-
+                self._use_engine('rotate', file_info, 'fitz')
 
                 # For preview, use a temporary filename with "preview_" prefix
                 if preview_only:
@@ -561,13 +1432,23 @@ class PdfOperations:
                     new_filename = f"rotated_{file_info['filename']}"
                     output_path = os.path.join(self.upload_folder, f"{new_file_id}_{new_filename}")
 
+                # Only /Rotate keys change, so append an update to a copy of the source if possible
+                total_pages = None
+                if incremental:
+                    total_pages = self._update_incrementally('rotate', file_info, output_path,
+                                                             lambda doc: _rotate_pages(doc, pages, angle))
 
-                doc.save(output_path)
-                doc.close()
+                if total_pages is None:
+                    doc = self.docs.checkout(file_id, file_info['filepath'])
+                    total_pages = _rotate_pages(doc, pages, angle)
+                    doc.save(output_path)
+                    doc.close()
 
             except Exception as e:
                 # If PyMuPDF fails, try with PyPDF
-                reader = PdfReader(file_info['filepath'])
+                self._use_engine('rotate', file_info, 'pypdf', after=e)
+
+                reader = self.docs.checkout(file_id, file_info['filepath'], 'pypdf')
                 writer = PdfWriter()
 
                 total_pages = len(reader.pages)
@@ -624,33 +1505,57 @@ class PdfOperations:
                 "preview": preview_only
             }
 
-            # Store in pdf_storage (even previews, they'll be cleaned up later)
+            # Store in the registry (even previews, they expire sooner)
 
-            self.pdf_storage[new_file_id] = pdf_info
+            self.registry.register(pdf_info, parent_id=file_id)
             return pdf_info
 
         except Exception as e:
             raise Exception(f"Error rotating PDF: {str(e)}")
 
 
-    def add_watermark(self, file_id, text, opacity=0.3, color="gray", size=36, angle=45, pages=None, preview_only=False):
+    def add_watermark(self, file_id, text, opacity=0.3, color="gray", size=36, angle=45, pages=None, preview_only=False,
+                      lazy=True):
 
-        """Add text watermark to PDF pages"""
-        if file_id not in self.pdf_storage:
-            raise Exception("File not found")
+        """
+        Add text watermark to PDF pages
 
-        file_info = self.pdf_storage[file_id]
+        With lazy=True the result is only rendered when it is first needed.
+        """
+        file_info = self._get_file_info(file_id)
+
+        # Check the parameters up front, so a deferred result cannot fail
+        # only when it is first rendered
+        if not isinstance(text, str) or not text:
+            raise ValueError("Watermark text must be a non-empty string")
+        size = _number(size, "Watermark size")
+        if size <= 0:
+            raise ValueError("Watermark size must be positive")
+        angle = _number(angle, "Watermark angle")
+        pages = _page_numbers(pages)
+
+        # Convert opacity to float in range 0-1
+        opacity = _number(opacity, "Watermark opacity")
+        if isinstance(opacity, int) and opacity > 1:
+            opacity = opacity / 100.0
+        opacity = min(max(float(opacity), 0), 1)  # Ensure in range 0-1
 
         try:
-            # Convert opacity to float in range 0-1
-            if isinstance(opacity, int) and opacity > 1:
-                opacity = opacity / 100.0
-            opacity = min(max(float(opacity), 0), 1)  # Ensure in range 0-1
+            # Store the result as a recipe; it is rendered on first download or use
+            if lazy and self._known_page_count(file_info):
+                pdf_info = self._defer('watermark', file_id, file_info,
+                                       "preview_watermarked_" if preview_only else "watermarked_",
+                                       {"text": text, "opacity": opacity, "color": color, "size": size,
+                                        "angle": angle, "pages": pages, "preview_only": preview_only}, preview_only)
+                if pdf_info is not None:
+                    return pdf_info
 
             # Try with PyMuPDF
             try:
-                # Open the PDF with PyMuPDF
-                doc = fitz.open(file_info['filepath'])
+                self._use_engine('watermark', file_info, 'fitz')
+
+                # Open a private copy of the PDF with PyMuPDF
+                doc = self.docs.checkout(file_id, file_info['filepath'])
                 total_pages = len(doc)
 
                 # Determine which pages to watermark
@@ -660,35 +1565,8 @@ class PdfOperations:
                 # Validate pages
                 pages = [p for p in pages if 1 <= p <= total_pages]
 
-                # Create font color
-                if color == "gray":
-                    text_color = (0.5, 0.5, 0.5)
-                elif color == "red":
-                    text_color = (1, 0, 0)
-                elif color == "blue":
-                    text_color = (0, 0, 1)
-                elif color == "green":
-                    text_color = (0, 0.5, 0)
-                elif color == "black":
-                    text_color = (0, 0, 0)
-                else:
-                    text_color = (0.5, 0.5, 0.5)  # Default to gray
-
                 # Apply watermark to all selected pages
-                for page_num in pages:
-                    # Get the page (PyMuPDF uses 0-based indexing)
-                    page = doc[page_num - 1]
-
-                    # Get page dimensions
-                    rect = page.rect
-                    center_x = rect.width / 2
-                    center_y = rect.height / 2
-
-                    # Create text watermark
-                    fontsize = size
-                    text_writer = fitz.TextWriter(rect, opacity=opacity, color=text_color)
-                    text_writer.append((center_x, center_y), text, fontsize=fontsize, rotate=angle)
-                    text_writer.write_text(page)
+                _watermark_pages(doc, pages, text, opacity, color, size, angle)
 
 
                 # For preview, use a temporary filename with "preview_" prefix
@@ -706,6 +1584,8 @@ class PdfOperations:
 
             except Exception as e:
                 # If PyMuPDF failed, try with PyPDF and reportlab
+                self._use_engine('watermark', file_info, 'pypdf', after=e)
+
                 from reportlab.pdfgen import canvas
                 from reportlab.lib.pagesizes import letter
                 from reportlab.lib.colors import red, blue, green, black, gray
@@ -725,8 +1605,8 @@ class PdfOperations:
                 else:
                     text_color = gray
 
-                # Open original PDF
-                reader = PdfReader(file_info['filepath'])
+                # Open original PDF (pages are modified, so use a private copy)
+                reader = self.docs.checkout(file_id, file_info['filepath'], 'pypdf')
                 writer = PdfWriter()
 
                 total_pages = len(reader.pages)
@@ -793,37 +1673,40 @@ class PdfOperations:
                 "preview": preview_only
             }
 
-            # Store in pdf_storage (even previews, they'll be cleaned up later)
+            # Store in the registry (even previews, they expire sooner)
 
-            self.pdf_storage[new_file_id] = pdf_info
+            self.registry.register(pdf_info, parent_id=file_id)
             return pdf_info
 
         except Exception as e:
             raise Exception(f"Error adding watermark to PDF: {str(e)}")
 
 
-    def compress_pdf(self, file_id, compression_level='medium'):
+    def compress_pdf(self, file_id, compression_level='medium', progress=None, target_bytes=None, optimize=False):
         """
         Compress a PDF file to reduce its size - improved version
-        """
-        if file_id not in self.pdf_storage:
-            raise Exception("File not found")
 
-        file_info = self.pdf_storage[file_id]
+        With target_bytes, compression_level is ignored and image quality and
+        resolution are searched instead, until the file fits (see
+        _compress_to_target). With optimize, the result also goes through
+        the optimize pass (see optimize_pdf).
+
+        A repeated request for the same content and settings reuses the
+        earlier result; it reports its own (near zero) compression_time and
+        keeps the original run's figures under cached_from.
+        """
+        started = time.time()
+        file_info = self._get_file_info(file_id)
 
         try:
-            # Map compression level to actual compression settings
-            compression_settings = {
-                'low': {'image_quality': 80, 'dpi': 150, 'pdfsettings': '/prepress'},
-                'medium': {'image_quality': 50, 'dpi': 120, 'pdfsettings': '/ebook'},
-                'high': {'image_quality': 30, 'dpi': 72, 'pdfsettings': '/screen'}
-            }
-
             # Default to medium if invalid level
-            if compression_level not in compression_settings:
+            if target_bytes:
+                compression_level = 'target'
+            elif compression_level not in COMPRESSION_SETTINGS:
                 compression_level = 'medium'
 
-            settings = compression_settings[compression_level]
+            settings = COMPRESSION_SETTINGS.get(compression_level)
+            image_report = None
 
             # Create a new file ID and path
             new_file_id = str(uuid.uuid4())
@@ -831,133 +1714,123 @@ class PdfOperations:
             output_path = os.path.join(self.upload_folder, f"{new_file_id}_{new_filename}")
             temp_output = os.path.join(tempfile.gettempdir(), f"temp_{new_file_id}.pdf")
 
-            # APPROACH 1: Try using Ghostscript if available - most effective
-            try:
-                import subprocess
-                gs_params = ['-dPDFSETTINGS=' + settings['pdfsettings']]
-
-                # Execute ghostscript
-                subprocess.run(
-                    ['gs', '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.4',
-                    gs_params[0], '-dNOPAUSE', '-dQUIET', '-dBATCH',
-                    f'-sOutputFile={temp_output}', file_info['filepath']],
-                    check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-                )
+            # Reuse an earlier result for the same content and settings
+            cache_settings = {"target_bytes": target_bytes, "ladder": TARGET_LADDER} if target_bytes else settings
+            if optimize:
+                cache_settings = dict(cache_settings, optimize=OPTIMIZE_VERSION)
+            cache_key = self.compression_cache.key(self.content_hash(file_info), cache_settings,
+                                                   self._compression_engine_version())
+            cached = self.compression_cache.get(cache_key)
+            if cached is not None:
+                info = dict(cached['info'])
+                cached_from = {key: info.pop(key) for key in COMPRESSION_RUN_KEYS if key in info}
+                pdf_info = dict(info, id=new_file_id, filename=new_filename,
+                                filepath=cached['filepath'], digest=cached['digest'], cached=True,
+                                cached_from=cached_from, compression_time=round(time.time() - started, 3))
+                self.registry.register(pdf_info, parent_id=file_id)
+
+                if progress:
+                    progress(1, 1)
+                return pdf_info
+
+            search = None
+            if target_bytes:
+                search = self._compress_to_target(file_info, target_bytes, output_path)
+                image_report = search.pop('images')
+            else:
+                # APPROACH 1: Try using Ghostscript if available - most effective
+                try:
+                    gs_params = ['-dPDFSETTINGS=' + settings['pdfsettings']]
+
+                    # Execute ghostscript (fails at once if it is not installed)
+                    self.tools.run('gs', [
+                        '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.4',
+                        gs_params[0], '-dNOPAUSE', '-dQUIET', '-dBATCH', '-dSAFER',
+                        f'-sOutputFile={temp_output}', file_info['filepath']
+                    ])
+
+                    if os.path.exists(temp_output):
+                        shutil.copy(temp_output, output_path)
+                        os.remove(temp_output)
+                except Exception as gs_error:
+                    if not isinstance(gs_error, ToolUnavailable):
+                        print(f"Ghostscript compression failed: {gs_error}")
+
+                    # A killed run may leave a partial output behind
+                    if os.path.exists(temp_output):
+                        os.remove(temp_output)
+
+                    # APPROACH 2: Try PyMuPDF, re-encoding each unique image once
+                    try:
+                        self._use_engine('compress', file_info, 'fitz')
 
-                if os.path.exists(temp_output):
-                    shutil.copy(temp_output, output_path)
-                    os.remove(temp_output)
-            except Exception as gs_error:
-                print(f"Ghostscript compression failed: {gs_error}")
+                        image_report = self._compress_images(file_info['filepath'], settings, output_path)
+                    except Exception as mupdf_error:
+                        print(f"PyMuPDF compression failed: {mupdf_error}")
+                        self._use_engine('compress', file_info, 'pypdf', after=mupdf_error)
 
-                # APPROACH 2: Try PyMuPDF for image-based compression
-                try:
-                    doc = fitz.open(file_info['filepath'])
-
-                    # Process each page for image compression
-                    for page_num in range(len(doc)):
-                        page = doc[page_num]
-                        image_list = page.get_images(full=True)
-
-                        for img_index, img in enumerate(image_list):
-                            xref = img[0]  # Image reference number
-
-                            try:
-                                base_image = doc.extract_image(xref)
-                                image_bytes = base_image["image"]
-
-                                # Convert to PIL image for recompression
-                                from PIL import Image
-                                import io
-
-                                # Load the image
-                                image = Image.open(io.BytesIO(image_bytes))
-
-                                # Resize image based on compression level
-                                if compression_level == 'high':
-                                    # Reduce by 50%
-                                    orig_width, orig_height = image.size
-                                    new_width = int(orig_width * 0.5)
-                                    new_height = int(orig_height * 0.5)
-                                    image = image.resize((new_width, new_height), Image.LANCZOS)
-                                elif compression_level == 'medium':
-                                    # Reduce by 25%
-                                    orig_width, orig_height = image.size
-                                    new_width = int(orig_width * 0.75)
-                                    new_height = int(orig_height * 0.75)
-                                    image = image.resize((new_width, new_height), Image.LANCZOS)
-                            except Exception as e:
-                                print(f"Error processing image: {e}")
-
-                    # Save with aggressive compression settings
-                    doc.save(output_path,
-                            garbage=4,  # Clean up unused objects
-                            clean=True,  # More cleanup
-                            deflate=True,  # Compress streams
-                            deflate_images=True,  # Compress images
-                            deflate_fonts=True)  # Compress fonts
-                    doc.close()
-                except Exception as mupdf_error:
-                    print(f"PyMuPDF compression failed: {mupdf_error}")
 
-                    # APPROACH 3: PyPDF as last resort
-                    reader = PdfReader(file_info['filepath'])
-                    writer = PdfWriter()
+                        # APPROACH 3: PyPDF as last resort
+                        reader = PdfReader(file_info['filepath'])
+                        writer = PdfWriter()
 
-                    for page in reader.pages:
-                        writer.add_page(page)
+                        for page in reader.pages:
+                            writer.add_page(page)
 
-                    writer.compress_content_streams = True
+                        writer.compress_content_streams = True
 
-                    with open(output_path, 'wb') as output_file:
-                        writer.write(output_file)
+                        with open(output_path, 'wb') as output_file:
+                            writer.write(output_file)
 
-            # If the output file doesn't exist or is somehow larger than the original,
-            # create a more aggressive compression using a different approach
-            if not os.path.exists(output_path) or os.path.getsize(output_path) >= os.path.getsize(file_info['filepath']):
-                # Try qpdf as a last resort if available
-                try:
-                    import subprocess
-                    subprocess.run(
-                        ['qpdf', '--linearize', '--compress-streams=y', '--decode-level=specialized',
-                         file_info['filepath'], output_path],
-                        check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-                    )
-                except Exception:
-                    # If all else fails, just use the original with JPG conversion trick
-                    # This method is more aggressive but might reduce quality
+                # If the output file doesn't exist or is somehow larger than the original,
+                # create a more aggressive compression using a different approach
+                if not os.path.exists(output_path) or os.path.getsize(output_path) >= os.path.getsize(file_info['filepath']):
+                    # The output is replaced, so the image report no longer applies
+                    image_report = None
+
+                    # Try qpdf as a last resort if available
                     try:
-                        # Open with PyMuPDF
-                        doc = fitz.open(file_info['filepath'])
-                        pdf_writer = fitz.open()
-
-                        # Convert each page to JPG then back to PDF
-                        for page_num in range(len(doc)):
-                            page = doc[page_num]
-                            pix = page.get_pixmap(matrix=fitz.Matrix(1, 1))
-
-                            # Higher compression for higher levels
-                            quality = 30
-                            if compression_level == 'low':
-                                quality = 60
-                            elif compression_level == 'medium':
-                                quality = 40
-
-                            img_data = pix.tobytes("jpeg", quality=quality)
-                            img = Image.open(io.BytesIO(img_data))
-
-                            # Create new PDF page
-                            new_page = pdf_writer.new_page(width=page.rect.width, height=page.rect.height)
-                            new_page.insert_image(page.rect, stream=img_data)
-
-                        # Save the resultant PDF
-                        pdf_writer.save(output_path)
-                        pdf_writer.close()
-                        doc.close()
-                    except Exception as e:
-                        print(f"Final compression method failed: {e}")
-                        # Last resort - just copy the file if all methods fail
-                        shutil.copy(file_info['filepath'], output_path)
+                        self.tools.run('qpdf', [
+                            '--linearize', '--compress-streams=y', '--decode-level=specialized',
+                            file_info['filepath'], output_path
+                        ])
+                    except Exception:
+                        # If all else fails, just use the original with JPG conversion trick
+                        # This method is more aggressive but might reduce quality
+                        try:
+                            # Open with PyMuPDF
+                            doc = fitz.open(file_info['filepath'])
+                            pdf_writer = fitz.open()
+
+                            # Convert each page to JPG then back to PDF
+                            for page_num in range(len(doc)):
+                                page = doc[page_num]
+                                pix = page.get_pixmap(matrix=fitz.Matrix(1, 1))
+
+                                # Higher compression for higher levels
+                                quality = 30
+                                if compression_level == 'low':
+                                    quality = 60
+                                elif compression_level == 'medium':
+                                    quality = 40
+
+                                img_data = pix.tobytes("jpeg", quality=quality)
+                                img = Image.open(BytesIO(img_data))
+
+                                # Create new PDF page
+                                new_page = pdf_writer.new_page(width=page.rect.width, height=page.rect.height)
+                                new_page.insert_image(page.rect, stream=img_data)
+
+                            # Save the resultant PDF
+                            pdf_writer.save(output_path)
+                            pdf_writer.close()
+                            doc.close()
+                        except Exception as e:
+                            print(f"Final compression method failed: {e}")
+                            # Last resort - just copy the file if all methods fail
+                            shutil.copy(file_info['filepath'], output_path)
+
+            optimization = self._optimize_output(output_path) if optimize else None
 
             # Create file info
             pdf_info = {
@@ -971,117 +1844,254 @@ class PdfOperations:
                 "compression_ratio": 1 - (os.path.getsize(output_path) / os.path.getsize(file_info['filepath']))
             }
 
-            # Store in pdf_storage
-            self.pdf_storage[new_file_id] = pdf_info
+            # Per-image report, when the images were re-encoded here
+            if image_report is not None:
+                pdf_info['images'] = image_report
+                pdf_info['images_saved'] = sum(image['saved'] for image in image_report)
+
+            # Target search: whether it was met, the steps tried and the time spent
+            if search is not None:
+                pdf_info.update(search)
+
+            if optimization is not None:
+                pdf_info['optimization'] = optimization
+
+            # Every fresh run reports the same figures, so a later cache hit
+            # always has them to show under cached_from
+            pdf_info.setdefault('attempts', [])
+            pdf_info.setdefault('passes', 1)
+            pdf_info['compression_time'] = round(time.time() - started, 3)
+
+            # Keep the output as a blob, so the cache can hand it out again
+            blob = self.blobs.store_file(output_path)
+            pdf_info['filepath'] = blob['filepath']
+            pdf_info['digest'] = blob['digest']
+
+            # Store in the registry
+            self.registry.register(pdf_info, parent_id=file_id)
+            self.compression_cache.put(cache_key, blob, {key: value for key, value in pdf_info.items()
+                                                         if key not in ('id', 'filename', 'filepath', 'digest')})
+
+            if progress:
+                progress(1, 1)
+
             return pdf_info
 
         except Exception as e:
             raise Exception(f"Error compressing PDF: {str(e)}")
 
-    def edit_metadata(self, file_id, metadata, preview_only=False):
+    def _compression_engine_version(self):
+        """Versions of every engine compress_pdf may use, part of its cache keys"""
+        return ';'.join([f"gs={self.tools.version('gs')}", f"qpdf={self.tools.version('qpdf')}",
+                         f"pymupdf={fitz.VersionBind}", f"pypdf={pypdf_version}",
+                         f"images={IMAGE_ENGINE_VERSION}"])
+
+    def _compress_images(self, pdf_path, settings, output_path, images=None):
         """
-        Edit metadata of a PDF file
+        Write a copy of a PDF with its images re-encoded at settings, return the per-image report
+        """
+        doc = fitz.open(pdf_path)
+        try:
+            image_report = self._recompress_images(doc, pdf_path, settings, images=images)
+
+            # Save with aggressive compression settings; images are JPEG
+            # already and need no deflating
+            doc.save(output_path,
+                     garbage=4,  # Clean up unused objects
+                     clean=True,  # More cleanup
+                     deflate=True,  # Compress streams
+                     deflate_fonts=True)  # Compress fonts
+        finally:
+            doc.close()
 
-        Args:
-            file_id: ID of the PDF to edit
-            metadata: Dictionary with metadata fields (title, author, subject, keywords)
-            preview_only: Whether this is just a preview
+        return image_report
+
+    def _compress_to_target(self, file_info, target_bytes, output_path):
+        """
+        Compress a PDF until it is no larger than target_bytes
+
+        Steps of TARGET_LADDER (image quality and resolution, mildest first)
+        are estimated by encoding a sample of the largest images, and a full
+        pass runs only for a step estimated to fit. A pass that misses the
+        target corrects the estimates of the steps after it. The search stops
+        at the first output that fits; if none does, the smallest is kept.
 
         Returns:
-            Dictionary with updated PDF info
+            target_bytes, target_met, attempts (every step looked at, with its
+            estimated and, if a full pass ran, actual size), passes (number of
+            full passes), compression_time (seconds) and images (per-image
+            report of the kept output, or None)
         """
-        if file_id not in self.pdf_storage:
-            raise Exception("File not found")
+        started = time.time()
+        pdf_path = file_info['filepath']
+        file_size = os.path.getsize(pdf_path)
+
+        result = {"target_bytes": target_bytes, "target_met": False, "attempts": [], "passes": 0, "images": None}
 
-        file_info = self.pdf_storage[file_id]
+        if file_size <= target_bytes:
+            # Fits already; nothing to give up
+            _clone_file(pdf_path, output_path)
+            result['target_met'] = True
+            result['compression_time'] = round(time.time() - started, 3)
+            return result
 
+        self._use_engine('compress', file_info, 'fitz')
+
+        doc = fitz.open(pdf_path)
+        pass_path = f"{output_path}.pass"
+        best_size = None
         try:
-            # Initialize PDF reader and writer
-            reader = PdfReader(file_info['filepath'])
-            writer = PdfWriter()
+            images = collect_images(doc)
+            base_size = file_size - deflate_savings(doc, skip=images)
+
+            # Actual over estimated size of the last full pass, applied to later estimates
+            correction = 1.0
+
+            for index, (quality, dpi) in enumerate(TARGET_LADDER):
+                estimate = estimate_size(doc, images, quality, dpi, base_size)
+                attempt = {"image_quality": quality, "dpi": dpi, "estimated_size": estimate}
+                result['attempts'].append(attempt)
+
+                # Only the last step runs regardless of its estimate
+                if estimate * correction > target_bytes and index < len(TARGET_LADDER) - 1:
+                    continue
+
+                image_report = self._compress_images(pdf_path, {"image_quality": quality, "dpi": dpi},
+                                                     pass_path, images=images)
+                attempt['size'] = os.path.getsize(pass_path)
+                result['passes'] += 1
+
+                if best_size is None or attempt['size'] < best_size:
+                    best_size = attempt['size']
+                    os.replace(pass_path, output_path)
+                    result['images'] = image_report
+
+                if best_size <= target_bytes:
+                    result['target_met'] = True
+                    break
+
+                # Without images to re-encode, the next steps produce the same file
+                if all(image.get('skipped') == 'not recompressible' for image in image_report):
+                    break
+
+                if estimate:
+                    correction = attempt['size'] / estimate
+        finally:
+            doc.close()
+            if os.path.exists(pass_path):
+                os.remove(pass_path)
 
-            # Add all pages from the original document
-            for page in reader.pages:
-                writer.add_page(page)
+        result['compression_time'] = round(time.time() - started, 3)
+        return result
 
-            # Prepare metadata
-            meta = {}
-            if metadata.get("title"):
-                meta["/Title"] = metadata["title"]
-            if metadata.get("author"):
-                meta["/Author"] = metadata["author"]
-            if metadata.get("subject"):
-                meta["/Subject"] = metadata["subject"]
-            if metadata.get("keywords"):
-                meta["/Keywords"] = metadata["keywords"]
+    def _recompress_images(self, doc, pdf_path, settings, workers=None, images=None):
+        """
+        Re-encode the images of an open document at a compression level's
+        quality and resolution, across the render pool when there are several
+        workers (COMPRESS_WORKERS, else RENDER_WORKERS)
 
-            # Apply metadata
-            writer.add_metadata(meta)
+        Returns:
+            Per-image report (see image_compress.recompress_images)
+        """
+        workers = self._render_workers(workers, os.environ.get('COMPRESS_WORKERS'))
 
-            # Set output path
-            if preview_only:
-                new_file_id = str(uuid.uuid4())
-                new_filename = f"preview_metadata_{file_info['filename']}"
-                output_path = os.path.join(self.upload_folder, f"{new_file_id}_{new_filename}")
-            else:
-                new_file_id = str(uuid.uuid4())
-                new_filename = f"metadata_{file_info['filename']}"
-                output_path = os.path.join(self.upload_folder, f"{new_file_id}_{new_filename}")
+        def recompress(pool):
+            return recompress_images(doc, pdf_path, settings['image_quality'], settings['dpi'],
+                                     pool=pool, workers=workers, images=images)
 
-            # Write the PDF with updated metadata
-            with open(output_path, 'wb') as output_file:
-                writer.write(output_file)
+        # Nothing is written back until every image is encoded, so a retry starts clean
+        return run_on_pool('render', self.render_workers_max, recompress) if workers > 1 else recompress(None)
+
+    def optimize_pdf(self, file_id, subset_fonts=True, progress=None):
+        """
+        Shrink a PDF without touching its images or page content
+
+        Embedded fonts are subset to the glyphs used, byte-identical streams
+        (fonts and images repeated by merges) are merged into one object and
+        unreferenced objects are dropped (see pdf_optimize.optimize_file).
+
+        Returns:
+            PDF file info dictionary with the size delta and an optimization report
+        """
+        file_info = self._get_file_info(file_id)
+
+        new_file_id = str(uuid.uuid4())
+        new_filename = f"optimized_{file_info['filename']}"
+        output_path = os.path.join(self.upload_folder, f"{new_file_id}_{new_filename}")
+
+        try:
+            self._use_engine('optimize', file_info, 'fitz')
+            report = optimize_file(file_info['filepath'], output_path, subset_fonts=subset_fonts)
 
-            # Create file info
             pdf_info = {
                 "id": new_file_id,
                 "filename": new_filename,
-                "pages": len(reader.pages),
+                "pages": file_info['pages'],
                 "filepath": output_path,
-                "preview": preview_only,
-                "metadata": metadata
+                "original_size": report['size_before'],
+                "optimized_size": report['size_after'],
+                "size_delta": report['size_after'] - report['size_before'],
+                "optimization": report
             }
 
-            # Store in pdf_storage
-            self.pdf_storage[new_file_id] = pdf_info
+            self.registry.register(pdf_info, parent_id=file_id)
+
+            if progress:
+                progress(1, 1)
+
             return pdf_info
 
         except Exception as e:
-            raise Exception(f"Error editing metadata: {str(e)}")
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            raise Exception(f"Error optimizing PDF: {str(e)}")
+
+    def _optimize_output(self, output_path):
+        """Run the optimize pass over a freshly written output file in place, return its report"""
+        temp_output = os.path.join(tempfile.gettempdir(), f"optimize_{uuid.uuid4()}.pdf")
+        try:
+            report = optimize_file(output_path, temp_output)
+            if not report['kept_original']:
+                shutil.move(temp_output, output_path)
+            return report
+        finally:
+            if os.path.exists(temp_output):
+                os.remove(temp_output)
 
     def get_metadata(self, file_id):
         """Get metadata from a PDF file"""
-        if file_id not in self.pdf_storage:
-            raise Exception("File not found")
-
-        file_info = self.pdf_storage[file_id]
+        file_info = self._get_file_info(file_id)
 
         try:
             # Try with PyPDF first
             try:
-                reader = PdfReader(file_info['filepath'])
-                if reader.metadata:
-                    metadata = reader.metadata
-
-                    # Extract metadata fields
-                    result = {}
-                    if metadata.title:
-                        result["title"] = metadata.title
-                    if metadata.author:
-                        result["author"] = metadata.author
-                    if metadata.subject:
-                        result["subject"] = metadata.subject
-                    if metadata.keywords:
-                        result["keywords"] = metadata.keywords
-
-                    return result
-                else:
-                    return {}
+                self._use_engine('get-metadata', file_info, 'pypdf')
+
+                with self.docs.borrow(file_id, file_info['filepath'], 'pypdf') as reader:
+                    if reader.metadata:
+                        metadata = reader.metadata
+
+                        # Extract metadata fields
+                        result = {}
+                        if metadata.title:
+                            result["title"] = metadata.title
+                        if metadata.author:
+                            result["author"] = metadata.author
+                        if metadata.subject:
+                            result["subject"] = metadata.subject
+                        if metadata.keywords:
+                            result["keywords"] = metadata.keywords
+
+                        return result
+                    else:
+                        return {}
 
             except Exception as e:
                 # If PyPDF fails, try with PyMuPDF
-                doc = fitz.open(file_info['filepath'])
-                metadata = doc.metadata
+                self._use_engine('get-metadata', file_info, 'fitz', after=e)
+
+                with self.docs.borrow(file_id, file_info['filepath']) as doc:
+                    metadata = doc.metadata
 
                 # Extract metadata fields
                 result = {}
@@ -1094,7 +2104,6 @@ class PdfOperations:
                 if "keywords" in metadata and metadata["keywords"]:
                     result["keywords"] = metadata["keywords"]
 
-                doc.close()
                 return result
 
         except Exception as e:
@@ -1102,82 +2111,84 @@ class PdfOperations:
             print(f"Error extracting metadata: {str(e)}")
             return {}
 
-    def edit_metadata(self, file_id, metadata, preview_only=False):
-        """Edit metadata of a PDF file"""
-        if file_id not in self.pdf_storage:
-            raise Exception("File not found")
+    def edit_metadata(self, file_id, metadata, preview_only=False, incremental=True):
+        """
+        Edit metadata of a PDF file
+
+        Args:
+            file_id: ID of the PDF to edit
+            metadata: Dictionary with metadata fields (title, author, subject, keywords)
+            preview_only: Whether this is just a preview
+            incremental: Append the new Info dictionary to a copy of the source
+                instead of rewriting the whole document (when possible)
 
-        file_info = self.pdf_storage[file_id]
+        Returns:
+            Dictionary with updated PDF info
+        """
+        file_info = self._get_file_info(file_id)
 
         try:
-            # Try with PyPDF first
-            try:
-                reader = PdfReader(file_info['filepath'])
-                writer = PdfWriter()
+            # Set output path
+            if preview_only:
+                new_file_id = str(uuid.uuid4())
+                new_filename = f"preview_metadata_{file_info['filename']}"
+                output_path = os.path.join(self.upload_folder, f"{new_file_id}_{new_filename}")
+            else:
+                new_file_id = str(uuid.uuid4())
+                new_filename = f"metadata_{file_info['filename']}"
+                output_path = os.path.join(self.upload_folder, f"{new_file_id}_{new_filename}")
 
-                # Add all pages from the original document
-                for page in reader.pages:
-                    writer.add_page(page)
+            def set_metadata(doc):
+                doc.set_metadata(_fitz_metadata(metadata))
+                return len(doc)
 
-                # Prepare metadata
-                meta = {}
-                if metadata.get("title"):
-                    meta["/Title"] = metadata["title"]
-                if metadata.get("author"):
-                    meta["/Author"] = metadata["author"]
-                if metadata.get("subject"):
-                    meta["/Subject"] = metadata["subject"]
-                if metadata.get("keywords"):
-                    meta["/Keywords"] = metadata["keywords"]
-
-                # Apply metadata
-                writer.add_metadata(meta)
-
-                # Set output path
-                if preview_only:
-                    new_file_id = str(uuid.uuid4())
-                    new_filename = f"preview_metadata_{file_info['filename']}"
-                    output_path = os.path.join(self.upload_folder, f"{new_file_id}_{new_filename}")
-                else:
-                    new_file_id = str(uuid.uuid4())
-                    new_filename = f"metadata_{file_info['filename']}"
-                    output_path = os.path.join(self.upload_folder, f"{new_file_id}_{new_filename}")
+            # Only the Info dictionary changes, so append an update to a copy of the source if possible
+            updated = None
+            if incremental:
+                updated = self._update_incrementally('edit-metadata', file_info, output_path, set_metadata)
 
-                # Write the PDF with updated metadata
-                with open(output_path, 'wb') as output_file:
-                    writer.write(output_file)
+            if updated is None:
+                # Try with PyPDF first
+                try:
+                    self._use_engine('edit-metadata', file_info, 'pypdf')
 
-            except Exception as e:
-                # If PyPDF fails, try with PyMuPDF
-                doc = fitz.open(file_info['filepath'])
+                    # Only the writer is modified, so the shared reader can be used
+                    with self.docs.borrow(file_id, file_info['filepath'], 'pypdf') as reader:
+                        writer = PdfWriter()
 
-                # Add metadata
-                meta = {}
-                if metadata.get("title"):
-                    meta["title"] = metadata["title"]
-                if metadata.get("author"):
-                    meta["author"] = metadata["author"]
-                if metadata.get("subject"):
-                    meta["subject"] = metadata["subject"]
-                if metadata.get("keywords"):
-                    meta["keywords"] = metadata["keywords"]
-
-                # Update the document's metadata
-                doc.set_metadata(meta)
-
-                # Set output path
-                if preview_only:
-                    new_file_id = str(uuid.uuid4())
-                    new_filename = f"preview_metadata_{file_info['filename']}"
-                    output_path = os.path.join(self.upload_folder, f"{new_file_id}_{new_filename}")
-                else:
-                    new_file_id = str(uuid.uuid4())
-                    new_filename = f"metadata_{file_info['filename']}"
-                    output_path = os.path.join(self.upload_folder, f"{new_file_id}_{new_filename}")
+                        # Add all pages from the original document
+                        for page in reader.pages:
+                            writer.add_page(page)
+
+                        # Prepare metadata
+                        meta = {}
+                        if metadata.get("title"):
+                            meta["/Title"] = metadata["title"]
+                        if metadata.get("author"):
+                            meta["/Author"] = metadata["author"]
+                        if metadata.get("subject"):
+                            meta["/Subject"] = metadata["subject"]
+                        if metadata.get("keywords"):
+                            meta["/Keywords"] = metadata["keywords"]
+
+                        # Apply metadata
+                        writer.add_metadata(meta)
+
+                        # Write the PDF with updated metadata (reads from the reader)
+                        with open(output_path, 'wb') as output_file:
+                            writer.write(output_file)
 
-                # Save the PDF with updated metadata
-                doc.save(output_path)
-                doc.close()
+                except Exception as e:
+                    # If PyPDF fails, try with PyMuPDF
+                    self._use_engine('edit-metadata', file_info, 'fitz', after=e)
+
+                    # Update the document's metadata
+                    doc = self.docs.checkout(file_id, file_info['filepath'])
+                    set_metadata(doc)
+
+                    # Save the PDF with updated metadata
+                    doc.save(output_path)
+                    doc.close()
 
             # Create file info
             pdf_info = {
@@ -1189,8 +2200,8 @@ class PdfOperations:
                 "metadata": metadata
             }
 
-            # Store in pdf_storage
-            self.pdf_storage[new_file_id] = pdf_info
+            # Store in the registry
+            self.registry.register(pdf_info, parent_id=file_id)
             return pdf_info
 
         except Exception as e:
@@ -1211,20 +2222,9 @@ class PdfOperations:
         Returns:
             Dictionary with protected PDF info
         """
-        if file_id not in self.pdf_storage:
-            raise Exception("File not found")
-
-        file_info = self.pdf_storage[file_id]
+        file_info = self._get_file_info(file_id)
 
         try:
-            # Initialize PDF reader and writer
-            reader = PdfReader(file_info['filepath'])
-            writer = PdfWriter()
-
-            # Add all pages from the original document
-            for page in reader.pages:
-                writer.add_page(page)
-
             # Set permissions - PyPDF permissions are bit flags
             permissions = 0
             if allow_printing:
@@ -1236,22 +2236,31 @@ class PdfOperations:
             if owner_password is None or owner_password == "":
                 owner_password = user_password
 
-            # Ensure we use the more secure 128-bit encryption
-            writer.encrypt(
-                user_password=user_password,
-                owner_password=owner_password,
-                use_128bit=True,
-                permissions_flag=permissions
-            )
-
             # Set output path
             new_file_id = str(uuid.uuid4())
             new_filename = f"protected_{file_info['filename']}"
             output_path = os.path.join(self.upload_folder, f"{new_file_id}_{new_filename}")
 
-            # Write the protected PDF
-            with open(output_path, 'wb') as output_file:
-                writer.write(output_file)
+            # Pages are only copied into the writer, so the shared reader can be used
+            with self.docs.borrow(file_id, file_info['filepath'], 'pypdf') as reader:
+                total_pages = len(reader.pages)
+                writer = PdfWriter()
+
+                # Add all pages from the original document
+                for page in reader.pages:
+                    writer.add_page(page)
+
+                # Ensure we use the more secure 128-bit encryption
+                writer.encrypt(
+                    user_password=user_password,
+                    owner_password=owner_password,
+                    use_128bit=True,
+                    permissions_flag=permissions
+                )
+
+                # Write the protected PDF (the writer still reads from the reader)
+                with open(output_path, 'wb') as output_file:
+                    writer.write(output_file)
 
             # Verify the PDF is actually password-protected
             try:
@@ -1261,7 +2270,7 @@ class PdfOperations:
                 # If we got here, the PDF isn't properly protected
                 # Let's try a different method with PyMuPDF
                 try:
-                    doc = fitz.open(file_info['filepath'])
+                    doc = self.docs.checkout(file_id, file_info['filepath'])
 
                     # Apply permissions and encryption
                     perm = 0
@@ -1290,19 +2299,130 @@ class PdfOperations:
             pdf_info = {
                 "id": new_file_id,
                 "filename": new_filename,
-                "pages": len(reader.pages),
+                "pages": total_pages,
                 "filepath": output_path,
                 "protected": True
             }
 
-            # Store in pdf_storage
-            self.pdf_storage[new_file_id] = pdf_info
+            # Store in the registry
+            self.registry.register(pdf_info, parent_id=file_id)
             return pdf_info
 
         except Exception as e:
             raise Exception(f"Error adding password protection: {str(e)}")
 
 
+    def run_pipeline(self, file_id, steps):
+        """
+        Apply several operations to one in-memory document and save it once
+
+        Args:
+            file_id: ID of the source PDF
+            steps: Ordered list of steps; each is a dictionary with "op" (rotate,
+                watermark, metadata or protect) and that operation's parameters,
+                named as in the single-operation routes. protect, which only
+                takes effect when the document is saved, must be the last step.
+
+        Returns:
+            PDF file info dictionary, with per-step timings in "timings"
+        """
+        file_info = self._get_file_info(file_id)
+
+        if not steps:
+            raise Exception("Pipeline has no steps")
+        for index, step in enumerate(steps):
+            if step.get('op') not in self.PIPELINE_STEPS:
+                raise Exception(f"Unsupported pipeline step: {step.get('op')}")
+            if step['op'] == 'protect' and index != len(steps) - 1:
+                raise Exception("protect must be the last pipeline step")
+
+        try:
+            self._use_engine('pipeline', file_info, 'fitz')
+
+            timings = []
+            started = time.perf_counter()
+            doc = self.docs.checkout(file_id, file_info['filepath'])
+            timings.append({"op": "open", "ms": round((time.perf_counter() - started) * 1000, 2)})
+
+            save_options = {}
+            for step in steps:
+                step_started = time.perf_counter()
+                op = step['op']
+
+                if op == 'rotate':
+                    angle = int(step.get('angle', step.get('rotation', 90))) % 360
+                    _rotate_pages(doc, step.get('pages'), angle)
+
+                elif op == 'watermark':
+                    if not step.get('text'):
+                        raise Exception("watermark step needs text")
+
+                    opacity = step.get('opacity', 0.3)
+                    if isinstance(opacity, int) and opacity > 1:
+                        opacity = opacity / 100.0
+                    opacity = min(max(float(opacity), 0), 1)
+
+                    color = step.get('color', 'gray')
+                    if isinstance(color, dict):
+                        color = color.get('value', 'gray')
+
+                    pages = [p for p in step.get('pages') or range(1, len(doc) + 1) if 1 <= p <= len(doc)]
+                    _watermark_pages(doc, pages, step['text'], opacity, color,
+                                     step.get('size', 36), int(step.get('angle', 45)))
+
+                elif op == 'metadata':
+                    doc.set_metadata(_fitz_metadata(step.get('metadata', {})))
+
+                elif op == 'protect':
+                    if not step.get('user_password'):
+                        raise Exception("protect step needs user_password")
+
+                    permissions = 0
+                    if step.get('allow_printing', True):
+                        permissions |= fitz.PDF_PERM_PRINT
+                    if step.get('allow_copying', True):
+                        permissions |= fitz.PDF_PERM_COPY
+
+                    save_options = {
+                        "encryption": fitz.PDF_ENCRYPT_AES_128,
+                        "user_pw": step['user_password'],
+                        "owner_pw": step.get('owner_password') or step['user_password'],
+                        "permissions": permissions
+                    }
+
+                timings.append({"op": op, "ms": round((time.perf_counter() - step_started) * 1000, 2)})
+
+            new_file_id = str(uuid.uuid4())
+            new_filename = f"processed_{file_info['filename']}"
+            output_path = os.path.join(self.upload_folder, f"{new_file_id}_{new_filename}")
+
+            # The only serialisation of the whole pipeline
+            save_started = time.perf_counter()
+            total_pages = len(doc)
+            doc.save(output_path, **save_options)
+            doc.close()
+            timings.append({"op": "save", "ms": round((time.perf_counter() - save_started) * 1000, 2)})
+
+            pdf_info = {
+                "id": new_file_id,
+                "filename": new_filename,
+                "pages": total_pages,
+                "filepath": output_path,
+                "steps": [step['op'] for step in steps],
+                "protected": bool(save_options)
+            }
+
+            self.registry.register(pdf_info, parent_id=file_id)
+
+            # Timings describe this run only, so they are not stored
+            result = dict(pdf_info)
+            result['timings'] = timings
+            result['total_ms'] = round((time.perf_counter() - started) * 1000, 2)
+            return result
+
+        except Exception as e:
+            raise Exception(f"Error running pipeline: {str(e)}")
+
     def convert_images_to_pdf(self, image_files, page_size='A4', orientation='portrait'):
         """
         Convert images to a single PDF file
@@ -1405,7 +2525,7 @@ class PdfOperations:
                 "filepath": output_path
             }
 
-            self.pdf_storage[file_id] = pdf_info
+            self.registry.register(pdf_info)
             return pdf_info
 
         except Exception as e:
@@ -1415,7 +2535,8 @@ class PdfOperations:
                     os.remove(temp_path)
             raise Exception(f"Error converting images to PDF: {str(e)}")
 
-    def convert_pdf_to_images(self, file_id, format='png', dpi=300, pages=None, create_zip=True):
+    def convert_pdf_to_images(self, file_id, format='png', dpi=300, pages=None, create_zip=True, progress=None,
+                              workers=None):
         """
         Convert PDF pages to images
 
@@ -1425,22 +2546,26 @@ class PdfOperations:
             dpi: Image resolution (dots per inch)
             pages: List of pages to convert (1-indexed), None for all pages
             create_zip: Whether to create a ZIP archive for multiple images
+            progress: Optional callback(done, total) called after each page
+            workers: Number of processes rendering in parallel (default:
+                RENDER_WORKERS environment variable, 1 = serial), capped at
+                render_workers_max
 
         Returns:
             List of dictionaries with image file info
         """
-        if file_id not in self.pdf_storage:
-            raise Exception("File not found")
-
-        file_info = self.pdf_storage[file_id]
+        file_info = self._get_file_info(file_id)
         pdf_file_path = file_info['filepath']
 
+        # Create an output folder per conversion, so the janitor expiring an
+        # earlier conversion of this file never removes this one's images
+        run_name = f"images_{file_id}_{uuid.uuid4().hex[:8]}"
+        output_folder = os.path.join(self.upload_folder, run_name)
+
         try:
             # Calculate zoom factor from DPI (default PDF resolution is 72 DPI)
             zoom = dpi / 72
 
-            # Create output folder for images
-            output_folder = os.path.join(self.upload_folder, f"images_{file_id}")
             os.makedirs(output_folder, exist_ok=True)
 
             # Open the PDF file with PyMuPDF
@@ -1466,65 +2591,172 @@ class PdfOperations:
                 # Convert only specified pages (convert from 1-indexed to 0-indexed)
                 pages_to_convert = [p-1 for p in pages if 1 <= p <= total_pages]
 
-            # Process each page
-            for i in pages_to_convert:
-                # Get the page
-                page = pdf_document[i]
+            workers = self._render_workers(workers)
 
-                # Set the matrix for rendering (controls resolution)
-                matrix = fitz.Matrix(zoom, zoom)
-
-                # Render the page as a pixmap
-                pixmap = page.get_pixmap(matrix=matrix, alpha=False)
+            if workers > 1 and len(pages_to_convert) > 1:
+                # Render chunks of pages in worker processes
+                pdf_document.close()
+                rendered = self._render_pages_parallel(pdf_file_path, list(pages_to_convert), zoom, format,
+                                                       output_folder, workers, progress)
+            else:
+                # Process each page
+                rendered = []
+                for i in pages_to_convert:
+                    rendered.append(_render_page(pdf_document, i, zoom, format, output_folder))
 
-                # Define the output filename
-                image_id = str(uuid.uuid4())
-                image_filename = f"page_{i+1}.{format}"
-                image_filepath = os.path.join(output_folder, image_filename)
+                    if progress:
+                        progress(len(rendered), len(pages_to_convert))
 
-                # Save the pixmap as an image file
-                pixmap.save(image_filepath)
+                pdf_document.close()
 
+            for image_filename, image_filepath in rendered:
                 # Store metadata
                 image_info = {
-                    "id": image_id,
+                    "id": str(uuid.uuid4()),
                     "filename": image_filename,
                     "filepath": image_filepath,
                     "type": mime_type
                 }
 
-                self.pdf_storage[image_id] = image_info
                 result_files.append(image_info)
 
-            pdf_document.close()
-
-            # Create ZIP if needed and there are multiple files
+            # Record a ZIP if needed and there are multiple files; it is streamed
+            # from the images on download, never written to disk
             if create_zip and len(result_files) > 1:
                 zip_id = str(uuid.uuid4())
-                zip_filename = f"images_{file_id}.zip"
-                zip_path = os.path.join(self.upload_folder, zip_filename)
-
-                with zipfile.ZipFile(zip_path, 'w') as zip_file:
-                    for file_info in result_files:
-                        zip_file.write(file_info['filepath'], file_info['filename'])
-
-                # Add zip info
-                zip_info = {
-                    "id": zip_id,
-                    "filename": zip_filename,
-                    "filepath": zip_path,
-                    "type": "application/zip"
-                }
-                self.pdf_storage[zip_id] = zip_info
+                zip_filename = f"{run_name}.zip"
+
+                # Record the archive in the zip manifest
+                self.registry.register_zip(zip_id, None, zip_filename,
+                                           [image_info['id'] for image_info in result_files],
+                                           parent_id=file_id)
 
                 # Add zip info to result files
                 for file_info in result_files:
                     file_info['zip_id'] = zip_id
 
+            # Register the images once their zip info is complete
+            for image_info in result_files:
+                self.registry.register(image_info, parent_id=file_id)
+
             return result_files
 
         except Exception as e:
+            shutil.rmtree(output_folder, ignore_errors=True)
             raise Exception(f"Error converting PDF to images: {str(e)}")
+        except BaseException:
+            # Cancelled (JobCancelled is not an Exception); nothing here was registered yet
+            shutil.rmtree(output_folder, ignore_errors=True)
+            raise
+
+    def iter_page_images(self, file_id, format='png', dpi=300, pages=None, workers=None):
+        """
+        Render PDF pages to images without storing them
+
+        Pages are rendered as the caller consumes them (e.g. while a streamed
+        ZIP is being sent). With several workers, at most one chunk per
+        worker is rendered ahead, so memory does not grow with the page count.
+
+        Yields:
+            (filename, image bytes) in page order
+        """
+        file_info = self._get_file_info(file_id)
+        pdf_file_path = file_info['filepath']
+
+        format = format.lower()
+        if format not in ['png', 'jpg', 'jpeg']:
+            format = 'png'  # Default to PNG if invalid format
+        zoom = dpi / 72
+
+        total_pages = self._known_page_count(file_info) or self.get_page_count(pdf_file_path)
+        if pages is None:
+            page_indices = list(range(total_pages))
+        else:
+            page_indices = [p-1 for p in pages if 1 <= p <= total_pages]
+
+        workers = self._render_workers(workers)
+
+        if workers > 1 and len(page_indices) > 1:
+            chunk_size = max(1, -(-len(page_indices) // (workers * 4)))
+            chunks = [page_indices[start:start + chunk_size] for start in range(0, len(page_indices), chunk_size)]
+
+            pool = get_pool('render', self.render_workers_max)
+            retried = False
+            pending = []
+            next_chunk = 0
+            while pending or next_chunk < len(chunks):
+                try:
+                    while next_chunk < len(chunks) and len(pending) < workers:
+                        pending.append(pool.submit(_render_page_chunk_bytes, pdf_file_path, chunks[next_chunk],
+                                                   zoom, format))
+                        next_chunk += 1
+                    results = pending[0].result()
+                except BrokenProcessPool:
+                    if retried:
+                        raise
+                    # A worker died; render the chunks not yet yielded again on a fresh pool
+                    retried = True
+                    next_chunk -= len(pending)
+                    pending = []
+                    pool = replace_pool('render', self.render_workers_max, pool)
+                    continue
+
+                pending.pop(0)
+                yield from results
+            return
+
+        doc = fitz.open(pdf_file_path)
+        try:
+            for index in page_indices:
+                yield _render_page_bytes(doc, index, zoom, format)
+        finally:
+            doc.close()
+
+    def iter_zip_members(self, zip_id):
+        """(arcname, path) pairs of the member files of a recorded zip archive"""
+        zip_info = self.registry.get_zip(zip_id)
+        if zip_info is None:
+            return []
+
+        return zip_members_from_files(self.registry.get(member_id) for member_id in zip_info['member_ids'])
+
+    def _render_workers(self, requested=None, default=None):
+        """
+        Render processes one request may use: requested, else default, else
+        RENDER_WORKERS, never more than render_workers_max
+        """
+        if requested is None:
+            requested = default if default is not None else os.environ.get('RENDER_WORKERS', 1)
+        return max(1, min(int(requested), self.render_workers_max))
+
+    def _render_pages_parallel(self, pdf_path, page_indices, zoom, format, output_folder, workers, progress=None):
+        """
+        Render pages across a process pool
+
+        Pages are split into contiguous chunks (several per worker, so a slow
+        chunk does not hold up the rest); each worker opens its own document.
+        Results come back in page order, exactly as the serial path writes them.
+        """
+        chunk_size = max(1, -(-len(page_indices) // (workers * 4)))
+        chunks = [page_indices[start:start + chunk_size] for start in range(0, len(page_indices), chunk_size)]
+
+        def render(pool):
+            rendered = []
+            jobs = [(pdf_path, chunk, zoom, format, output_folder) for chunk in chunks]
+            for result in imap_bounded(pool, _render_page_chunk, jobs, workers):
+                rendered.extend(result)
+
+                if progress:
+                    progress(len(rendered), len(page_indices))
+            return rendered
+
+        # Pages rendered before a worker died are simply written again
+        rendered = run_on_pool('render', self.render_workers_max, render)
+
+        # Merge back into the requested page order
+        order = {index: position for position, index in enumerate(page_indices)}
+        rendered.sort(key=lambda item: order[item[0]])
+        return [(filename, filepath) for _, filename, filepath in rendered]
 
     def get_page_count(self, file_path):
         """Get the number of pages in a PDF file"""
@@ -1543,55 +2775,46 @@ class PdfOperations:
             print(f"Error getting page count: {str(e)}")
             return 0
 
+    def get_file_info(self, file_id, materialize=False):
+        """
+        Get stored file info, or None if the file is unknown
+
+        Args:
+            materialize: Render a file that is stored as a recipe, so that
+                its filepath exists (e.g. for downloads)
+        """
+        file_info = self.registry.get(file_id)
+        if file_info is not None and materialize:
+            file_info = self._materialize(file_info)
+        return file_info
+
+    def _get_file_info(self, file_id):
+        """Get stored file info (with the file on disk) or fail with 'File not found'"""
+        file_info = self.registry.get(file_id)
+        if file_info is None:
+            raise Exception("File not found")
+        return self._materialize(file_info)
+
     def get_file_path(self, file_id):
         """Get file path for download"""
-        if file_id not in self.pdf_storage:
+        file_info = self.get_file_info(file_id, materialize=True)
+        if file_info is None:
             return None
 
-        return self.pdf_storage[file_id]['filepath']
+        return file_info['filepath']
+
+    def get_zip_info(self, zip_id):
+        """Get the zip manifest entry (path, member ids, size), or None"""
+        return self.registry.get_zip(zip_id)
 
     def get_zip_path(self, zip_id):
         """Get zip file path for download"""
-        for file_id, file_info in self.pdf_storage.items():
-            if 'zip_id' in file_info and file_info['zip_id'] == zip_id:
-                return file_info['zip_path']
-
-        return None
-
-    def cleanup_files(self, max_age_hours=24):
-        """Clean up temporary files older than specified age"""
-        import time
-
-        now = time.time()
-        max_age_seconds = max_age_hours * 3600
-
-
-        # Preview files should be cleaned up more aggressively
-        preview_max_age_seconds = 3600  # 1 hour
-
-
-        for root, dirs, files in os.walk(self.upload_folder):
-            for filename in files:
-                filepath = os.path.join(root, filename)
-                if os.path.isfile(filepath):
-                    file_age = now - os.path.getmtime(filepath)
-
-
-                    # Clean up preview files more aggressively
-                    is_preview = "preview_" in filename
-                    max_age = preview_max_age_seconds if is_preview else max_age_seconds
-
-                    if file_age > max_age:
-
-                        try:
-                            os.remove(filepath)
-                            print(f"Removed old file: {filepath}")
+        zip_info = self.registry.get_zip(zip_id)
+        if zip_info is None:
+            return None
 
-                            # Remove from storage if present
-                            for file_id, file_info in list(self.pdf_storage.items()):
-                                if file_info.get('filepath') == filepath:
-                                    del self.pdf_storage[file_id]
-                                    break
+        return zip_info['filepath']
 
-                        except Exception as e:
-                            print(f"Error removing file {filepath}: {str(e)}")
\ No newline at end of file
+    def cleanup_files(self):
+        """Remove one batch of expired files (the janitor normally does this in the background)"""
+        return self.janitor.run_once()
@@ -0,0 +1,150 @@
+import os
+import time
+import shutil
+import hashlib
+from collections import defaultdict
+
+import fitz
+
+from pdf_analysis import FONT_FILE_KEYS, SUBSET_PREFIX
+
+
+# Bumped whenever a change makes the same input produce different output
+OPTIMIZE_VERSION = 1
+
+
+def _font_files(doc):
+    """Embedded font files: {font file xref: (font name, subset)}"""
+    fonts = {}
+    for xref in range(1, doc.xref_length()):
+        try:
+            source = doc.xref_object(xref, compressed=True)
+        except Exception:
+            continue
+        if '/FontDescriptor' not in source or doc.xref_get_key(xref, 'Type')[1] != '/FontDescriptor':
+            continue
+
+        name = doc.xref_get_key(xref, 'FontName')[1].lstrip('/')
+        for key in FONT_FILE_KEYS:
+            kind, value = doc.xref_get_key(xref, key)
+            if kind == 'xref':
+                fonts[int(value.split()[0])] = (SUBSET_PREFIX.sub('', name), bool(SUBSET_PREFIX.match(name)))
+    return fonts
+
+
+def _font_bytes(doc, fonts):
+    return sum(len(doc.xref_stream_raw(xref) or b'') for xref in fonts)
+
+
+def _duplicate_streams(doc):
+    """
+    Streams identical to an earlier one, dictionary and data alike
+
+    Returns:
+        (number of duplicates, bytes they take)
+    """
+    groups = defaultdict(list)
+    for xref in range(1, doc.xref_length()):
+        if doc.xref_is_stream(xref):
+            groups[doc.xref_object(xref, compressed=True)].append(xref)
+
+    # Only streams whose dictionaries match can be equal, so hash just those
+    count = size = 0
+    for xrefs in groups.values():
+        if len(xrefs) < 2:
+            continue
+
+        seen = set()
+        for xref in xrefs:
+            data = doc.xref_stream_raw(xref) or b''
+            digest = hashlib.sha256(data).digest()
+            if digest in seen:
+                count += 1
+                size += len(data)
+            else:
+                seen.add(digest)
+    return count, size
+
+
+def optimize_file(src_path, dst_path, subset_fonts=True):
+    """
+    Write a smaller copy of a PDF without changing how it looks
+
+    Embedded fonts are cut down to the glyphs the document uses, streams
+    identical in dictionary and data are merged into one object, objects
+    nothing refers to any more are dropped and uncompressed streams are
+    deflated. If that does not make the file smaller, the original is
+    copied as it is.
+
+    Args:
+        src_path: PDF to optimize
+        dst_path: Path of the optimized copy
+        subset_fonts: Whether to subset embedded fonts
+
+    Returns:
+        Report: size before and after, bytes saved, object counts, merged
+        duplicate streams and embedded font bytes before and after
+    """
+    started = time.time()
+    size_before = os.path.getsize(src_path)
+
+    doc = fitz.open(src_path)
+    try:
+        objects_before = doc.xref_length() - 1
+        duplicates, duplicate_bytes = _duplicate_streams(doc)
+
+        fonts = _font_files(doc)
+        font_report = {
+            "embedded": len(fonts),
+            "subset_before": sum(1 for _, subset in fonts.values() if subset),
+            "bytes_before": _font_bytes(doc, fonts),
+            "subsetted": False
+        }
+
+        if subset_fonts and fonts:
+            # Needs fontTools on older PyMuPDF; the rest of the pass runs either way
+            try:
+                doc.subset_fonts()
+                font_report['subsetted'] = True
+            except Exception as e:
+                font_report['error'] = str(e)
+
+        # garbage=4 drops unreferenced objects and merges the duplicate streams
+        doc.save(dst_path,
+                 garbage=4,
+                 clean=True,
+                 deflate=True,
+                 deflate_images=True,
+                 deflate_fonts=True)
+    finally:
+        doc.close()
+
+    optimized = fitz.open(dst_path)
+    try:
+        objects_after = optimized.xref_length() - 1
+        fonts = _font_files(optimized)
+        font_report['subset_after'] = sum(1 for _, subset in fonts.values() if subset)
+        font_report['bytes_after'] = _font_bytes(optimized, fonts)
+    finally:
+        optimized.close()
+
+    size_after = os.path.getsize(dst_path)
+    if size_after >= size_before:
+        # Nothing to gain; keep the original bytes
+        shutil.copy(src_path, dst_path)
+        size_after = size_before
+        objects_after = objects_before
+        font_report['subset_after'] = font_report['subset_before']
+        font_report['bytes_after'] = font_report['bytes_before']
+
+    return {
+        "size_before": size_before,
+        "size_after": size_after,
+        "saved": size_before - size_after,
+        "objects_before": objects_before,
+        "objects_after": objects_after,
+        "duplicate_streams": {"count": duplicates, "bytes": duplicate_bytes},
+        "fonts": font_report,
+        "kept_original": size_after == size_before,
+        "optimize_time": round(time.time() - started, 3)
+    }
@@ -0,0 +1,71 @@
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+
+# Process pools of this server process, by (name, worker count)
+_pools = {}
+_lock = threading.Lock()
+
+
+def get_pool(name, workers):
+    """Shared process pool called name with workers processes, created on first use"""
+    with _lock:
+        pool = _pools.get((name, workers))
+        if pool is None:
+            # Spawned workers do not inherit server threads or open connections
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _pools[(name, workers)] = pool
+        return pool
+
+
+def replace_pool(name, workers, broken):
+    """
+    Drop a pool that lost a worker (killed for memory, crashed in MuPDF)
+    and return a fresh one
+
+    A broken pool refuses all further work, so keeping it would fail every
+    later call until the server restarts. If another thread already
+    replaced it, that replacement is returned.
+    """
+    with _lock:
+        if _pools.get((name, workers)) is broken:
+            del _pools[(name, workers)]
+    broken.shutdown(wait=False, cancel_futures=True)
+    return get_pool(name, workers)
+
+
+def run_on_pool(name, workers, work):
+    """
+    Call work(pool) with the shared pool; if a worker died meanwhile,
+    replace the pool and call work once more
+    """
+    pool = get_pool(name, workers)
+    try:
+        return work(pool)
+    except BrokenProcessPool:
+        return work(replace_pool(name, workers, pool))
+
+
+def imap_bounded(pool, fn, jobs, limit):
+    """
+    Run fn(*job) on pool for each job with at most limit of them queued or
+    running at a time, so one request cannot take over a shared pool
+
+    Yields:
+        Results in the order they complete
+    """
+    jobs = iter(jobs)
+    pending = set()
+    while True:
+        for job in jobs:
+            pending.add(pool.submit(fn, *job))
+            if len(pending) >= limit:
+                break
+        if not pending:
+            return
+
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
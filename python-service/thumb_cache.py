@@ -0,0 +1,125 @@
+import os
+import uuid
+import hashlib
+import threading
+
+
+class ThumbnailCache:
+    """
+    Size-bounded on-disk cache of rendered page thumbnails.
+
+    Thumbnails are keyed by the content hash of the document plus the page,
+    width, transform and image format, so a key never goes stale: the same
+    key always describes the same pixels. Files live under <aa>/<key>.<ext>
+    and the least recently used ones are deleted once the cache grows past
+    its size limit. The folder is shared by all worker processes; each one
+    keeps its own running estimate of the size and rescans the folder when
+    the estimate crosses the limit.
+    """
+
+    def __init__(self, root, max_bytes=None):
+        """
+        Args:
+            root: Cache folder
+            max_bytes: Maximum size on disk in bytes (default: THUMB_CACHE_MB or 128 MB)
+        """
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('THUMB_CACHE_MB', 128)) * 1024 * 1024
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._bytes = sum(size for _, size, _ in self._scan())
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    @staticmethod
+    def key(content_hash, page, width, transform, image_format):
+        """Build the cache key of one rendering"""
+        parts = [content_hash, str(page), str(width), image_format]
+        parts.extend(f"{name}={value}" for name, value in sorted(transform.items()))
+        return hashlib.sha256('|'.join(parts).encode('utf-8')).hexdigest()
+
+    def path_for(self, key, image_format):
+        """Get the on-disk location of a thumbnail"""
+        return os.path.join(self.root, key[:2], f"{key}.{image_format}")
+
+    def get(self, key, image_format):
+        """Get the path of a cached thumbnail, or None on a miss"""
+        path = self.path_for(key, image_format)
+        try:
+            # Mark as recently used for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._stats['misses'] += 1
+            return None
+
+        with self._lock:
+            self._stats['hits'] += 1
+        return path
+
+    def put(self, key, image_format, data):
+        """Store a rendered thumbnail and return its path"""
+        path = self.path_for(key, image_format)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write atomically, so concurrent readers never see half an image
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._bytes += len(data)
+            over_limit = self._bytes > self.max_bytes
+
+        if over_limit:
+            self._prune()
+        return path
+
+    def _scan(self):
+        """List (path, size, mtime) of all cached thumbnails"""
+        files = []
+        for folder, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((path, stat.st_size, stat.st_mtime))
+        return files
+
+    def _prune(self):
+        """Delete least recently used thumbnails until the cache is at 90% of its limit"""
+        files = sorted(self._scan(), key=lambda item: item[2])
+        total = sum(size for _, size, _ in files)
+        target = self.max_bytes * 0.9
+
+        evicted = 0
+        for path, size, _ in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+
+        with self._lock:
+            self._bytes = total
+            self._stats['evictions'] += evicted
+
+    def stats(self):
+        """Hit/miss counters and estimated size of the cache"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['bytes'] = self._bytes
+
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,89 @@
+import os
+import time
+import zipfile
+
+
+# Members that are already compressed; deflating them again costs CPU and saves nothing
+STORED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.zip')
+
+
+class _Sink:
+    """Write-only, unseekable buffer that zipfile writes into and the stream drains"""
+
+    def __init__(self):
+        self._chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        self.size = 0
+        return data
+
+
+def _compression_for(arcname):
+    if arcname.lower().endswith(STORED_EXTENSIONS):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def stream_zip(members, chunk_size=64 * 1024):
+    """
+    Produce a ZIP archive chunk by chunk, e.g. as the body of an HTTP response
+
+    members is an iterable of (arcname, source) pairs, where source is either
+    a file path or the member's bytes. It is consumed lazily, so members can
+    be generated (e.g. pages rendered) while the archive is being sent. Only
+    about chunk_size bytes plus one in-memory member are held at a time,
+    whatever the number of members. Images are stored, everything else is
+    deflated.
+
+    Yields:
+        Chunks of the archive (bytes)
+    """
+    sink = _Sink()
+
+    # The sink cannot seek, so zipfile writes sizes in data descriptors after each member
+    with zipfile.ZipFile(sink, 'w') as zip_file:
+        for arcname, source in members:
+            compress_type = _compression_for(arcname)
+
+            if isinstance(source, (bytes, bytearray)):
+                zip_info = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+                zip_info.compress_type = compress_type
+                zip_info.file_size = len(source)
+                with zip_file.open(zip_info, 'w') as dest:
+                    for start in range(0, len(source), chunk_size):
+                        dest.write(source[start:start + chunk_size])
+                        if sink.size >= chunk_size:
+                            yield sink.drain()
+            else:
+                zip_info = zipfile.ZipInfo.from_file(source, arcname)
+                zip_info.compress_type = compress_type
+                with open(source, 'rb') as src, zip_file.open(zip_info, 'w') as dest:
+                    for chunk in iter(lambda: src.read(chunk_size), b''):
+                        dest.write(chunk)
+                        if sink.size >= chunk_size:
+                            yield sink.drain()
+
+            if sink.size:
+                yield sink.drain()
+
+    # Central directory, written when the archive is closed
+    if sink.size:
+        yield sink.drain()
+
+
+def zip_members_from_files(file_infos):
+    """(arcname, path) pairs of the stored files that still exist"""
+    for file_info in file_infos:
+        if file_info and file_info.get('filepath') and os.path.exists(file_info['filepath']):
+            yield file_info['filename'], file_info['filepath']